@@ -0,0 +1,281 @@
+# Batch analysis of saved picoscope shots, in parallel over a process pool
+#
+# Finds the shots (.npz files from get_data_*, 'mmap' trace files, shots in HDF5 run files), has worker processes
+# compute the same reductions as get_data_reduced, the phase of an I/Q pair and/or a PSD of every shot,
+# and appends one row per shot (per segment of rapid block shots) to a columnar HDF5 summary file as the results
+# come in. Shots already in the summary are skipped, so an interrupted run picks up where it stopped. Shots that
+# failed are tried again, their new rows are added after the rows with the error.
+#
+# usage: python analyze_shots.py SHOTS... --output summary.h5 [--reductions spec.json] [--phase A B]
+#                                [--psd A] [--nfft 4096] [--bins-per-decade 10] [--workers 8] [--pattern '*.npz']
+#   SHOTS: shot files, directories (searched recursively for --pattern) or run files (.h5, every shot in them)
+#   --reductions: json reduction spec, or a file holding one, see reductions.py
+#   --phase I Q: phase of the beat note on channels I and Q (phase_noise.py): phase.rms_rad, its rms after
+#                removing the mean frequency, and phase.beat_Hz, that frequency
+#   --psd CHANNEL: Welch PSD of the channel (psd_accumulator.py), log binned with --bins-per-decade > 0
+#
+# Summary file: one dataset per column, in the order the shots finished. A single block shot is one row, a rapid
+# block shot one row per segment, each analysed on its own, so both kinds of shot can be in one summary:
+#   path (run file shots as 'run.h5::shot'), error (empty, or why the shot couldn't be analysed),
+#   segment (index of the segment of a rapid block shot, NaN for single block shots),
+#   time (file modification / shot time), n_samples (per segment), dt_ns
+#   <window>.<channel>.<op> for each reduction
+#   phase.rms_rad, phase.beat_Hz
+#   psd.<channel> (rows x bins) in mV^2/Hz, with the bin frequencies in frequencies/psd.<channel>
+# Values a row doesn't have are NaN. Read it back with e.g.
+#   with h5py.File('summary.h5') as f:
+#       table = pandas.DataFrame({key: f[key][:] for key in f if isinstance(f[key], h5py.Dataset) and f[key].ndim == 1})
+
+import argparse
+import concurrent.futures
+import fnmatch
+import json
+import os
+import time
+
+import h5py
+import numpy as np
+
+from phase_noise import PhaseNoise, trace_phase_noise
+from picoscope_data import load_trace
+from psd_accumulator import WelchAccumulator, add_trace
+from reductions import check_reductions, reduce_saved
+from run_file import load_shot
+
+RUN_FILE_EXTENSIONS = ('.h5', '.hdf5')
+
+
+def find_shots(sources, pattern='*.npz'):
+    # Shot names for the files, directories and run files in sources, in a stable order
+    shots = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                shots += [os.path.join(root, name) for name in sorted(files) if fnmatch.fnmatch(name, pattern)]
+        elif source.endswith(RUN_FILE_EXTENSIONS):
+            with h5py.File(source, 'r') as f:
+                shots += [f'{source}::{name}' for name in f]
+        else:
+            shots.append(source)
+    return shots
+
+
+def open_shot(shot):
+    # The shot as a picoscope_data.Trace, and its time
+    if '::' in shot:
+        path, name = shot.rsplit('::', 1)
+        trace = load_shot(path, name)
+        return trace, float(trace.file.group.attrs.get('time', np.nan))
+    return load_trace(shot), os.path.getmtime(shot)
+
+
+def _segments(trace):
+    # number of segments of a rapid block trace, None for a single block trace
+    first = trace.channel(trace.channels[0], 0, 1)
+    return len(first) if np.ndim(first) == 2 else None
+
+
+def _phase_columns(analysis):
+    # rms of the phase of a PhaseNoise after removing its mean frequency, and that frequency
+    phase = np.concatenate(analysis.chunks)
+    times = np.arange(len(phase))/analysis.rate
+    slope, intercept = np.polyfit(times, phase, 1)
+    return {'phase.rms_rad': np.std(phase - slope*times - intercept), 'phase.beat_Hz': slope/(2*np.pi)}
+
+
+def _psd_columns(accumulator, options):
+    if options['bins_per_decade']:
+        freqs, psd = accumulator.log_binned(options['bins_per_decade'])[:2]
+    else:
+        freqs, psd = accumulator.psd()
+    return {'psd.' + options['psd']: psd, 'psd_freqs_Hz': freqs}
+
+
+def analyze_shot(shot, options):
+    # Everything asked for in options (see main) for one shot. Runs in the worker processes.
+    # Returns the shot's rows, dicts of column: value: one for a single block shot, one per segment of a rapid
+    # block shot. A shot that fails is one row whose error column says why, instead of raising
+    try:
+        trace, shot_time = open_shot(shot)
+        with trace:
+            n_segments = _segments(trace)
+            t0_ns, t1_ns = trace.time_axis(0, 2)
+            dt_ns = t1_ns - t0_ns
+            rows = [{'path': shot, 'error': '', 'segment': segment, 'time': shot_time, 'n_samples': trace.n_samples(), 'dt_ns': dt_ns}
+                    for segment in ([None] if n_segments is None else range(n_segments))]
+            if options['reductions']:
+                for window, channels in reduce_saved(trace, options['reductions']).items():
+                    for channel, ops in channels.items():
+                        for op, value in ops.items():
+                            for row in rows:
+                                row[f'{window}.{channel}.{op}'] = value if n_segments is None else value[row['segment']]
+            # single blocks are read chunk by chunk, rapid block segments (which fit the scope's memory) whole
+            if options['phase']:
+                if n_segments is None:
+                    rows[0].update(_phase_columns(trace_phase_noise(trace, *options['phase'], chunk_samples=options['chunk_samples'], keep_phase=True)))
+                else:
+                    i, q = (trace.channel(channel) for channel in options['phase'])
+                    for row in rows:
+                        analysis = PhaseNoise(1e9/dt_ns, keep_phase=True)
+                        analysis.process(i[row['segment']], q[row['segment']])
+                        row.update(_phase_columns(analysis))
+            if options['psd']:
+                if n_segments is None:
+                    accumulator = WelchAccumulator(1e9/dt_ns, options['nfft'])
+                    add_trace(accumulator, trace, options['psd'], options['chunk_samples'])
+                    rows[0].update(_psd_columns(accumulator, options))
+                else:
+                    mV = trace.channel(options['psd'])
+                    for row in rows:
+                        accumulator = WelchAccumulator(1e9/dt_ns, options['nfft'])
+                        accumulator.add(mV[row['segment']])
+                        row.update(_psd_columns(accumulator, options))
+        return rows
+    except Exception as e:
+        return [{'path': shot, 'error': f'{type(e).__name__}: {e}'}]
+
+
+class Summary:
+    # Columnar HDF5 file rows are appended to. Each column is a dataset that grows with every shot,
+    # numbers as float64 (NaN where a row has no value), arrays as (rows x length), strings as variable length.
+    # A column first seen in a later row is created with the earlier rows set to NaN. The rows of a shot are
+    # appended together and the path column is written last, so if the process dies in the middle of a shot,
+    # its rows are dropped when the file is reopened.
+    # The frequencies of each psd column are in frequencies/<column>
+
+    def __init__(self, path, flush_every=20):
+        self.file = h5py.File(path, 'a')
+        self.rows = len(self.file['path']) if 'path' in self.file else 0
+        self.flush_every = flush_every
+        self.shots = 0
+        for column in self.columns():
+            column.resize(self.rows, axis=0)
+
+    def columns(self):
+        return [self.file[key] for key in self.file if isinstance(self.file[key], h5py.Dataset)]
+
+    def done(self):
+        # shots already analysed. Shots whose row has an error aren't, so a shot that failed for a passing reason
+        # (a file still being written, a network drive away) is tried again on the next run
+        if 'path' not in self.file:
+            return set()
+        paths = self.file['path'][:]
+        errors = self.file['error'][:] if 'error' in self.file else [''] * len(paths)
+        return {path.decode() if isinstance(path, bytes) else path for path, error in zip(paths, errors) if not error}
+
+    def _column(self, key, value):
+        if key in self.file:
+            return self.file[key]
+        if isinstance(value, str):
+            return self.file.create_dataset(key, (self.rows,), h5py.string_dtype(), maxshape=(None,), chunks=(256,))
+        shape = np.shape(value)
+        # chunks of about 1 MB
+        rows = max(1, min(256, 2**17//max(1, int(np.prod(shape)))))
+        return self.file.create_dataset(key, (self.rows,) + shape, float, maxshape=(None,) + shape, chunks=(rows,) + shape, fillvalue=np.nan)
+
+    def append(self, rows):
+        # Add the rows of one shot, dicts of column: value. Raises ValueError, without adding anything, if an array
+        # doesn't have the shape of the column's earlier rows
+        freqs = None
+        for row in rows:
+            freqs = row.pop('psd_freqs_Hz', freqs)
+        rows = [{key: np.nan if value is None else value for key, value in row.items()} for row in rows]
+        shapes = {key: self.file[key].shape[1:] for key in self.file if isinstance(self.file[key], h5py.Dataset) and self.file[key].dtype.kind == 'f'}
+        for row in rows:
+            for key, value in row.items():
+                if not isinstance(value, str) and np.shape(value) != shapes.setdefault(key, np.shape(value)):
+                    raise ValueError(f'{row["path"]}: {key} has shape {np.shape(value)}, earlier rows {shapes[key]}')
+        keys = sorted({key for row in rows for key in row}, key=lambda key: key == 'path')
+        n = len(rows)
+        for key in keys:
+            value = next(row[key] for row in rows if key in row)
+            if key.startswith('psd.') and freqs is not None and 'frequencies/' + key not in self.file:
+                self.file['frequencies/' + key] = freqs
+            column = self._column(key, value)
+            column.resize(self.rows + n, axis=0)
+            missing = '' if isinstance(value, str) else np.full(np.shape(value), np.nan)
+            column[self.rows:self.rows + n] = [row.get(key, missing) for row in rows]
+        self.rows += n
+        self.shots += 1
+        # columns these rows don't have stay at their fill value
+        for column in self.columns():
+            if column.shape[0] < self.rows:
+                column.resize(self.rows, axis=0)
+        if self.flush_every and self.shots % self.flush_every == 0:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('shots', nargs='+', help='shot files, directories or run files')
+    parser.add_argument('--output', required=True, help='HDF5 summary file, appended to if it exists')
+    parser.add_argument('--pattern', default='*.npz', help='file name pattern of the shots in directories')
+    parser.add_argument('--reductions', help='json reduction spec or a file with one')
+    parser.add_argument('--phase', nargs=2, metavar=('I', 'Q'), help='channels of the I and Q quadratures')
+    parser.add_argument('--psd', metavar='CHANNEL', help='channel to compute the PSD of')
+    parser.add_argument('--nfft', type=int, default=4096)
+    parser.add_argument('--bins-per-decade', type=int, default=0)
+    parser.add_argument('--chunk-samples', type=int, default=2**20, help='samples read at a time from long shots')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    reductions = None
+    if args.reductions:
+        if os.path.exists(args.reductions):
+            with open(args.reductions) as f:
+                reductions = json.load(f)
+        else:
+            reductions = json.loads(args.reductions)
+        check_reductions(reductions)
+    options = {'reductions': reductions, 'phase': args.phase, 'psd': args.psd, 'nfft': args.nfft,
+               'bins_per_decade': args.bins_per_decade, 'chunk_samples': args.chunk_samples}
+
+    summary = Summary(args.output)
+    done = summary.done()
+    shots = [shot for shot in find_shots(args.shots, args.pattern) if shot not in done]
+    print(f'{len(shots)} shots to analyse, {len(done)} already in {args.output}')
+
+    # at most a few shots per worker are queued at a time, so results are written as they finish
+    # and nothing but the summary grows with the number of shots
+    start = time.perf_counter()
+    finished = failed = 0
+    pending = set()
+    remaining = iter(shots)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+            while True:
+                for shot in remaining:
+                    pending.add(pool.submit(analyze_shot, shot, options))
+                    if len(pending) >= 2*args.workers:
+                        break
+                if not pending:
+                    break
+                completed, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in completed:
+                    rows = future.result()
+                    try:
+                        summary.append(rows)
+                    except ValueError as e:
+                        rows = [{'path': rows[0]['path'], 'error': str(e)}]
+                        summary.append(rows)
+                    finished += 1
+                    if rows[0]['error']:
+                        failed += 1
+                        print(f'{rows[0]["path"]}: {rows[0]["error"]}')
+                    if finished % 100 == 0:
+                        print(f'{finished}/{len(shots)} shots, {finished/(time.perf_counter() - start):.1f} shots/s')
+    except KeyboardInterrupt:
+        for future in pending:
+            future.cancel()
+        print('interrupted, run again to analyse the rest')
+    finally:
+        summary.close()
+    print(f'{finished} shots analysed ({failed} failed) in {time.perf_counter() - start:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# Benchmark of the ADC count -> mV conversion
+# compares picosdk.functions.adc2mV (what get_data used to call, one python float per sample)
+# with picoscope_data.adc_to_mV (one vectorized multiply over all channels) in float64 and float32
+#
+# usage: python bench_adc_to_mV.py [--channels 4] [--reference-max 1e7]
+# The adc2mV path is slow and needs ~30 bytes of python objects per sample, so it is skipped above
+# --reference-max samples per channel
+
+import argparse
+import ctypes
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from picoscope_data import CHANNEL_RANGES_MV, adc_to_mV
+
+try:
+    from picosdk.functions import adc2mV
+except ImportError:
+    # same as picosdk.functions.adc2mV, so the comparison can run without the picosdk package
+    def adc2mV(bufferADC, range, maxADC):
+        vRange = CHANNEL_RANGES_MV[range]
+        return [(x * vRange) / maxADC.value for x in bufferADC]
+
+
+def best_time(f, repeats):
+    # best of repeats runs, in s
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1e5, 1e6, 1e7, 1e8], help='samples per channel')
+    parser.add_argument('--reference-max', type=float, default=1e7, help='largest size to run adc2mV at')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    ranges = [9]*args.channels # PS5000A_10V
+    maxADC = ctypes.c_int16(32512)
+
+    print(f'{"samples/ch":>12} {"adc2mV (s)":>12} {"float64 (s)":>12} {"float32 (s)":>12} {"speedup64":>10} {"speedup32":>10}')
+    for n in args.sizes:
+        n = int(n)
+        # ctypes buffers like the ones the driver writes into
+        buffers = ((ctypes.c_int16 * n) * args.channels)()
+        counts = np.ctypeslib.as_array(buffers)
+        counts[:] = np.random.randint(-maxADC.value, maxADC.value, size=counts.shape, dtype=np.int16)
+
+        t64 = best_time(lambda: adc_to_mV(np.ctypeslib.as_array(buffers), ranges, maxADC, np.float64), args.repeats)
+        t32 = best_time(lambda: adc_to_mV(np.ctypeslib.as_array(buffers), ranges, maxADC, np.float32), args.repeats)
+        if n <= args.reference_max:
+            tref = best_time(lambda: [adc2mV(buffers[i], ranges[i], maxADC) for i in range(args.channels)], 1)
+            print(f'{n:>12} {tref:>12.4g} {t64:>12.4g} {t32:>12.4g} {tref/t64:>10.1f} {tref/t32:>10.1f}')
+        else:
+            print(f'{n:>12} {"skipped":>12} {t64:>12.4g} {t32:>12.4g} {"":>10} {"":>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# Benchmark of the ways a trace's sample rate is lowered
+#   block mean:   mean of every ratio samples, what the 3000a's hardware averaging (get_data_3000a) does
+#   draft:        scipy.signal.decimate of the whole array once per stage, like decimate(decimate(x, 10), 2)
+#                 in the phase-noise draft (order 8 Chebyshev IIR, run forwards and backwards)
+#   lfilter:      phase_noise's StreamingDecimator before it became polyphase: a 20*ratio+1 tap FIR at the full
+#                 rate per stage, keeping every ratio-th output, in chunks
+#   polyphase:    decimation.Decimator, the multi-stage polyphase plan, in chunks
+# For each ratio it reports the throughput (input samples/s), the peak memory allocated on top of the input
+# (tracemalloc, numpy arrays included) and the alias rejection: how much of a tone just above the new Nyquist
+# frequency, which would fold back into the kept band, gets through (dB, lower is better)
+#
+# usage: python bench_decimation.py [--samples 1e7] [--ratios 20 32 1000] [--chunk-samples 1048576]
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from scipy import signal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from decimation import Decimator, plan_stages
+from phase_noise import StreamingDecimator
+
+
+def block_mean(x, ratio, chunk_samples):
+    n = x.shape[-1] // ratio * ratio
+    return x[..., :n].reshape(x.shape[:-1] + (-1, ratio)).mean(axis=-1)
+
+
+def draft(x, ratio, chunk_samples):
+    for r in plan_stages(ratio):
+        x = signal.decimate(x, r)
+    return x
+
+
+def lfilter_stages(x, ratio, chunk_samples):
+    # the lfilter implementation StreamingDecimator had, kept here as the reference
+    stages = []
+    for r in plan_stages(ratio):
+        taps = signal.firwin(20*r + 1, 0.8/r)
+        stages.append({'ratio': r, 'taps': taps, 'zi': None, 'next': 0})
+    out = []
+    for start in range(0, x.shape[-1], chunk_samples):
+        y = x[start:start + chunk_samples]
+        for stage in stages:
+            if stage['zi'] is None:
+                stage['zi'] = signal.lfilter_zi(stage['taps'], 1)*y[0]
+            filtered, stage['zi'] = signal.lfilter(stage['taps'], 1, y, zi=stage['zi'])
+            y = filtered[stage['next']::stage['ratio']]
+            stage['next'] = (stage['next'] - len(filtered)) % stage['ratio']
+        out.append(y)
+    return np.concatenate(out)
+
+
+def draft_stages(x, ratio, chunk_samples):
+    # StreamingDecimator as it is now: the draft's filters run polyphase
+    decimator = Decimator(ratio, stages=[StreamingDecimator(r) for r in plan_stages(ratio)])
+    return np.concatenate([decimator.process(x[start:start + chunk_samples]) for start in range(0, x.shape[-1], chunk_samples)])
+
+
+def polyphase(x, ratio, chunk_samples):
+    decimator = Decimator(ratio)
+    return np.concatenate([decimator.process(x[start:start + chunk_samples]) for start in range(0, x.shape[-1], chunk_samples)])
+
+
+METHODS = {'block mean': block_mean, 'draft': draft, 'lfilter': lfilter_stages, 'draft taps, polyphase': draft_stages, 'polyphase': polyphase}
+
+
+def measure(method, x, ratio, chunk_samples):
+    # time and peak memory of one run
+    tracemalloc.start()
+    start = time.perf_counter()
+    method(x, ratio, chunk_samples)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def alias_rejection(method, ratio, chunk_samples, n=2**18):
+    # output power of a unit tone at 1.2x the new Nyquist frequency relative to a tone in the passband, in dB
+    t = np.arange(n*ratio//64)
+    powers = []
+    for f in (0.1/ratio, 0.6/ratio):
+        y = method(np.sin(2*np.pi*f*t), ratio, chunk_samples)
+        y = y[len(y)//10:-len(y)//10]
+        powers.append(np.mean(y**2))
+    return 10*np.log10(powers[1]/powers[0])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', type=float, default=1e7, help='input samples (one channel)')
+    parser.add_argument('--ratios', type=int, nargs='+', default=[20, 32, 1000])
+    parser.add_argument('--chunk-samples', type=int, default=2**20)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    x = np.random.default_rng(0).normal(size=int(args.samples))
+    print(f'{int(args.samples)} samples, {x.nbytes/1e6:.0f} MB float64 input\n')
+    print(f'{"ratio":>6} {"method":>22} {"MS/s":>8} {"peak MB":>9} {"alias dB":>9}')
+    for ratio in args.ratios:
+        for name, method in METHODS.items():
+            elapsed, peak = min(measure(method, x, ratio, args.chunk_samples) for _ in range(args.repeats))
+            rejection = alias_rejection(method, ratio, args.chunk_samples)
+            print(f'{ratio:>6} {name:>22} {len(x)/elapsed/1e6:>8.1f} {peak/1e6:>9.1f} {rejection:>9.1f}')
+        print()
+
+
+if __name__ == '__main__':
+    main()
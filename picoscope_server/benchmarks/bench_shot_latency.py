@@ -0,0 +1,152 @@
+# Per-shot latency benchmark of the picoscope server
+# runs PicoscopeServer settings directly (no LabRAD manager needed) against the simulated scope from
+# picoscope_simulator.py, and reports where the time of each get_data call goes (see get_timings)
+# and the shots/s reached, for every combination of sample count, channel count and storage format
+#
+# usage: python bench_shot_latency.py [--samples 1e4 1e6] [--channels 1 4] [--formats mV raw] [--async-save 4]
+#                                     [--output results.json] [--compare old_results.json]
+# The simulated trigger delay and transfer rate default to 0, so the numbers are the server's own
+# overhead. Set --transfer-rate (bytes/s) and --trigger-delay to model a real scope instead.
+# --output writes one json record per configuration; --compare prints the change against such a file
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from picoscope_server import PicoscopeServer
+
+STAGES = ['open', 'setup', 'arm', 'trigger_wait', 'transfer', 'convert', 'save', 'queue']
+
+
+def version():
+    # git commit of the server code, so results files say what they were measured on
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def run(server, model, path, n_samples, n_channels, storage, shots, async_save=0):
+    # Set up the server like an experiment would and time shots get_data calls.
+    # Returns the record for one configuration
+    # The server prints a line per setting and shot, which is kept out of the results table.
+    # The first shot opens the scope and allocates the buffers, it is reported separately
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i, name in enumerate('ABCD'):
+            server.set_channel(None, name, i < n_channels)
+        server.set_storage_format(None, storage)
+        server.set_async_save(None, async_save)
+        get_data = server.get_data_5000a if model == '5000a' else server.get_data_3000a
+        if model == '5000a':
+            server.set_recordduration_5000a(None, n_samples*1e-8, n_samples//10, n_samples - n_samples//10)
+        else:
+            server.set_recordduration_3000a(None, n_samples*1e-8, n_samples//10, n_samples - n_samples//10, 1)
+
+        start = time.perf_counter()
+        get_data(None, path, 'BENCH')
+        first_shot = time.perf_counter() - start
+
+    totals = []
+    timings = {stage: [] for stage in STAGES}
+    for _ in range(shots):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            get_data(None, path, 'BENCH')
+            totals.append(time.perf_counter() - start)
+        shot = json.loads(server.get_timings(None, 'BENCH'))
+        for stage in STAGES:
+            timings[stage].append(shot.get(stage, 0))
+
+    # with background saving the last files are still being written, which counts towards the shot rate
+    start = time.perf_counter()
+    server.wait_for_save(None, path)
+    drain = time.perf_counter() - start
+
+    return {
+        'model': model,
+        'samples': n_samples,
+        'channels': n_channels,
+        'storage': storage,
+        'shots': shots,
+        'first_shot_s': first_shot,
+        'median_shot_s': float(np.median(totals)),
+        'async_save': async_save,
+        'shots_per_s': shots/(sum(totals) + drain),
+        'file_MB': os.path.getsize(path)/1e6,
+        'median_stage_s': {stage: float(np.median(timings[stage])) for stage in STAGES},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='5000a', choices=['5000a', '3000a'])
+    parser.add_argument('--samples', type=float, nargs='+', default=[1e4, 1e5, 1e6, 1e7], help='samples per channel')
+    parser.add_argument('--channels', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--formats', nargs='+', default=['mV', 'raw'])
+    parser.add_argument('--shots', type=int, default=10)
+    parser.add_argument('--async-save', type=int, default=0, help='max_pending of set_async_save, 0 saves inline')
+    parser.add_argument('--trigger-delay', type=float, default=0, help='simulated s from arming to trigger')
+    parser.add_argument('--transfer-rate', type=float, default=0, help='simulated USB transfer rate in bytes/s, 0 for instant')
+    parser.add_argument('--dir', default=None, help='directory the traces are saved in, a temporary one by default')
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--compare', help='json results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    server = PicoscopeServer()
+    server.initServer()
+    server.set_simulated(None, True, json.dumps({'trigger_delay_s': args.trigger_delay, 'transfer_rate': args.transfer_rate, 'memory_samples': 2**30, 'reuse_waveforms': True, 'seed': 0}))
+
+    directory = args.dir or tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench.npz')
+    results = []
+    print(f'{"samples":>10} {"ch":>3} {"format":>6} {"shots/s":>9} {"shot ms":>9} ' + ' '.join(f'{stage:>12}' for stage in STAGES))
+    for n_samples in args.samples:
+        for n_channels in args.channels:
+            for storage in args.formats:
+                result = run(server, args.model, path, int(n_samples), n_channels, storage, args.shots, args.async_save)
+                results.append(result)
+                stages = ' '.join(f'{result["median_stage_s"][stage]*1e3:>12.3f}' for stage in STAGES)
+                print(f'{result["samples"]:>10} {n_channels:>3} {storage:>6} {result["shots_per_s"]:>9.2f} {result["median_shot_s"]*1e3:>9.3f} {stages}')
+    server.stopServer()
+    if args.dir is None:
+        os.remove(path)
+        os.rmdir(directory)
+    print('(stage times are medians in ms)')
+
+    if args.output:
+        report = {
+            'version': version(),
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'options': vars(args),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        old_results = {(r['model'], r['samples'], r['channels'], r['storage'], r.get('async_save', 0)): r for r in old['results']}
+        print(f'\ncompared with {args.compare} ({old.get("version")}), median shot time new/old')
+        for result in results:
+            key = (result['model'], result['samples'], result['channels'], result['storage'], result.get('async_save', 0))
+            if key in old_results:
+                ratio = result['median_shot_s']/old_results[key]['median_shot_s']
+                print(f'{result["samples"]:>10} {result["channels"]:>3} {result["storage"]:>6} {ratio:>9.2f}' + ('  slower' if ratio > 1.1 else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# Multi-stage polyphase decimation of long traces, chunk by chunk
+#
+# Lowers the sample rate by any integer ratio with an anti-aliasing filter, without the full rate
+# intermediates of decimate(decimate(x, 10), 2) or the rough response of a plain block mean (the 3000a's
+# hardware averaging is a moving-average filter with -13 dB sidelobes that alias into the passband).
+#   The ratio is split into stages of at most max_stage (e.g. 1000 -> 10, 10, 10). Each stage's FIR filter
+#   (Kaiser window design, attenuation_dB in the stopband) only has to keep out what would alias into the final
+#   passband, so the early stages run at the high rates with short filters and the sharp filter runs last,
+#   at the lowest rate. That is far fewer taps per input sample than a single stage filter.
+#   Each stage is polyphase (scipy.signal.upfirdn): only the kept output samples are computed, not
+#   ratio times as many that are then thrown away.
+#   Filter history and the position of the next output are carried from chunk to chunk, so any chunking gives
+#   the same output as the whole array in one go, and only one chunk of full rate samples is in memory.
+#   Input before the first sample is taken to equal the first sample, so a DC level gives no start-up step.
+# Usage:
+#   decimator = Decimator(ratio)
+#   for chunk in chunks: out.append(decimator.process(chunk))    # chunk: (..., samples), rows are independent
+#   output sample k is at input sample k*ratio - decimator.delay   (delay: the filters' group delay)
+# or decimate(x, ratio) for an array in memory, processed chunk_samples at a time
+
+import numpy as np
+from scipy import signal
+
+
+def plan_stages(ratio, max_stage=10):
+    # Split ratio into stage ratios of at most max_stage (unless ratio has a larger prime factor), largest first
+    factors = []
+    n, p = int(ratio), 2
+    while p*p <= n:
+        while n % p == 0:
+            factors.append(p)
+            n //= p
+        p += 1
+    if n > 1:
+        factors.append(n)
+    # fill each stage with the largest factors that still fit
+    stages = []
+    for factor in sorted(factors, reverse=True):
+        for i, stage in enumerate(stages):
+            if stage*factor <= max_stage:
+                stages[i] *= factor
+                break
+        else:
+            stages.append(factor)
+    return sorted(stages, reverse=True)
+
+
+def design_stage(ratio, rate_out, passband_Hz, last, attenuation_dB=80):
+    # Low-pass FIR taps for one stage, in units of its input rate (ratio*rate_out). It passes 0..passband_Hz, the
+    # final passband, and stops everything that would alias onto it: from rate_out - passband_Hz for
+    # intermediate stages, and from the final Nyquist frequency rate_out/2 for the last one
+    rate_in = ratio*rate_out
+    stop_Hz = rate_out/2 if last else rate_out - passband_Hz
+    numtaps, beta = signal.kaiserord(attenuation_dB, (stop_Hz - passband_Hz)/(rate_in/2))
+    numtaps |= 1 # odd, so the delay is a whole number of samples
+    return signal.firwin(numtaps, (passband_Hz + stop_Hz)/2, window=('kaiser', beta), fs=rate_in)
+
+
+class PolyphaseStage:
+    # One FIR filter + downsample by ratio, fed in chunks along the last axis
+
+    def __init__(self, ratio, taps):
+        self.ratio = ratio
+        self.taps = np.asarray(taps, dtype=float)
+        self.history = None # the last len(taps)-1 samples of the input so far
+        self.next = len(self.taps) - 1 # position of the next output in history + the next chunk
+
+    def process(self, x):
+        L, r = len(self.taps), self.ratio
+        if self.history is None:
+            self.history = np.repeat(x[..., :1], L - 1, axis=-1).astype(float)
+        x = np.concatenate((self.history, x), axis=-1)
+        n = x.shape[-1]
+        n_out = max(0, -(-(n - self.next)//r))
+        # upfirdn computes the outputs at multiples of r, so the input is shifted to put self.next on one.
+        # Only the samples the outputs need are passed
+        start = self.next - (L - 1)
+        pad = (-(L - 1)) % r
+        first = (pad + L - 1)//r
+        if n_out:
+            padded = x[..., start:start + (n_out - 1)*r + L]
+            if pad:
+                padded = np.concatenate((np.zeros(padded.shape[:-1] + (pad,)), padded), axis=-1)
+            y = signal.upfirdn(self.taps, padded, 1, r, axis=-1)[..., first:first + n_out]
+        else:
+            y = np.zeros(x.shape[:-1] + (0,))
+        self.next += n_out*r - n + L - 1
+        self.history = x[..., n - (L - 1):] if L > 1 else x[..., :0]
+        return y
+
+
+class Decimator:
+
+    def __init__(self, ratio, passband=0.8, attenuation_dB=80, max_stage=10, stages=None):
+        # Inputs:
+        #   ratio: total integer decimation ratio
+        #   passband: kept band as a fraction of the output Nyquist frequency, flat to within the filter ripple
+        #   attenuation_dB: stopband attenuation of every stage
+        #   max_stage: largest ratio of one stage, see plan_stages
+        #   stages: list of PolyphaseStage to use instead of designing them
+        self.ratio = int(ratio)
+        if stages is None:
+            ratios = plan_stages(self.ratio, max_stage)
+            passband_Hz = passband*0.5 # in units of the output rate
+            stages = []
+            rate = float(self.ratio) # input rate, in units of the output rate
+            for i, r in enumerate(ratios):
+                rate /= r
+                stages.append(PolyphaseStage(r, design_stage(r, rate, passband_Hz, i == len(ratios) - 1, attenuation_dB)))
+        self.stages = stages
+        # group delay of the filters in input samples
+        self.delay = 0
+        step = 1
+        for stage in self.stages:
+            self.delay += step*(len(stage.taps) - 1)/2
+            step *= stage.ratio
+
+    def process(self, x):
+        # Decimate the next chunk, (..., samples) with independent rows. Returns the new output samples
+        for stage in self.stages:
+            x = stage.process(x)
+        return x
+
+    def taps_per_sample(self):
+        # multiplies per input sample, the cost of the plan
+        total, step = 0, 1
+        for stage in self.stages:
+            total += len(stage.taps)/(step*stage.ratio)
+            step *= stage.ratio
+        return total
+
+
+def decimate(x, ratio, chunk_samples=2**20, out=None, **options):
+    # Decimate x (..., samples) by ratio with a Decimator (options are passed to it), chunk_samples at a time so the
+    # filter intermediates stay small
+    # Inputs:
+    #   ratio: total ratio, or a new Decimator to use
+    #   out: optional preallocated (..., ceil(samples/ratio)) array to fill
+    decimator = ratio if isinstance(ratio, Decimator) else Decimator(ratio, **options)
+    n_out = -(-x.shape[-1]//decimator.ratio)
+    if out is None:
+        out = np.empty(x.shape[:-1] + (n_out,))
+    k = 0
+    for start in range(0, x.shape[-1], chunk_samples):
+        y = decimator.process(x[..., start:start + chunk_samples])
+        out[..., k:k + y.shape[-1]] = y
+        k += y.shape[-1]
+    return out
@@ -0,0 +1,110 @@
+# Memory-mapped trace files
+#
+# A capture in 'mmap' storage (set_storage_format) goes straight from the driver into a file: the
+# driver's data buffers are rows of an np.memmap of the file, so GetValues writes the samples into
+# the page cache and the OS writes them to disk, with no conversion, copy or np.savez in between.
+#
+# File layout:
+#   header, HEADER_SIZE bytes unless more were reserved: MAGIC, then as little endian uint32 the size of
+#           the header (where the samples start) and the length of the json, the json, zero padding.
+#           The json holds the same fields as a raw .npz trace (picoscope_data.pack_raw) plus shape,
+#           dtype, n_samples and complete
+#   then: the int16 counts, C order, shape (channels x samples) or (segments x channels x samples)
+# n_samples is 0 and complete false until the capture is finished, so a reader that opens the file
+# early can tell. Open with open_mmap_trace (or picoscope_data.load_trace), which maps the file
+# instead of reading it.
+
+import json
+import struct
+
+import numpy as np
+
+from picoscope_data import Trace
+
+MAGIC = b'PICOMMAP'
+HEADER_SIZE = 4096
+
+
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def is_mmap_trace(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_header(path, header, header_size):
+    # (Re)write the header of a trace file in place
+    text = json.dumps({key: _jsonable(value) for key, value in header.items()}).encode()
+    if len(MAGIC) + 8 + len(text) > header_size:
+        raise ValueError(f'trace header of {len(text)} bytes does not fit in {header_size}')
+    with open(path, 'r+b') as f:
+        f.write(MAGIC + struct.pack('<II', header_size, len(text)) + text)
+
+
+def read_header(path):
+    # Returns the header dict and the header size
+    with open(path, 'rb') as f:
+        start = f.read(len(MAGIC) + 8)
+        if start[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a memory-mapped picoscope trace')
+        header_size, length = struct.unpack('<II', start[len(MAGIC):])
+        return json.loads(f.read(length)), header_size
+
+
+def create_mmap_trace(path, shape, header, header_size=HEADER_SIZE):
+    # Create a trace file for shape int16 samples and return it mapped as a writable np.memmap.
+    # The file is allocated up front (sparse where the filesystem allows), pages are written out by the OS
+    # as the driver fills them
+    # Inputs:
+    #   shape: (channels x samples) or (segments x channels x samples)
+    #   header: dict of metadata, e.g. pack_raw without the counts
+    #   header_size: bytes reserved for the header, a multiple of HEADER_SIZE keeps the samples page aligned.
+    #                Has to fit anything finish_mmap_trace adds later
+    header = dict(header, shape=list(shape), dtype='int16', n_samples=0, complete=False)
+    with open(path, 'wb') as f:
+        f.truncate(header_size + 2*int(np.prod(shape)))
+    write_header(path, header, header_size)
+    return np.memmap(path, dtype=np.int16, mode='r+', offset=header_size, shape=tuple(shape))
+
+
+def finish_mmap_trace(data, n_samples, extra=None):
+    # Mark the capture in a file from create_mmap_trace as complete, with n_samples valid samples per channel.
+    # The samples themselves are already in the file
+    # extra: dict of any other (small) values to add to the header, e.g. trigger offsets
+    header, header_size = read_header(data.filename)
+    header.update(extra or {}, n_samples=int(n_samples), complete=True)
+    write_header(data.filename, header, header_size)
+
+
+class _MmapFiles:
+    # Gives a mapped trace file the .files / [key] / close() interface of np.load, for picoscope_data.Trace
+
+    def __init__(self, path):
+        self.path = path
+        self.header, self.header_size = read_header(path)
+        self.files = ['adc'] + list(self.header)
+
+    def __getitem__(self, key):
+        if key == 'adc':
+            # mapped when first asked for, so opening a trace only reads its header.
+            # A capture still being written has n_samples 0, the whole buffer is returned then
+            adc = np.memmap(self.path, dtype=np.int16, mode='r', offset=self.header_size, shape=tuple(self.header['shape']))
+            return adc[..., :self.header['n_samples'] or adc.shape[-1]]
+        value = self.header[key]
+        return np.array(value) if isinstance(value, list) else value
+
+    def close(self):
+        # the file is unmapped once no arrays taken from it are left
+        pass
+
+
+def open_mmap_trace(path):
+    # Open a trace file as a picoscope_data.Trace. The counts are mapped, not read, so only the
+    # parts of the file that are used are loaded from disk
+    return Trace(path, _MmapFiles(path))
@@ -0,0 +1,118 @@
+# Heterodyne phase-noise analysis of picoscope captures, in bounded memory
+#
+# Takes the I and Q quadratures of a beat note on two channels (e.g. A and B) and gives the phase and its
+# power spectral density, like the draft in 'picoscope server drafts/picoscope_server.py', but chunk by chunk:
+#   phase = unwrap(arctan2(I, Q))      no division, so zeros don't need replacing
+#   decimated by StreamingDecimator stages (10 and 2 by default, like decimate(decimate(x, 10), 2)), or
+#   by a decimation.Decimator plan for any total ratio (decimation=200)
+#   detrended and turned into a PSD at the end, on the decimated phase only
+# Only one chunk of full rate samples is in memory at a time, and the unwrap and filter state is carried
+# from chunk to chunk, so the result doesn't depend on the chunk size.
+# The PSD is computed in bounded memory by a psd_accumulator.WelchAccumulator (at the decimated rate,
+# detrend='linear') that is fed each decimated chunk, and can be shared by many captures to average them:
+#   accumulator = WelchAccumulator(sample_rate/20, nfft=2**14, detrend='linear')
+#   for path in paths: trace_phase_noise(path, accumulator=accumulator)   # or stream_phase_noise(path, ...)
+#   freqs, psd = accumulator.psd()              # rad^2/Hz, psd*freqs**2 for Hz^2/Hz
+# With keep_phase=True the whole decimated phase is kept as well, for phase() and the draft's single Welch
+# estimate psd(). That buffer grows with the record (8 bytes per decimated sample), so only use it for
+# records that fit in memory:
+#   analysis = PhaseNoise(sample_rate, keep_phase=True)
+#   for I, Q in chunks: analysis.process(I, Q)
+#   freqs, psd = analysis.psd()
+
+import json
+
+import numpy as np
+from scipy import signal
+
+from decimation import Decimator, PolyphaseStage
+from picoscope_data import load_trace, read_stream
+
+
+class StreamingDecimator(PolyphaseStage):
+    # One decimation stage with the draft's filter, fed in chunks (see decimation.PolyphaseStage): low-pass FIR and
+    # downsample by ratio. Gives the same output as filtering at the full rate and keeping every ratio-th sample
+
+    def __init__(self, ratio, numtaps=None):
+        # Inputs:
+        #   ratio: integer decimation ratio
+        #   numtaps: FIR length, 20*ratio + 1 by default (cutoff at 80% of the new Nyquist frequency)
+        super().__init__(ratio, signal.firwin(numtaps or 20*ratio + 1, 0.8/ratio))
+
+
+class PhaseNoise:
+
+    def __init__(self, sample_rate, decimation=(10, 2), accumulator=None, keep_phase=False):
+        # Inputs:
+        #   sample_rate: sample rate of the I and Q samples in Hz
+        #   decimation: ratio of each decimation stage with the draft's filters (StreamingDecimator), or a total
+        #               ratio for a decimation.Decimator plan. The phase is kept at sample_rate/prod(decimation)
+        #   accumulator: optional WelchAccumulator at the decimated rate, the phase of this capture is added to it
+        #   keep_phase: True to also keep every decimated chunk for phase() and psd(). Memory grows with the record
+        self.sample_rate = sample_rate
+        self.accumulator = accumulator
+        self.keep_phase = keep_phase
+        if np.ndim(decimation):
+            self.decimator = Decimator(np.prod(decimation), stages=[StreamingDecimator(ratio) for ratio in decimation])
+        else:
+            self.decimator = Decimator(decimation)
+        self.rate = sample_rate/self.decimator.ratio
+        self.last_phase = None # last unwrapped phase of the previous chunk
+        self.chunks = [] # decimated phase of each chunk, with keep_phase
+        self.samples = 0
+
+    def process(self, i, q):
+        # Add the next chunk of I and Q samples (any units, as long as they are the same)
+        phase = np.arctan2(i, q)
+        # unwrapping with the previous chunk's last phase in front carries the 2 pi jumps across chunks
+        if self.last_phase is not None:
+            phase = np.unwrap(np.concatenate(([self.last_phase], phase)))[1:]
+        else:
+            phase = np.unwrap(phase)
+        self.last_phase = phase[-1]
+        phase = self.decimator.process(phase)
+        if self.accumulator is not None:
+            self.accumulator.add(phase, continued=self.samples > 0)
+        if self.keep_phase:
+            self.chunks.append(phase)
+        self.samples += len(i)
+
+    def phase(self):
+        # Decimated, detrended phase in rad and its times in s since the first sample, with keep_phase
+        if not self.keep_phase:
+            raise ValueError('the phase was not kept, use keep_phase=True or an accumulator for the PSD')
+        phase = signal.detrend(np.concatenate(self.chunks))
+        return np.arange(len(phase))/self.rate, phase
+
+    def psd(self, nperseg=None):
+        # One-sided PSD of the phase in rad^2/Hz (Welch, Hann window, 50% overlap) and its frequencies in Hz,
+        # without the DC bin. nperseg defaults to a tenth of the decimated phase, like the draft's NFFT
+        times, phase = self.phase()
+        freqs, psd = signal.welch(phase, fs=self.rate, nperseg=nperseg or len(phase)//10)
+        return freqs[1:], psd[1:]
+
+
+def trace_phase_noise(path, i='A', q='B', decimation=(10, 2), chunk_samples=2**20, accumulator=None, keep_phase=False):
+    # PhaseNoise of a trace saved by get_data_* (any storage format), read chunk_samples at a time.
+    # path can also be a trace that is already open, e.g. a shot of a run file (run_file.load_shot)
+    if isinstance(path, str):
+        with load_trace(path) as trace:
+            return trace_phase_noise(trace, i, q, decimation, chunk_samples, accumulator, keep_phase)
+    trace = path
+    dt_ns = np.diff(trace.time_axis(0, 2))[0]
+    analysis = PhaseNoise(1e9/dt_ns, decimation, accumulator, keep_phase)
+    for start in range(0, trace.n_samples(), chunk_samples):
+        analysis.process(trace.channel(i, start, start + chunk_samples), trace.channel(q, start, start + chunk_samples))
+    return analysis
+
+
+def stream_phase_noise(path, i='A', q='B', decimation=(10, 2), chunk_samples=2**20, accumulator=None, keep_phase=False):
+    # PhaseNoise of a stream_5000a recording, read chunk_samples at a time. Recordings can be hours long,
+    # keep_phase only for short ones
+    with open(path + '.json') as f:
+        metadata = json.load(f)
+    analysis = PhaseNoise(1e9/metadata['sample_interval_ns'], decimation, accumulator, keep_phase)
+    rows = [metadata['channels'].index(i), metadata['channels'].index(q)]
+    for chunk in read_stream(path, chunk_samples):
+        analysis.process(chunk[rows[0]], chunk[rows[1]])
+    return analysis
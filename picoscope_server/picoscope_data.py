@@ -0,0 +1,255 @@
+# Helpers for picoscope trace data that don't need the picosdk driver or labrad,
+# so analysis code and benchmarks can use them as well as the server
+
+import json
+import struct
+import zipfile
+
+import numpy as np
+
+# full scale of each PS5000A_RANGE / PS3000A_RANGE value in mV, same table as picosdk.functions.adc2mV
+CHANNEL_RANGES_MV = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000]
+
+
+def adc_to_mV(counts, ranges, maxADC, dtype=np.float64, channel_axis=0, out=None):
+    # Convert ADC counts to mV for all channels with one vectorized multiply.
+    # Replaces picosdk.functions.adc2mV, which loops over the samples in python
+    # Inputs:
+    #   counts: int16 array of ADC counts, e.g. (channels x samples), or a single channel's samples
+    #           np.ctypeslib.as_array gives a no-copy view of a ctypes buffer the driver wrote into
+    #   ranges: PS5000A_RANGE / PS3000A_RANGE value of each channel, or a single value for one channel
+    #   maxADC: max ADC count, an int or the c_int16 filled in by MaximumValue
+    #   dtype: np.float64, or np.float32 for half the memory and a faster conversion
+    #   channel_axis: axis of counts that runs over the channels, e.g. 1 for (segments x channels x samples)
+    #   out: optional preallocated array of counts.shape and dtype to write the result into
+    maxADC = getattr(maxADC, 'value', maxADC)
+    scale = np.array([CHANNEL_RANGES_MV[r] for r in np.atleast_1d(ranges)], dtype=dtype) / maxADC
+    if np.ndim(ranges) == 0:
+        scale = scale[0]
+    else:
+        shape = [1]*np.ndim(counts)
+        shape[channel_axis] = -1
+        scale = scale.reshape(shape)
+    return np.multiply(counts, scale, out=out, dtype=dtype)
+
+
+def pack_raw(counts, ranges, maxADC, offsets_V, t0_ns, dt_ns, channels='ABCD'):
+    # Build the arrays np.savez stores for a raw (int16) trace file. 2 bytes per sample per channel
+    # instead of the 8 bytes of a float64 mV array plus 8 for the time array. Read with load_trace
+    # Inputs:
+    #   counts: int16 ADC counts, (channels x samples) or (segments x channels x samples)
+    #   ranges: PS5000A_RANGE / PS3000A_RANGE value of each channel
+    #   maxADC: max ADC count, an int or the c_int16 filled in by MaximumValue
+    #   offsets_V: analog offset of each channel as passed to SetChannel, in V
+    #   t0_ns: time of the first sample relative to the trigger
+    #   dt_ns: time between samples
+    #   channels: channel names, in the order of the channel axis of counts
+    return {
+        'format': 'raw',
+        'adc': counts,
+        'channels': np.array(list(channels)),
+        'range_mV': np.array([CHANNEL_RANGES_MV[r] for r in ranges], dtype=float),
+        'maxADC': getattr(maxADC, 'value', maxADC),
+        'offset_mV': np.array(offsets_V, dtype=float)*1e3,
+        't0_ns': t0_ns,
+        'dt_ns': dt_ns,
+    }
+
+
+def envelope(counts, n_points):
+    # Min/max envelope of a trace decimated to n_points bins along the last axis, for previews: every
+    # spike and edge stays visible, which plain decimation (counts[..., ::step]) can miss.
+    # Returns the min and max of each bin and the index of the first sample of each bin.
+    # Traces with no more than n_points samples are returned as they are
+    n = counts.shape[-1]
+    if n <= n_points:
+        return counts, counts, np.arange(n)
+    starts = np.arange(n_points)*n // n_points
+    return np.minimum.reduceat(counts, starts, axis=-1), np.maximum.reduceat(counts, starts, axis=-1), starts
+
+
+# arrays in .npz files smaller than this are read, larger ones memory-mapped, see _NpzFiles
+MAP_BYTES = 2**16
+
+
+class _NpzFiles:
+    # The .files / [key] / close() interface of np.load for a .npz trace, but arrays stored uncompressed (np.savez,
+    # what the server writes) are memory-mapped straight from the file rather than read: a slice of
+    # one only reads those samples from disk. Compressed members (np.savez_compressed) are read whole as np.load would.
+    # Only the zip directory is read on opening and no file is kept open, so thousands of traces can be opened at once
+
+    def __init__(self, path):
+        self.path = path
+        with zipfile.ZipFile(path) as f:
+            self.members = {info.filename[:-4]: info for info in f.infolist() if info.filename.endswith('.npy')}
+        self.files = list(self.members)
+        self.small = {} # small arrays already read, e.g. the scaling of raw traces
+        self.layout = {} # dtype, shape, order and file offset of the mapped arrays
+
+    def __getitem__(self, key):
+        if key in self.small:
+            return self.small[key]
+        if key in self.layout:
+            dtype, shape, order, offset = self.layout[key]
+            return np.memmap(self.path, dtype, 'c', offset, shape, order)
+        info = self.members[key]
+        if info.compress_type != zipfile.ZIP_STORED:
+            with zipfile.ZipFile(self.path) as f, f.open(info) as member:
+                return np.lib.format.read_array(member, allow_pickle=False)
+        with open(self.path, 'rb') as f:
+            # the member's data starts after its local header, whose extra field can differ from the directory's
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            if dtype.hasobject:
+                raise ValueError(f'{key} in {self.path} holds python objects, which are not loaded')
+            order = 'F' if fortran_order else 'C'
+            size = int(np.prod(shape))*dtype.itemsize
+            if size < MAP_BYTES:
+                self.small[key] = np.frombuffer(f.read(size), dtype).reshape(shape, order=order)
+                return self.small[key]
+            # copy on write: the array can be changed in place like np.load's, without changing the file
+            self.layout[key] = dtype, shape, order, f.tell()
+            return np.memmap(self.path, dtype, 'c', f.tell(), shape, order)
+
+    def close(self):
+        # mapped arrays taken from the file stay valid, the file is unmapped once they are gone
+        self.small = {}
+
+
+def time_axis(t0_ns, dt_ns, start, stop):
+    # Times in ns of samples start..stop-1 of a trace whose sample 0 is at t0_ns
+    return t0_ns + np.arange(start, stop)*dt_ns
+
+
+class Trace:
+    # Read-only, dict-like access to a saved trace, the way analysis code should open the server's files, e.g.
+    #   trace = load_trace(path)
+    #   trace['ChA_mV'], trace['time_ns']                      whole channels
+    #   times_ns, mV = trace.window(1000, 2000, ['A', 'B'])     just the samples between two times
+    #   trace.channel('A', start, stop)                        or between two sample indices
+    # Opening a trace reads almost nothing: the samples are memory-mapped (uncompressed .npz members, 'mmap'
+    # trace files) or read chunk by chunk (run file shots), so a window of a long capture only costs its own
+    # samples, and only the channels asked for.
+    # Files saved with ChA_mV.. float arrays are returned as stored. For raw files (pack_raw) each ChX_mV
+    # is only converted to mV when it is asked for, as
+    #   mV = counts*range_mV/maxADC - offset_mV
+    # The time axis is rebuilt from t0_ns and dt_ns when it is asked for, as trace['time_ns'] or just
+    # a part of it with trace.time_axis(start, stop). Older files with a stored time_ns array still work
+
+    def __init__(self, path, file=None):
+        # file: already opened source with the np.load interface, e.g. a shot of a run file (run_file.load_shot)
+        self.path = path
+        self.file = _NpzFiles(path) if file is None else file
+        self.raw = 'format' in self.file.files and str(self.file['format']) == 'raw'
+        self.implicit_time = 'time_ns' not in self.file.files and 't0_ns' in self.file.files
+        self.adc = None
+        if self.raw:
+            self.channels = [str(name) for name in self.file['channels']]
+            self.range_mV = self.file['range_mV']
+            self.maxADC = int(self.file['maxADC'])
+            self.offset_mV = self.file['offset_mV']
+        else:
+            self.channels = [key[2:-3] for key in self.file.files if key.startswith('Ch') and key.endswith('_mV')]
+
+    def keys(self):
+        keys = ['time_ns'] if self.implicit_time else []
+        if self.raw:
+            keys += ['Ch' + name + '_mV' for name in self.channels]
+        return keys + [key for key in self.file.files if key not in ('format', 'adc')]
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def _array(self, key):
+        # key as an array that is only read where it is sliced: sources with a lazy(key) method give
+        # e.g. an h5py dataset, the others' arrays are already mapped (or were read by np.load)
+        lazy = getattr(self.file, 'lazy', None)
+        return self.file[key] if lazy is None else lazy(key)
+
+    def n_samples(self):
+        # samples per channel (per segment for rapid block traces)
+        if self.raw:
+            return self._adc().shape[-1]
+        return self._array('Ch' + self.channels[0] + '_mV').shape[-1]
+
+    def time_axis(self, start=0, stop=None):
+        # Times in ns of samples start..stop-1, stop defaults to the end of the trace
+        if not self.implicit_time:
+            return self._array('time_ns')[start:stop]
+        if stop is None:
+            stop = self.n_samples()
+        return time_axis(float(self.file['t0_ns']), float(self.file['dt_ns']), start, stop)
+
+    def _adc(self):
+        if self.adc is not None:
+            return self.adc
+        adc = self._array('adc')
+        # mapped counts are mapped again for every read instead of kept, a map holds its file open
+        # and thousands of open traces would run out of file handles
+        if not isinstance(adc, np.memmap):
+            self.adc = adc
+        return adc
+
+    def channel(self, name, start=0, stop=None):
+        # mV of samples start..stop-1 of channel name (of every segment for rapid block traces).
+        # Only those samples are read and converted, so a long trace can be processed in chunks
+        if not self.raw:
+            # a copy, not a view that would keep a mapped file open
+            return np.array(self._array('Ch' + name + '_mV')[..., start:stop])
+        i = self.channels.index(name)
+        return np.asarray(self._adc()[..., i, start:stop]*(self.range_mV[i]/self.maxADC) - self.offset_mV[i])
+
+    def window(self, start_ns, stop_ns, channels=None):
+        # The samples from start_ns up to stop_ns (relative to the trigger), clipped to the record.
+        # Returns their times in ns and their mV as a (channels x samples) array, (segments x channels x samples)
+        # for rapid block traces. channels: names, all channels by default
+        channels = self.channels if channels is None else channels
+        t0_ns, t1_ns = self.time_axis(0, 2)
+        n = self.n_samples()
+        start = min(max(int(np.ceil((start_ns - t0_ns)/(t1_ns - t0_ns))), 0), n)
+        stop = min(max(int(np.ceil((stop_ns - t0_ns)/(t1_ns - t0_ns))), start), n)
+        return self.time_axis(start, stop), np.stack([self.channel(name, start, stop) for name in channels], axis=-2)
+
+    def __getitem__(self, key):
+        if key == 'time_ns' and self.implicit_time:
+            return self.time_axis()
+        if not self.raw or key not in self.keys() or key in self.file.files:
+            return self.file[key]
+        return self.channel(key[2:-3])
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_stream(path, chunk_samples=2**20):
+    # Read a stream_5000a recording chunk by chunk, without loading the whole file. The file is mapped and
+    # each chunk of chunk_samples samples per channel is converted to a (channels x samples) mV array.
+    # The channels, sample_interval_ns etc. are in the recording's json file (path + '.json')
+    with open(path + '.json') as f:
+        metadata = json.load(f)
+    n_channels = len(metadata['channels'])
+    scale = np.array(metadata['range_mV'], dtype=float)[:, None]/metadata['maxADC']
+    offset = np.array(metadata.get('offset_mV', [0.0]*n_channels))[:, None]
+    counts = np.memmap(path, dtype=np.int16, mode='r')
+    counts = counts[:len(counts) - len(counts) % n_channels].reshape(-1, n_channels)
+    for start in range(0, len(counts), chunk_samples):
+        yield counts[start:start + chunk_samples].T*scale - offset
+
+
+def load_trace(path):
+    # Open a trace saved by the picoscope server, see Trace. Memory-mapped traces
+    # ('mmap' storage) are mapped rather than read, see mmap_trace.py
+    from mmap_trace import is_mmap_trace, open_mmap_trace
+    if is_mmap_trace(path):
+        return open_mmap_trace(path)
+    return Trace(path)
@@ -0,0 +1,208 @@
+# Model-agnostic interface to the picoscope drivers
+#
+# The server talks to every scope through one of these backends, so the acquisition code doesn't
+# depend on the model or on the picosdk naming (ps5000aRunBlock vs ps3000aRunBlock, PS5000A_10V vs
+# PS3000A_10V, ...). Each method wraps one SDK call and returns its PICO_STATUS, plus any outputs the
+# SDK returns through pointers, e.g.
+#   status, maxADC = driver.maximum_value(handle)
+# Enum arguments are passed by their name without the model prefix: channels 'A'..'D' or 'EXTERNAL',
+# couplings 'DC'/'AC', threshold directions 'RISING', 'BELOW', ..., ratio modes 'NONE'/'AVERAGE'.
+# Ranges are PS5000A_RANGE / PS3000A_RANGE values, i.e. indices into picoscope_data.CHANNEL_RANGES_MV,
+# which are the same for both models.
+#
+#   Ps5000aDriver, Ps3000aDriver: the real scopes, through the picosdk ctypes wrappers
+#   picoscope_simulator.SimulatedDriver: a simulated scope with the same interface, for running the
+#       server and benchmarks without hardware
+#
+# picosdk is only imported when a real backend is created, since importing it loads the driver library
+
+import ctypes
+
+import numpy as np
+
+
+class PicoSDKDriver:
+    # Calls shared by the 5000a and 3000a. Subclasses set model, sdk (the picosdk module) and prefix
+    # (ps5000a / ps3000a) and override the calls whose arguments differ between the two
+    model = None
+
+    def _call(self, name, *args):
+        return getattr(self.sdk, self.prefix + name)(*args)
+
+    def _enum(self, table, name):
+        # e.g. _enum('CHANNEL', 'CHANNEL_A') -> ps5.PS5000A_CHANNEL["PS5000A_CHANNEL_A"]
+        upper = self.prefix.upper()
+        return getattr(self.sdk, upper + '_' + table)[upper + '_' + name]
+
+    def block_ready(self, function):
+        # Wrap function(handle, status, pParameter) as the lpReady callback of run_block.
+        # Keep the returned object alive while the capture is armed
+        return self.sdk.BlockReadyType(function)
+
+    def streaming_ready(self, function):
+        # Wrap function(handle, noOfSamples, startIndex, overflow, triggerAt, triggered, autoStop, pParameter)
+        # as the callback of get_streaming_latest_values
+        return self.sdk.StreamingReadyType(function)
+
+    def enumerate_units(self):
+        # Returns the status and the serial numbers of the attached scopes of this model that aren't open.
+        # The status is PICO_NOT_FOUND when there are none
+        count = ctypes.c_int16()
+        serials = ctypes.create_string_buffer(256)
+        serialLth = ctypes.c_int16(len(serials))
+        status = self._call('EnumerateUnits', ctypes.byref(count), serials, ctypes.byref(serialLth))
+        return status, [serial for serial in serials.value.decode().split(',') if serial]
+
+    def change_power_source(self, handle, power_status):
+        return self._call('ChangePowerSource', handle, power_status)
+
+    def close_unit(self, handle):
+        return self._call('CloseUnit', handle)
+
+    def ping_unit(self, handle):
+        return self._call('PingUnit', handle)
+
+    def maximum_value(self, handle):
+        # max ADC count. This only changes with the device resolution
+        maxADC = ctypes.c_int16()
+        status = self._call('MaximumValue', handle, ctypes.byref(maxADC))
+        return status, maxADC.value
+
+    def set_channel(self, handle, name, enabled, coupling, range, offset_V):
+        return self._call('SetChannel', handle, self._enum('CHANNEL', 'CHANNEL_' + name), int(enabled), self._enum('COUPLING', coupling), range, offset_V)
+
+    def set_simple_trigger(self, handle, enabled, source, threshold, direction, delay, autoTrigger_ms):
+        if source != 'EXTERNAL':
+            source = 'CHANNEL_' + source
+        return self._call('SetSimpleTrigger', handle, int(enabled), self._enum('CHANNEL', source), threshold, self._enum('THRESHOLD_DIRECTION', direction), delay, autoTrigger_ms)
+
+    def memory_segments(self, handle, n_segments):
+        # returns the status and the number of samples available in each segment
+        maxSegmentSamples = ctypes.c_int32()
+        status = self._call('MemorySegments', handle, n_segments, ctypes.byref(maxSegmentSamples))
+        return status, maxSegmentSamples.value
+
+    def set_no_of_captures(self, handle, n_captures):
+        return self._call('SetNoOfCaptures', handle, n_captures)
+
+    def set_data_buffer(self, handle, name, buffer, segment=0, ratio_mode='NONE'):
+        # Point the driver at buffer, a C contiguous int16 array it writes channel name into.
+        # The driver keeps the pointer, so buffer must stay alive and in place until it is replaced
+        pointer = buffer.ctypes.data_as(ctypes.POINTER(ctypes.c_int16))
+        return self._call('SetDataBuffer', handle, self._enum('CHANNEL', 'CHANNEL_' + name), pointer, buffer.size, segment, self._enum('RATIO_MODE', 'RATIO_MODE_' + ratio_mode))
+
+    def get_values(self, handle, n_samples, ratio=0, ratio_mode='NONE', segment=0):
+        # Transfer one block into the buffers given to set_data_buffer.
+        # Returns the status, the number of samples transferred and the overflow flags
+        cSamples = ctypes.c_uint32(n_samples)
+        overflow = ctypes.c_int16()
+        status = self._call('GetValues', handle, 0, ctypes.byref(cSamples), ratio, self._enum('RATIO_MODE', 'RATIO_MODE_' + ratio_mode), segment, ctypes.byref(overflow))
+        return status, cSamples.value, overflow.value
+
+    def get_values_bulk(self, handle, n_samples, from_segment, to_segment):
+        # Transfer segments from_segment..to_segment of a rapid block capture in one call.
+        # Returns the status, the number of samples per segment and an overflow flag per segment
+        cSamples = ctypes.c_uint32(n_samples)
+        overflow = (ctypes.c_int16 * (to_segment - from_segment + 1))()
+        status = self._call('GetValuesBulk', handle, ctypes.byref(cSamples), from_segment, to_segment, 0, 0, ctypes.byref(overflow))
+        return status, cSamples.value, np.array(overflow)
+
+    def get_trigger_time_offsets_bulk(self, handle, from_segment, to_segment):
+        # Trigger time offset of each segment in ns. The driver returns them in units given per segment
+        # by PS5000A_TIME_UNITS (FS=0 ... S=5)
+        n = to_segment - from_segment + 1
+        offsets = (ctypes.c_int64 * n)()
+        units = (ctypes.c_int32 * n)()
+        status = self._call('GetValuesTriggerTimeOffsetBulk64', handle, ctypes.byref(offsets), ctypes.byref(units), from_segment, to_segment)
+        return status, np.array(offsets, dtype=float) * 10.0**(3*(np.array(units) - 2))
+
+    def run_streaming(self, handle, sample_interval_ns, pre_trigger, post_trigger, autostop, ratio, ratio_mode, overview_size):
+        # Returns the status and the sample interval in ns the driver actually uses
+        sampleInterval = ctypes.c_int32(int(sample_interval_ns))
+        status = self._call('RunStreaming', handle, ctypes.byref(sampleInterval), self._enum('TIME_UNITS', 'NS'), pre_trigger, post_trigger, autostop, ratio, self._enum('RATIO_MODE', 'RATIO_MODE_' + ratio_mode), overview_size)
+        return status, sampleInterval.value
+
+    def get_streaming_latest_values(self, handle, callback):
+        return self._call('GetStreamingLatestValues', handle, callback, None)
+
+    def stop(self, handle):
+        return self._call('Stop', handle)
+
+
+class Ps5000aDriver(PicoSDKDriver):
+    model = '5000a'
+
+    def __init__(self):
+        from picosdk.ps5000a import ps5000a
+        self.sdk = ps5000a
+        self.prefix = 'ps5000a'
+
+    def open_unit(self, serial_no, bits):
+        # Returns the status and the handle used by every other call
+        chandle = ctypes.c_int16()
+        cserial_no = ctypes.create_string_buffer(bytes(serial_no, encoding='utf-8'))
+        status = self.sdk.ps5000aOpenUnit(ctypes.byref(chandle), cserial_no, self._enum('DEVICE_RESOLUTION', f'DR_{bits}BIT'))
+        return status, chandle
+
+    def set_resolution(self, handle, bits):
+        return self.sdk.ps5000aSetDeviceResolution(handle, self._enum('DEVICE_RESOLUTION', f'DR_{bits}BIT'))
+
+    def get_timebase(self, handle, timebase, n_samples, segment=0):
+        # Returns the status, the sample interval in ns and the max samples of the timebase
+        timeIntervalns = ctypes.c_float()
+        returnedMaxSamples = ctypes.c_int32()
+        status = self.sdk.ps5000aGetTimebase2(handle, timebase, n_samples, ctypes.byref(timeIntervalns), ctypes.byref(returnedMaxSamples), segment)
+        return status, timeIntervalns.value, returnedMaxSamples.value
+
+    def run_block(self, handle, pre_trigger, post_trigger, timebase, segment, lpReady):
+        # handle, pre and post trigger samples, timebase, timeIndisposedMs, segment index, lpReady, pParameter
+        return self.sdk.ps5000aRunBlock(handle, pre_trigger, post_trigger, timebase, None, segment, lpReady, None)
+
+
+class Ps3000aDriver(PicoSDKDriver):
+    model = '3000a'
+
+    def __init__(self):
+        from picosdk.ps3000a import ps3000a
+        self.sdk = ps3000a
+        self.prefix = 'ps3000a'
+
+    def open_unit(self, serial_no, bits):
+        # the 3000a always samples at 8 bit, bits is ignored
+        chandle = ctypes.c_int16()
+        cserial_no = ctypes.create_string_buffer(bytes(serial_no, encoding='utf-8'))
+        status = self.sdk.ps3000aOpenUnit(ctypes.byref(chandle), cserial_no)
+        return status, chandle
+
+    def block_ready(self, function):
+        # picosdk's ps3000a module has no BlockReadyType (only StreamingReadyType), so the type of the
+        # ps3000aBlockReady callback, void (*)(int16_t handle, PICO_STATUS status, void *pParameter), is built
+        # here the same way ps5000a.BlockReadyType is
+        from picosdk.ctypes_wrapper import C_CALLBACK_FUNCTION_FACTORY
+        return C_CALLBACK_FUNCTION_FACTORY(None, ctypes.c_int16, ctypes.c_uint32, ctypes.c_void_p)(function)
+
+    def get_timebase(self, handle, timebase, n_samples, segment=0):
+        # handle, timebase, noSamples, timeIntervalNanoseconds, oversample, maxSamples, segmentIndex - page 48 of ps3000a programmer's guide
+        timeIntervalns = ctypes.c_float()
+        returnedMaxSamples = ctypes.c_int32()
+        status = self.sdk.ps3000aGetTimebase2(handle, timebase, n_samples, ctypes.byref(timeIntervalns), 1, ctypes.byref(returnedMaxSamples), segment)
+        return status, timeIntervalns.value, returnedMaxSamples.value
+
+    def run_block(self, handle, pre_trigger, post_trigger, timebase, segment, lpReady):
+        # handle, pre and post trigger samples, timebase, oversample, timeIndisposedMs, segment index, lpReady, pParameter
+        # page 75 of ps3000a programmer's guide
+        return self.sdk.ps3000aRunBlock(handle, pre_trigger, post_trigger, timebase, 1, None, segment, lpReady, None)
+
+
+DRIVERS = {'5000a': Ps5000aDriver, '3000a': Ps3000aDriver}
+
+
+def make_driver(model, simulated=None):
+    # Backend for a model. simulated is None for the real scope, or a dict of
+    # picoscope_simulator.SimulatedDriver options to get a simulated one
+    if model not in DRIVERS:
+        raise ValueError(f'unknown picoscope model {model}, use one of {list(DRIVERS)}')
+    if simulated is not None:
+        from picoscope_simulator import SimulatedDriver
+        return SimulatedDriver(model, **simulated)
+    return DRIVERS[model]()
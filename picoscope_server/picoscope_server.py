@@ -1,468 +1,1299 @@
 # this is in python2
 
-from labrad.server import ThreadedServer, Signal, setting, LabradServer, inlineCallbacks
-
-import ctypes
+from labrad.server import ThreadedServer, Signal, setting
+from twisted.internet import reactor
+
+import collections
+import copy
+import os
+import threading
+import time
+import json
 import numpy as np
-from picosdk.ps5000a import ps5000a as ps5
-from picosdk.ps3000a import ps3000a as ps3
-import matplotlib.pyplot as plt
-from picosdk.functions import adc2mV, assert_pico_ok, mV2adc
-import h5py
+from picosdk.functions import assert_pico_ok
+from picosdk.constants import PICO_STATUS
+
+from stream_buffer import StreamRingBuffer
+from trace_writer import TraceWriter, npz_path, write_npz
+from run_file import RunFile
+from mmap_trace import HEADER_SIZE, create_mmap_trace, finish_mmap_trace
+from reductions import check_reductions, reduce_trace
+from psd_accumulator import WelchAccumulator, resume
+from decimation import Decimator, decimate
+from picoscope_data import CHANNEL_RANGES_MV, adc_to_mV, envelope, pack_raw
+from picoscope_driver import make_driver
+from timebase import TIMEBASES, max_channels, solve_timebase
 
 # uses example code from https://github.com/picotech/picosdk-python-wrappers/blob/master/ps5000aExamples/ps5000aBlockExample.py
 # and https://github.com/picotech/picosdk-python-wrappers/blob/master/ps3000aExamples/ps3000aBlockExample.py
 # combined with Will Milner's picoscope_labrad_server.py code
 
+# statuses meaning the handle is no longer usable and the scope has to be reopened
+DEVICE_LOST_STATUS = (PICO_STATUS["PICO_NOT_FOUND"], PICO_STATUS["PICO_NOT_RESPONDING"], PICO_STATUS["PICO_INVALID_HANDLE"])
+
+# number of shots saved without the background writer that save_status remembers, like TraceWriter's history
+SAVED_HISTORY = 10000
+
+# PS5000A_10V / PS3000A_10V, the range the external trigger threshold is converted with
+TRIGGER_RANGE = 9
+
 class PicoscopeServer(ThreadedServer):
     name = '%LABRADNODE%_picoscope'
-    update = Signal(698461, 'signal: update', 's') #?
+    # json preview of every capture for monitoring clients, see _publish_preview
+    update = Signal(698461, 'signal: update', 's')
 
     def initServer(self):
-        # Create chandle and self.status ready for use
-        self.chandle = ctypes.c_int16()
-        self.status = {}
+        self.mV_dtype = np.float64 # dtype of the saved mV traces, see set_float32
+        self.storage = 'mV' # file format of saved traces, see set_storage_format
+        self.capture_timeout = 0 # s to wait for a trigger before giving up, 0 waits indefinitely (see set_capture_timeout)
+        self.preview_points = 1000 # points per channel of the previews sent with the update signal, 0 for none (see set_preview_points)
+
+        # acquisition settings are kept per LabRAD context (see initContext). Calls made without
+        # one (c=None, e.g. from the benchmarks) share default_context
+        self.default_context = {}
+        self.initContext(self.default_context)
+
+        # preallocated arrays reused from shot to shot (see _buffer), keyed by name. Each device has its own
+        # pool for the arrays its captures use, this one is for the background writer thread
+        self.buffer_pool = {}
+
+        # background file writer, None to save inline (see set_async_save). Each device rotates through
+        # save_slots copies of the counts handed to the writer, see _save_trace
+        self.writer = None
+        self.save_slots = 0
+        self.run = None # HDF5 RunFile shots are appended to instead of .npz files, see open_run
+        # where the shots saved without the writer went, path -> file written ('mmap' traces, .npz files) or run
+        # file appended to, for save_status / wait_for_save. The last SAVED_HISTORY shots are kept
+        self.saved = collections.OrderedDict()
+        self.saved_lock = threading.Lock()
+
+        # driver backend of each model (picoscope_driver.py), created on first use. self.simulated is None
+        # for the real scopes, or the options of the simulated scopes selected with set_simulated
+        self.drivers = {}
+        self.simulated = None
+
+        # open scopes, keyed by serial number. Opening a scope over USB takes hundreds of ms,
+        # so each scope is opened on first use and kept open for the life of the server.
+        # Each entry looks like
+        #   {'model': '5000a', 'serial_no': ..., 'driver': backend, 'chandle': handle, 'maxADC': int, 'applied': {},
+        #    'status': {}, 'buffers': {}, ...}
+        # where 'applied' holds the channel/trigger/timebase settings last sent to that device,
+        # so get_data only re-sends settings that actually changed, 'status' the last PICO_STATUS of
+        # each SDK call (see get_status) and 'buffers' the device's pool of shot buffers
+        self.devices = {}
+
+        # block captures armed with arm_block, by job id, until they are fetched. Each holds what
+        # _finish_block needs, and its device has 'job' set to the id so nothing else uses the scope meanwhile
+        self.jobs = {}
+        self.next_job = 1
+
+        # running PSDs (psd_accumulator.py) fed with every block and rapid block capture of a scope, by serial
+        # number, see start_psd. Each holds the channel, options and checkpoint given to start_psd and the
+        # WelchAccumulator, created at the first capture once the sample rate is known
+        self.psds = {}
+
+        # one lock per serial number, held for the whole of a capture, so two clients (or get_data_parallel)
+        # can't interleave calls on the same scope while captures on different scopes run in parallel.
+        # devices_lock only guards creating the locks, see _device_lock
+        self.device_locks = {}
+        self.devices_lock = threading.Lock()
+
+    def initContext(self, c):
+        # Each client context has its own acquisition config, so one experiment changing the record length,
+        # channels or resolution doesn't change them for another. c['config'] is the one get_data uses,
+        # c['presets'] holds named copies of it (save_preset / use_preset)
+        c['config'] = {
+            'name': '', # preset the config was saved as or loaded from
+            'bits': 14, # 5000a resolution, see set_resolution_5000a
+            'averaging': 1, # 3000a hardware averaging ratio, see set_recordduration_3000a
+            'decimation': 1, # ratio of the software decimation after the transfer, see set_decimation
+            'passband': 0.8, # its passband as a fraction of the decimated Nyquist frequency
+            # input settings of channels A-D on either model, changed with set_channel.
+            # range is a PS5000A_RANGE / PS3000A_RANGE value (index into CHANNEL_RANGES_MV), offset is in V
+            'channels': {name: {'enabled': True, 'range': 9, 'coupling': 'DC', 'offset': 0.0} for name in 'ABCD'},
+            # samples and sample interval in s, from set_recordduration_*
+            'preTriggerSamples': None,
+            'postTriggerSamples': None,
+            'maxSamples': None,
+            'sample_interval': None,
+        }
+        c['presets'] = {}
+
+    def _context(self, c):
+        return self.default_context if c is None else c
+
+    def _config(self, c):
+        # the acquisition config in use in context c
+        return self._context(c)['config']
+
+    def stopServer(self):
+        for serial_no in list(self.devices):
+            self._close_device(serial_no)
+        if self.writer is not None:
+            self.writer.close()
+        if self.run is not None:
+            self.run.close()
+
+    def _driver(self, model):
+        # Backend for model, real or simulated depending on set_simulated
+        if model not in self.drivers:
+            self.drivers[model] = make_driver(model, self.simulated)
+        return self.drivers[model]
+
+    def _bits(self, model, config):
+        # resolution a model samples at. The 3000a is always 8 bit
+        return config['bits'] if model == '5000a' else 8
+
+    def _open_device(self, serial_no, model, bits):
+        # Open a 5000a or 3000a series PicoScope at resolution bits and return a new entry for self.devices
+        driver = self._driver(model)
+
+        # Returns handle to chandle for use in future API functions
+        status = {}
+        status["openunit"], chandle = driver.open_unit(serial_no, bits)
+
+        try:
+            assert_pico_ok(status["openunit"])
+        except: # PicoNotOkError:
+
+            powerStatus = status["openunit"]
+
+            if powerStatus == 286 or powerStatus == 282:
+                status["changePowerSource"] = driver.change_power_source(chandle, powerStatus)
+            else:
+                raise
+
+            assert_pico_ok(status["changePowerSource"])
+
+        device = {'model': model, 'serial_no': serial_no, 'driver': driver, 'chandle': chandle, 'maxADC': None, 'applied': {}, 'status': status, 'buffers': {}}
+        device['save_jobs'] = [None]*self.save_slots
+        device['save_slot'] = 0
+        # derived settings that stay valid while the scope is open, so switching between a few configs
+        # (use_preset) doesn't repeat the SDK queries: GetTimebase2 results by timebase settings and
+        # MaximumValue by resolution, see _timebase and _read_max_adc
+        device['timebases'] = {}
+        device['maxADCs'] = {}
+
+        # block-ready callback passed to RunBlock as lpReady. The driver calls it from its own thread
+        # once the capture is complete, and it wakes up whoever is waiting in _wait_for_block.
+        # The ctypes function object is kept on the device so it isn't garbage collected while armed
+        device['ready'] = threading.Event()
+        device['cancelled'] = False
+        def block_ready(handle, status, pParameter):
+            device['blockStatus'] = status
+            device['ready'].set()
+        device['lpReady'] = driver.block_ready(block_ready)
+
+        if model == '5000a':
+            device['applied']['resolution'] = bits
+        self._read_max_adc(device)
+
+        print(f'opened picoscope {model} {serial_no}')
+        return device
+
+    def _read_max_adc(self, device):
+        # find maximum ADC count value. This only changes with the device resolution, so it is only read once for each
+        resolution = device['applied'].get('resolution')
+        if resolution not in device['maxADCs']:
+            status, device['maxADCs'][resolution] = device['driver'].maximum_value(device['chandle'])
+            self._check(device, "maximumValue", status)
+        device['maxADC'] = device['maxADCs'][resolution]
+
+    def _get_device(self, serial_no, model, config):
+        # Return the open device for serial_no, opening it if needed.
+        # A cached handle is pinged first (one cheap USB round trip) so that a scope that was
+        # unplugged or power cycled since the last shot is transparently reopened.
+        # Also starts the stage timings of the shot (see _lap and get_timings) with the time this took as 'open'
+        start = time.perf_counter()
+        device = self.devices.get(serial_no)
+        if device is not None and device.get('job') is not None:
+            raise ValueError(f'picoscope {serial_no} is armed by job {device["job"]}, fetch_block it first')
+        if device is not None:
+            device['status']["ping"] = device['driver'].ping_unit(device['chandle'])
+            if device['status']["ping"] != PICO_STATUS["PICO_OK"] or device['model'] != model:
+                print(f'picoscope {serial_no} is not responding (status {device["status"]["ping"]}), reopening')
+                self._close_device(serial_no)
+                device = None
+
+        if device is None:
+            device = self._open_device(serial_no, model, self._bits(model, config))
+            self.devices[serial_no] = device
+        device['timings'] = {}
+        device['lap'] = start
+        self._lap(device, 'open')
+        return device
+
+    def _lap(self, device, stage):
+        # Add the time since the previous lap to stage in device['timings'], e.g. 'setup' or 'transfer'
+        now = time.perf_counter()
+        device['timings'][stage] = device['timings'].get(stage, 0) + now - device['lap']
+        device['lap'] = now
+
+    def _close_device(self, serial_no):
+        # Close unit Disconnect the scope. Errors are ignored since the device may already be gone
+        device = self.devices.pop(serial_no, None)
+        if device is None:
+            return
+        device['status']["close"] = device['driver'].close_unit(device['chandle'])
+
+    def _enabled_channels(self, model, config):
+        # Names of the enabled channels, checked against what the model supports at the config's resolution
+        bits = self._bits(model, config)
+        names = [name for name in 'ABCD' if config['channels'][name]['enabled']]
+        if not names:
+            raise ValueError('no channels enabled, turn one on with set_channel')
+        if len(names) > max_channels(model, bits):
+            raise ValueError(f'a {model} at {bits} bit can only use {max_channels(model, bits)} channels, {len(names)} are enabled')
+        return names
+
+    def _set_channels(self, device, config, names):
+        # Send the settings of the channels in names to the device, skipping those it already has
+        applied = device['applied']
+        for name in names:
+            channel = config['channels'][name]
+            channel_settings = (channel['enabled'], channel['coupling'], channel['range'], channel['offset'])
+            if applied.get('ch' + name) != channel_settings:
+                self._check(device, "setCh" + name, device['driver'].set_channel(device['chandle'], name, *channel_settings))
+                applied['ch' + name] = channel_settings
+
+    def _configure(self, device, config, n_segments=1):
+        # Send the resolution, segment, channel and trigger settings of config to the device, skipping
+        # any that it already has. Returns the enabled channel names and their ranges
+        # Inputs:
+        #   device: entry of self.devices
+        #   config: acquisition config of the calling context, see initContext
+        #   n_segments: number of memory segments / captures per RunBlock, 1 for a normal block capture
+        driver = device['driver']
+        chandle = device['chandle']
+        applied = device['applied']
+        names = self._enabled_channels(device['model'], config)
+
+        # Change the 5000a resolution if set_resolution_5000a asked for a different one.
+        # The device refuses a resolution that doesn't allow the channels that are currently on,
+        # so channels are turned off before and on after the resolution change
+        self._set_channels(device, config, [name for name in 'ABCD' if name not in names])
+        if device['model'] == '5000a' and applied.get('resolution') != config['bits']:
+            self._check(device, "setResolution", driver.set_resolution(chandle, config['bits']))
+            applied['resolution'] = config['bits']
+            applied.pop('segmentSamples', None) # the memory per segment depends on the resolution
+            self._read_max_adc(device)
+        self._set_channels(device, config, names)
+
+        # Split the capture memory into n_segments and capture one block into each (rapid block mode).
+        # A freshly opened scope has 1 segment and 1 capture
+        if applied.get('segments', 1) != n_segments:
+            status, maxSegmentSamples = driver.memory_segments(chandle, n_segments)
+            self._check(device, "memorySegments", status)
+            applied['segments'] = n_segments
+            applied['segmentSamples'] = maxSegmentSamples
+            applied.pop('buffers', None)
+        if applied.get('captures', 1) != n_segments:
+            self._check(device, "setNoOfCaptures", driver.set_no_of_captures(chandle, n_segments))
+            applied['captures'] = n_segments
+
+        # Set up single trigger on the external input
+        # 500mV threshold for trigger, in counts of the 10 V range like picosdk.functions.mV2adc(500, PS5000A_10V, maxADC).
+        # The EXT input doesn't use the channel ranges, so this stays fixed whatever set_channel does to channel A
+        # direction: the 5000a code always passed 1 here (PS5000A_BELOW), kept so its triggering doesn't change
+        threshold = int(500 * device['maxADC'] / CHANNEL_RANGES_MV[TRIGGER_RANGE])
+        direction = 'BELOW' if device['model'] == '5000a' else 'RISING'
+        delay = 0 # s
+        autoTrigger_ms = 0 # 0 means device will wait indefinitely for a trigger - see page 115 of ps5000a / page 105 of ps3000a programmer's guide
+        trigger_settings = (1, 'EXTERNAL', threshold, direction, delay, autoTrigger_ms) # (enable, source, threshold, direction, delay, autoTrigger_ms)
+        if applied.get('trigger') != trigger_settings:
+            self._check(device, "trigger", driver.set_simple_trigger(chandle, *trigger_settings))
+            applied['trigger'] = trigger_settings
+
+        return names, [config['channels'][name]['range'] for name in names]
+
+    def _timebase(self, device, config, names, n_segments=1):
+        # Pick the timebase for the sample interval asked for in set_recordduration_*, check it and
+        # the config's maxSamples against the device, and leave the timebase in device['timebase'] and the
+        # sample interval in device['timeIntervalns']. Call after _configure
+        # Inputs:
+        #   config: acquisition config, see _configure
+        #   names: enabled channels, from _configure
+        #   n_segments: number of memory segments, see _configure
+        applied = device['applied']
+        if config['maxSamples'] is None:
+            raise ValueError('no record length set, call set_recordduration_5000a / set_recordduration_3000a first')
+        # samples per segment from memory_segments, only known once the memory has been split
+        if config['maxSamples'] > applied.get('segmentSamples', config['maxSamples']):
+            raise ValueError(f'{config["maxSamples"]} samples per capture don\'t fit in the {applied["segmentSamples"]} samples of each of the {n_segments} memory segments, shorten the record or capture fewer segments')
+
+        # The timebase formula depends on the model, resolution and number of enabled channels (see timebase.py).
+        # GetTimebase2 has the final say, since some models/firmware are slower than the table. The result only
+        # depends on the timebase, sample count, segments and channel setup, so the result for each of those is
+        # cached and only queried the first time. GetTimebase2 also fails if maxSamples doesn't fit in a segment,
+        # which is checked above with a clearer message when the segment size is known
+        timebase, interval = solve_timebase(device['model'], self._bits(device['model'], config), len(names), config['sample_interval'])
+        timebase_settings = (timebase, config['maxSamples'], n_segments, applied.get('resolution')) + tuple(applied['ch' + name] for name in 'ABCD')
+        if timebase_settings not in device['timebases']:
+            # if the device rejects the timebase, step to the next slower ones before giving up
+            for n in range(timebase, timebase + 4):
+                status, timeIntervalns, returnedMaxSamples = device['driver'].get_timebase(device['chandle'], n, config['maxSamples'], 0)
+                if status != PICO_STATUS["PICO_INVALID_TIMEBASE"]:
+                    break
+            self._check(device, "getTimebase2", status)
+            if n != timebase or abs(timeIntervalns - interval*1e9) > 1e-3*interval*1e9:
+                print(f'picoscope {device["serial_no"]}: timebase {timebase} ({interval*1e9:g} ns) not available, using {n} ({timeIntervalns:g} ns)')
+            device['timebases'][timebase_settings] = (n, timeIntervalns)
+
+        device['timebase'], device['timeIntervalns'] = device['timebases'][timebase_settings]
+
+    def _device_lock(self, serial_no):
+        # The lock of the scope serial_no, see self.device_locks. It outlives reopening the scope
+        with self.devices_lock:
+            return self.device_locks.setdefault(serial_no, threading.RLock())
+
+    def _block_buffer_name(self, model, config):
+        # Pool name of the block capture buffer of a config. Each preset gets its own, so switching
+        # between presets doesn't reallocate them
+        return f"block_{model}_{config['name']}"
+
+    def _buffer(self, name, shape, dtype=np.int16, device=None):
+        # Return the preallocated array called name from the device's pool (self.buffer_pool without one),
+        # only allocating a new one when the shape or dtype changed. Keeps large allocations out of the
+        # steady-state shot loop. Scopes capturing in parallel each fill their own buffers
+        pool = self.buffer_pool if device is None else device['buffers']
+        buffer = pool.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = np.zeros(shape, dtype=dtype)
+            pool[name] = buffer
+        return buffer
+
+    def _register_buffers(self, device, buffers, names, ratio_mode='NONE', segment=0):
+        # Point the driver at the rows of a (channels x samples) int16 array with SetDataBuffer, so data
+        # is transferred straight into it. The driver keeps these pointers between captures, so this is
+        # skipped when the device already has the same buffers for this segment
+        # Inputs:
+        #   buffers: C contiguous (channels x samples) int16 array, e.g. from _buffer
+        #   names: channel of each row of buffers
+        #   ratio_mode: downsampling ratio mode the data will be fetched with, 'NONE' or 'AVERAGE'
+        #   segment: memory segment the buffers are for
+        registered = device['applied'].setdefault('buffers', {})
+        key = (buffers.ctypes.data, buffers.shape, tuple(names), ratio_mode)
+        if registered.get(segment) == key:
+            return
+        for i, name in enumerate(names):
+            # handle, source, buffer, segment index, ratio mode
+            self._check(device, "setDataBuffer" + name, device['driver'].set_data_buffer(device['chandle'], name, buffers[i], segment, ratio_mode))
+        registered[segment] = key
+
+    def _arm_block(self, device):
+        # reset the block-ready event. Call this right before RunBlock
+        device['cancelled'] = False
+        device['blockStatus'] = None
+        device['ready'].clear()
+
+    def _wait_for_block(self, device):
+        # Sleep until the driver calls lpReady (or the capture is cancelled / times out).
+        # This replaces polling IsReady in a loop, which kept one core at 100% for the whole
+        # trigger wait. The thread sleeps on an event, so other settings keep being served
+        timeout = self.capture_timeout if self.capture_timeout > 0 else None
+        done = device['ready'].wait(timeout)
+
+        if done and not device['cancelled']:
+            self._check(device, "blockReady", device['blockStatus'])
+            return
+
+        # abort the capture so the scope can be re-armed by the next shot
+        device['status']["stop"] = device['driver'].stop(device['chandle'])
+        if device['cancelled']:
+            raise RuntimeError(f'capture on picoscope {device["serial_no"]} was cancelled')
+        raise TimeoutError(f'picoscope {device["serial_no"]} got no trigger within {self.capture_timeout} s')
+
+    def _publish_preview(self, device, path, counts, names, chRanges, t0_ns, dt_ns):
+        # Send a min/max envelope of a capture (picoscope_data.envelope) with the update signal, so monitoring
+        # clients can draw each shot without reading the file. Skipped when nobody listens to the signal.
+        # The json message holds serial_no, model, path, channels, samples (of the full trace), t0_ns,
+        # dt_ns (between preview points) and min_mV / max_mV, a list per channel
+        # Inputs: see _save_trace, counts is (channels x samples)
+        if not self.preview_points or not self.update.listeners:
+            return
+        low, high, starts = envelope(counts, self.preview_points)
+        scale = np.array([CHANNEL_RANGES_MV[r] for r in chRanges])[:, None]/device['maxADC']
+        offset = np.array([device['applied']['ch' + name][3]*1e3 for name in names])[:, None]
+        preview = {
+            'serial_no': device['serial_no'],
+            'model': device['model'],
+            'path': path,
+            'channels': names,
+            'samples': counts.shape[-1],
+            't0_ns': t0_ns,
+            'dt_ns': dt_ns*counts.shape[-1]/len(starts),
+            'min_mV': np.round(low*scale - offset, 2).tolist(),
+            'max_mV': np.round(high*scale - offset, 2).tolist(),
+        }
+        # signals have to be sent from the reactor thread, captures run on the server's worker threads
+        reactor.callFromThread(self.update, json.dumps(preview))
+        self._lap(device, 'preview')
+
+    def _decimate(self, device, name, counts, config, t0_ns, dt_ns):
+        # Decimate a capture by config['decimation'] (decimation.py), chunk by chunk into a float32 buffer of the
+        # device's pool, so only the decimated samples are kept and saved. They stay in ADC count units, so the
+        # rest of the pipeline (reductions, previews, 'raw' and 'mV' storage) treats them like the int16 counts.
+        # Returns the decimated counts and their t0_ns and dt_ns: output sample k is at input sample
+        # k*ratio - delay, the filters' group delay
+        # Inputs: see _save_trace, name: buffer name
+        decimator = Decimator(config['decimation'], config['passband'])
+        out = self._buffer('decimated_' + name, counts.shape[:-1] + (-(-counts.shape[-1]//decimator.ratio),), np.float32, device)
+        decimate(counts, decimator, out=out)
+        self._lap(device, 'decimate')
+        return out, t0_ns - decimator.delay*dt_ns, decimator.ratio*dt_ns
+
+    def _accumulate_psd(self, device, counts, names, chRanges, dt_ns):
+        # Add a capture to the scope's running PSD if start_psd is on for it, each segment of a rapid block
+        # capture as a capture of its own. The checkpoint, if any, is rewritten after every capture
+        # Inputs: see _save_trace, counts is (channels x samples) or (segments x channels x samples)
+        psd = self.psds.get(device['serial_no'])
+        if psd is None:
+            return
+        if psd['channel'] not in names:
+            print(f'Picoscope {device["serial_no"]} PSD skipped: channel {psd["channel"]} is not enabled')
+            return
+        sample_rate = 1e9/dt_ns
+        if psd['accumulator'] is None:
+            psd['accumulator'] = resume(psd['checkpoint'], sample_rate, psd['nfft'], psd['overlap'], psd['window'])
+        accumulator = psd['accumulator']
+        if not np.isclose(accumulator.sample_rate, sample_rate):
+            print(f'Picoscope {device["serial_no"]} PSD skipped: capture at {sample_rate} Hz, the PSD is at {accumulator.sample_rate} Hz')
+            return
+        i = names.index(psd['channel'])
+        mV = counts[..., i, :]*(CHANNEL_RANGES_MV[chRanges[i]]/device['maxADC']) - device['applied']['ch' + psd['channel']][3]*1e3
+        for segment in mV.reshape(-1, mV.shape[-1]):
+            accumulator.add(segment)
+        if psd['checkpoint']:
+            accumulator.save(psd['checkpoint'])
+        self._lap(device, 'psd')
+
+    def _mmap_buffer(self, device, path, shape, names, chRanges, t0_ns, dt_ns, header_size=HEADER_SIZE):
+        # For 'mmap' storage: create the trace file at path and return its samples as a writable np.memmap
+        # of shape, to register with the driver in place of a pooled buffer (see mmap_trace.py).
+        # The header is written before the capture, so the file can be opened while it is being filled
+        offsets = [device['applied']['ch' + name][3] for name in names]
+        header = pack_raw(None, chRanges, device['maxADC'], offsets, t0_ns, dt_ns, names)
+        del header['adc']
+        header.update(serial_no=device['serial_no'], model=device['model'], time=time.time())
+        return create_mmap_trace(path, shape, header, header_size)
+
+    def _save_trace(self, device, path, counts, names, chRanges, t0_ns, dt_ns, extra=None):
+        # Save a capture in the format chosen with set_storage_format, see _pack_trace, as a .npz file
+        # or as a shot in the run file opened with open_run.
+        # Saved inline, or with set_async_save handed to the background writer so the setting returns
+        # as soon as the data is off the scope
+        # Inputs:
+        #   device: entry of self.devices the data came from
+        #   path: where to save the .npz file
+        #   counts: int16 ADC counts, (channels x samples) or (segments x channels x samples)
+        #   names: channel names, in the order of the channel axis of counts
+        #   chRanges: range of each channel
+        #   t0_ns, dt_ns: time of the first sample relative to the trigger, and the sample interval
+        #   extra: dict of any other arrays to save with the trace
+        maxADC = device['maxADC']
+        offsets = [device['applied']['ch' + name][3] for name in names]
+        storage = self.storage
+        dtype = self.mV_dtype
+        if self.run is not None:
+            attrs = {'serial_no': device['serial_no'], 'model': device['model'], 'time': time.time()}
+            write = lambda path, packed, run=self.run: run.append(path, packed, attrs)
+        elif self.writer is not None:
+            write = write_npz
+        else:
+            write = lambda path, packed: np.savez(path,**packed)
+
+        if self.writer is None:
+            packed = self._pack_trace(counts, names, chRanges, maxADC, offsets, t0_ns, dt_ns, storage, dtype, extra, device)
+            self._lap(device, 'convert')
+            write(path, packed)
+            self._lap(device, 'save')
+            self._record_saved(path, self.run.path if self.run is not None else npz_path(path))
+            return
+
+        # The shot buffers are reused by the next shot while the writer may still be working on this one,
+        # so the counts are copied into one of a few rotating buffers, and a buffer is only reused once the
+        # file that was made from it has been written. The conversion happens on the writer thread
+        slot = device['save_slot']
+        device['save_slot'] = (slot + 1) % len(device['save_jobs'])
+        if device['save_jobs'][slot] is not None:
+            device['save_jobs'][slot].done.wait()
+        snapshot = self._buffer(f'save{slot}', counts.shape, counts.dtype, device=device)
+        np.copyto(snapshot, counts)
+        device['save_jobs'][slot] = self.writer.submit(path, lambda: self._pack_trace(snapshot, names, chRanges, maxADC, offsets, t0_ns, dt_ns, storage, dtype, extra), write)
+        self._lap(device, 'queue')
+
+    def _record_saved(self, path, where):
+        # Remember that the shot for path was saved to where, see self.saved
+        with self.saved_lock:
+            self.saved.pop(path, None)
+            self.saved[path] = where
+            while len(self.saved) > SAVED_HISTORY:
+                self.saved.popitem(last=False)
+
+    def _pack_trace(self, counts, names, chRanges, maxADC, offsets, t0_ns, dt_ns, storage, dtype, extra, device=None):
+        # Build the arrays saved for a capture (see _save_trace for the inputs). The mV conversion goes into
+        # a buffer of the device's pool, or of the writer's when called on the writer thread (device None)
+        #   'mV': a ChX_mV float array per enabled channel, plus t0_ns and dt_ns
+        #   'raw': the int16 counts plus ranges, max ADC, offsets, t0 and dt (picoscope_data.pack_raw).
+        #          About 5x smaller and no conversion here, picoscope_data.load_trace converts on access
+        # The time axis is not saved, it is fully determined by t0_ns, dt_ns and the number of samples.
+        # picoscope_data.load_trace rebuilds it (trace['time_ns'] or trace.time_axis(start, stop))
+        if storage == 'raw':
+            packed = pack_raw(counts, chRanges, maxADC, offsets, t0_ns, dt_ns, names)
+        else:
+            # convert ADC counts data to mV, all channels in one go, into a reused buffer
+            data_mV = adc_to_mV(counts, chRanges, maxADC, dtype, channel_axis=counts.ndim - 2, out=self._buffer('mV', counts.shape, dtype, device))
+            # remove the analog offset of each channel, like load_trace does for raw files
+            if any(offsets):
+                data_mV -= (np.array(offsets, dtype=dtype)*1e3)[:, None]
+            packed = {"t0_ns": t0_ns, "dt_ns": dt_ns}
+            for i, name in enumerate(names):
+                packed["Ch" + name + "_mV"] = data_mV[..., i, :]
+        packed.update(extra or {})
+        return packed
+
+    def _check(self, device, key, status):
+        # Record the status of an SDK call and raise if it failed.
+        # If the device has dropped off the bus its session is discarded, so the next shot reopens it
+        device['status'][key] = status
+        if status in DEVICE_LOST_STATUS:
+            self._close_device(device['serial_no'])
+        assert_pico_ok(status)
 
     @setting(1)
     def set_recordduration_5000a(self,c,duration,presamples,postsamples):
-        # TODO: - add option to change device resolution. 4ch requires 14bit, 2ch can do 16
-        #       - add option to select number of channels without having to go in and edit the get_data method
+        # Resolution and channels are set with set_resolution_5000a and set_channel
         # Inputs:
         #   c: context varaible passed when the conductor accesses this labrad server. See https://github.com/PickyPointer/SrE/wiki/Labrad_Tools-overview for more details
         #   duration: record duration in s
         #   presamples: number of samples before external trigger
         #   postsamples: number of samples after external trigger
 
-        # timebase calculation from duration and # of samples
-        # See page 28 of picotech.com/download/manuals/picoscope-5000-series-a-api-programmers-guide.pdf
-        # 4 channels, 14-bit: (n-2)/125000000 s/sample
-        # 2 channels, 15-bit: (n-2)/125000000 s/sample
-        # 1 channels, 16-bit: (n-3)/62500000 s/sample
-        # where n is an integer used to specify the picoscope timebase
-                
-        self.resolution = ps5.PS5000A_DEVICE_RESOLUTION["PS5000A_DR_14BIT"]
-        self.preTriggerSamples = presamples # Set number of pre and post trigger samples to be collected
-        self.postTriggerSamples = postsamples
-        self.maxSamples = self.preTriggerSamples + self.postTriggerSamples
-        self.timebase = round(duration/self.maxSamples*125000000 + 2)
-    
-        print(f'\ndur={duration}s timebase={self.timebase} pre_trig_samples={presamples} post_trig_samples={postsamples}')
+        # The timebase for duration/samples is picked at capture time by _timebase, since it depends on the
+        # resolution and number of enabled channels. See timebase.py and page 28 of
+        # picotech.com/download/manuals/picoscope-5000-series-a-api-programmers-guide.pdf
+
+        config = self._config(c)
+        config['preTriggerSamples'] = presamples # Set number of pre and post trigger samples to be collected
+        config['postTriggerSamples'] = postsamples
+        config['maxSamples'] = presamples + postsamples
+        config['sample_interval'] = duration/config['maxSamples']
+
+        # allocate the (channels x samples) buffer get_data_5000a transfers into on each open scope, reused until the sample count changes
+        n_channels = sum(channel['enabled'] for channel in config['channels'].values())
+        for device in list(self.devices.values()):
+            if device['model'] == '5000a':
+                self._buffer(self._block_buffer_name('5000a', config), (n_channels, config['maxSamples']), device=device)
+
+        print(f'\ndur={duration}s sample_interval={config["sample_interval"]*1e9:g}ns pre_trig_samples={presamples} post_trig_samples={postsamples}')
     
     @setting(2)
-    def set_recordduration_3000a(self,c,duration,presamples,postsamples):
+    def set_recordduration_3000a(self,c,duration,presamples,postsamples,averaging=32):
         # Inputs:
             #   c: context varaible passed when the conductor accesses this labrad server. See https://github.com/PickyPointer/SrE/wiki/Labrad_Tools-overview for more details
             #   duration: record duration in s
             #   presamples: number of samples before external trigger
             #   postsamples: number of samples after external trigger
+            #   averaging: number of raw samples the scope averages into each saved sample, 1 turns averaging off
 
-        # timebase calculation from duration and # of samples
-        # See page 15 of picotech.com/download/manuals/picoscope-3000-series-a-api-programmers-guide.pdf
-        # 3000D series
-        # 4 channels, 8-bit: (n-2)/125000000 s/sample
-        # where n is an integer used to specify the picoscope timebase
+        # The timebase for duration/samples is picked at capture time by _timebase, see timebase.py and
+        # page 15 of picotech.com/download/manuals/picoscope-3000-series-a-api-programmers-guide.pdf
         # ps3000a doesn't have the option to set device resolution
 
         # picoscope can only sample at 8bits of resolution
         # we want to sample x32 more and then average back down to try to make up for the 7 less bits of resolution
+        # The averaging is done by the driver (PS3000A_RATIO_MODE_AVERAGE in get_data_3000a), so only the
+        # averaged samples are transferred over USB
 
 
-        self.preTriggerSamples = presamples*32 # Set number of pre and post trigger samples to be collected
-        self.postTriggerSamples = postsamples*32
-        self.maxSamples = self.preTriggerSamples + self.postTriggerSamples
-        self.timebase = round(duration/self.maxSamples*125000000 + 2)
+        config = self._config(c)
+        config['averaging'] = averaging
+        config['preTriggerSamples'] = presamples*averaging # Set number of pre and post trigger samples to be collected
+        config['postTriggerSamples'] = postsamples*averaging
+        config['maxSamples'] = config['preTriggerSamples'] + config['postTriggerSamples']
+        config['sample_interval'] = duration/config['maxSamples']
 
-        print(f'\ndur={duration}s timebase={self.timebase} pre_trig_samples={presamples} post_trig_samples={postsamples} x32 sampling but avged back down again')
-    
-    @setting(3)
-    def get_data_5000a(self,c,path,serial_no):
-        # based off of https://github.com/picotech/picosdk-python-wrappers/blob/master/ps5000aExamples/ps5000aBlockExample.py
+        # allocate the (channels x averaged samples) buffer get_data_3000a transfers into on each open scope, reused until the sample count changes
+        n_channels = sum(channel['enabled'] for channel in config['channels'].values())
+        for device in list(self.devices.values()):
+            if device['model'] == '3000a':
+                self._buffer(self._block_buffer_name('3000a', config), (n_channels, config['maxSamples'] // averaging), device=device)
 
-            ## PICOSDK CODE ##
+        print(f'\ndur={duration}s sample_interval={config["sample_interval"]*1e9:g}ns pre_trig_samples={presamples} post_trig_samples={postsamples} x{averaging} sampling but avged back down again')
+    
+    def _get_block(self, path, serial_no, model, config, reductions=None):
+        # Block capture shared by get_data_5000a, get_data_3000a and get_data_reduced. Saves the trace to path
+        # unless it is '', and returns the results of reductions (see reductions.py) if any are given
+        block = self._start_block(path, serial_no, model, config, reductions)
 
-        self.serial_no = ctypes.create_string_buffer(bytes(serial_no,encoding='utf-8'))
+        # Wait for data collection to finish without polling IsReady
+        self._wait_for_block(block['device'])
+        self._lap(block['device'], 'trigger_wait')
 
-        # Open 5000 series PicoScope
-        # Returns handle to chandle for use in future API functions
-        self.status["openunit"] = ps5.ps5000aOpenUnit(ctypes.byref(self.chandle), self.serial_no, self.resolution)
+        return self._finish_block(block)
 
-        try:
-            assert_pico_ok(self.status["openunit"])
-        except: # PicoNotOkError:
+    def _start_block(self, path, serial_no, model, config, reductions=None):
+        # Set up and arm a block capture, and return what _finish_block needs to fetch and save it once triggered
+        # based off of https://github.com/picotech/picosdk-python-wrappers/blob/master/ps5000aExamples/ps5000aBlockExample.py
+        # and https://github.com/picotech/picosdk-python-wrappers/blob/master/ps3000aExamples/ps3000aBlockExample.py
+        # The scope stays open between shots (see _get_device), and channel, trigger and timebase
+        # settings are only sent to the device when they differ from what it already has
 
-            powerStatus = self.status["openunit"]
+            ## PICOSDK CODE ##
 
-            if powerStatus == 286:
-                self.status["changePowerSource"] = ps5.ps5000aChangePowerSource(self.chandle, powerStatus)
-            elif powerStatus == 282:
-                self.status["changePowerSource"] = ps5.ps5000aChangePowerSource(self.chandle, powerStatus)
-            else:
-                raise
+        if config['decimation'] > 1 and self.storage == 'mmap' and path:
+            raise ValueError("set_decimation can't be used with 'mmap' storage, the trace file is the capture buffer")
+        device = self._get_device(serial_no, model, config)
+        driver = device['driver']
+        chandle = device['chandle']
 
-            assert_pico_ok(self.status["changePowerSource"])
-
-        # Set up channel A
-        channel = ps5.PS5000A_CHANNEL["PS5000A_CHANNEL_A"]
-        enabled = 1
-        coupling_type = ps5.PS5000A_COUPLING["PS5000A_DC"]
-        chARange = ps5.PS5000A_RANGE["PS5000A_10V"] # range is +- around 0V
-        analog_offset=0 # voltage to add to the input channel before digitization 
-        self.status["setChA"] = ps5.ps5000aSetChannel(self.chandle, channel, enabled, coupling_type, chARange, analog_offset)
-        assert_pico_ok(self.status["setChA"])
-
-        # Set up channel B
-        channel = ps5.PS5000A_CHANNEL["PS5000A_CHANNEL_B"]
-        enabled = 1
-        chBRange = ps5.PS5000A_RANGE["PS5000A_10V"]
-        analog_offset=0 # voltage to add to the input channel before digitization 
-        self.status["setChB"] = ps5.ps5000aSetChannel(self.chandle, channel, enabled, coupling_type, chBRange, analog_offset)
-        assert_pico_ok(self.status["setChB"])
-
-        # Set up channel C
-        channel = ps5.PS5000A_CHANNEL["PS5000A_CHANNEL_C"]
-        enabled = 1
-        chCRange = ps5.PS5000A_RANGE["PS5000A_10V"]
-        analog_offset=0 # voltage to add to the input channel before digitization 
-        self.status["setChC"] = ps5.ps5000aSetChannel(self.chandle, channel, enabled, coupling_type, chCRange, analog_offset)
-        assert_pico_ok(self.status["setChC"])
-
-        # Set up channel D
-        channel = ps5.PS5000A_CHANNEL["PS5000A_CHANNEL_D"]
-        enabled = 1
-        chDRange = ps5.PS5000A_RANGE["PS5000A_10V"]
-        analog_offset=0 # voltage to add to the input channel before digitization 
-        self.status["setChD"] = ps5.ps5000aSetChannel(self.chandle, channel, enabled, coupling_type, chDRange, analog_offset)
-        assert_pico_ok(self.status["setChD"])
-
-        # find maximum ADC count value
-        # pointer to value = ctypes.byref(maxADC)
-        maxADC = ctypes.c_int16()
-        self.status["maximumValue"] = ps5.ps5000aMaximumValue(self.chandle, ctypes.byref(maxADC))
-        assert_pico_ok(self.status["maximumValue"])
-
-        # Set up single trigger
-        enabled = 1
-        source = ps5.PS5000A_CHANNEL["PS5000A_EXTERNAL"]
-        threshold = int(mV2adc(500,chARange, maxADC)) # 500mV threshold for trigger. For def of mV2adc: https://github.com/picotech/picosdk-python-wrappers/blob/master/picosdk/functions.py#L42
-        direction = ps5.PS5000A_THRESHOLD_DIRECTION["PS5000A_RISING"]
-        delay = 0 # s
-        autoTrigger_ms = 0 # setting to 0 makes scope wate indefinitely for a trigger - see page 115 of ps5000a programmer's guide
-        self.status["trigger"] = ps5.ps5000aSetSimpleTrigger(self.chandle, enabled, source, threshold, enabled, delay, autoTrigger_ms) # (handle, enable, source, threshold, direction, delay, autoTrigger_ms)
-
-        assert_pico_ok(self.status["trigger"])
-
-        # Get self.timebase information
-        # Warning: When using this example it may not be possible to access all Timebases as all channels are enabled by default when opening the scope.  
-        # To access these Timebases, set any unused analogue channels to off.
-        # pointer to timeIntervalNanoseconds = ctypes.byref(timeIntervalns)
-        # pointer to self.maxSamples = ctypes.byref(returnedMaxSamples)
-        segment_index = 0
-        timeIntervalns = ctypes.c_float()
-        returnedMaxSamples = ctypes.c_int32()
-        self.status["getTimebase2"] = ps5.ps5000aGetTimebase2(self.chandle, self.timebase, self.maxSamples, ctypes.byref(timeIntervalns), ctypes.byref(returnedMaxSamples), segment_index)
-        assert_pico_ok(self.status["getTimebase2"])
+        names, chRanges = self._configure(device, config)
+        self._timebase(device, config, names)
+        timeIntervalns = device['timeIntervalns']
+        self._lap(device, 'setup')
 
         # Run block capture
-        timeIndisposedMs = None # not needed in the example
-        segmentIndex = 0
-        lpReady = None # using ps5000aIsReady rather than ps5000aBlockReady
-        pParameter = None
-        self.status["runBlock"] = ps5.ps5000aRunBlock(self.chandle, self.preTriggerSamples, self.postTriggerSamples, self.timebase, timeIndisposedMs, segmentIndex, lpReady, pParameter)
-        assert_pico_ok(self.status["runBlock"])
-
-        # Check for data collection to finish using ps5000aIsReady
-        ready = ctypes.c_int16(0)
-        check = ctypes.c_int16(0)
-        while ready.value == check.value:
-            self.status["isReady"] = ps5.ps5000aIsReady(self.chandle, ctypes.byref(ready))
-
-        # Create buffers ready for assigning pointers for data collection
-        bufferAMax = (ctypes.c_int16 * self.maxSamples)() # used for downsampling which isn't in the scope of this example
-        bufferAMin = (ctypes.c_int16 * self.maxSamples)()
-        bufferBMax = (ctypes.c_int16 * self.maxSamples)()
-        bufferBMin = (ctypes.c_int16 * self.maxSamples)()
-        bufferCMax = (ctypes.c_int16 * self.maxSamples)()
-        bufferCMin = (ctypes.c_int16 * self.maxSamples)() 
-        bufferDMax = (ctypes.c_int16 * self.maxSamples)()
-        bufferDMin = (ctypes.c_int16 * self.maxSamples)() 
-
-        # Set data buffer location for data collection from channel A
-        source = ps5.PS5000A_CHANNEL["PS5000A_CHANNEL_A"]
-        # pointer to buffer max = ctypes.byref(bufferAMax)
-        # pointer to buffer min = ctypes.byref(bufferAMin)
-        # buffer length = self.maxSamples
         # segment index = 0
-        # ratio mode = PS5000A_RATIO_MODE_NONE = 0
-        self.status["setDataBuffersA"] = ps5.ps5000aSetDataBuffers(self.chandle, source, ctypes.byref(bufferAMax), ctypes.byref(bufferAMin), self.maxSamples, 0, 0)
-        assert_pico_ok(self.status["setDataBuffersA"])
-
-        # Set data buffer location for data collection from channel B
-        source = ps5.PS5000A_CHANNEL["PS5000A_CHANNEL_B"]
-        self.status["setDataBuffersB"] = ps5.ps5000aSetDataBuffers(self.chandle, source, ctypes.byref(bufferBMax), ctypes.byref(bufferBMin), self.maxSamples, 0, 0)
-        assert_pico_ok(self.status["setDataBuffersB"])
-
-        source = ps5.PS5000A_CHANNEL["PS5000A_CHANNEL_C"]
-        self.status["setDataBuffersC"] = ps5.ps5000aSetDataBuffers(self.chandle, source, ctypes.byref(bufferCMax), ctypes.byref(bufferCMin), self.maxSamples, 0, 0)
-        assert_pico_ok(self.status["setDataBuffersC"])
-
-        source = ps5.PS5000A_CHANNEL["PS5000A_CHANNEL_D"]
-        self.status["setDataBuffersD"] = ps5.ps5000aSetDataBuffers(self.chandle, source, ctypes.byref(bufferDMax), ctypes.byref(bufferDMin), self.maxSamples, 0, 0)
-        assert_pico_ok(self.status["setDataBuffersD"])
-
-        # create overflow loaction
-        overflow = ctypes.c_int16()
-        # create converted type self.maxSamples
-        self.cmaxSamples = ctypes.c_int32(self.maxSamples)
+        # lpReady = BlockReady callback, see _open_device
+        self._arm_block(device)
+        self._check(device, "runBlock", driver.run_block(chandle, config['preTriggerSamples'], config['postTriggerSamples'], device['timebase'], 0, device['lpReady']))
+
+        # Downsampling (3000a only): the driver averages every config['averaging'] raw samples into one value (PS3000A_RATIO_MODE_AVERAGE),
+        # so the buffers only need to hold the averaged samples and only those are transferred.
+        # The 8 bit samples are scaled to the full 16 bit ADC range, so the averages keep the extra bits
+        averaging = config['averaging'] if model == '3000a' else 1
+        if averaging > 1:
+            ratio = averaging
+            ratio_mode = 'AVERAGE'
+        else:
+            ratio = 0
+            ratio_mode = 'NONE'
+
+        # Set data buffer location for data collection
+        # one preallocated (channels x samples) buffer, reused from shot to shot. The driver already has
+        # its address after the first shot, so SetDataBuffer is only called again when it changes.
+        # With 'mmap' storage the buffer is the trace file itself, so the transfer is the save.
+        # The min buffers are only needed for aggregate downsampling
+        t0_ns = (-config['preTriggerSamples'] + (averaging - 1)/2) * timeIntervalns
+        if self.storage == 'mmap' and path:
+            bufferMax = self._mmap_buffer(device, path, (len(names), config['maxSamples'] // averaging), names, chRanges, t0_ns, averaging*timeIntervalns)
+        else:
+            bufferMax = self._buffer(self._block_buffer_name(model, config), (len(names), config['maxSamples'] // averaging), device=device)
+        self._register_buffers(device, bufferMax, names, ratio_mode)
+        self._lap(device, 'arm')
+
+        return {'path': path, 'device': device, 'config': config, 'reductions': reductions, 'names': names, 'chRanges': chRanges,
+                'buffer': bufferMax, 'averaging': averaging, 'ratio': ratio, 'ratio_mode': ratio_mode, 't0_ns': t0_ns, 'dt_ns': averaging*timeIntervalns}
+
+    def _finish_block(self, block):
+        # Fetch a triggered capture from _start_block, then reduce and save it. Returns the results of the reductions
+        path = block['path']
+        device = block['device']
+        driver = device['driver']
+        chandle = device['chandle']
+        config = block['config']
+        names, chRanges = block['names'], block['chRanges']
+        bufferMax = block['buffer']
+        t0_ns, dt_ns = block['t0_ns'], block['dt_ns']
 
         # Retried data from scope to buffers assigned above
-        # handle = chandle
-        # start index = 0
-        # pointer to number of samples = ctypes.byref(self.cmaxSamples)
-        # downsample ratiao = 0
-        # downsample ratio mode = PS5000A_RATIO_MODE_NONE
-        # pointer to overflow = ctypes.byref(overflow))
-        self.status["getValues"] = ps5.ps5000aGetValues(self.chandle, 0, ctypes.byref(self.cmaxSamples), 0, 0, 0, ctypes.byref(overflow))
-        assert_pico_ok(self.status["getValues"])
-
-        # convert ADC counts data to mV
-        adc2mVChAMax =  adc2mV(bufferAMax, chARange, maxADC)
-        adc2mVChBMax =  adc2mV(bufferBMax, chBRange, maxADC)
-        adc2mVChCMax =  adc2mV(bufferCMax, chCRange, maxADC)
-        adc2mVChDMax =  adc2mV(bufferDMax, chDRange, maxADC)
+        # number of samples = config['maxSamples'], replaced by the number of (averaged) samples returned
+        # downsample ratio = ratio
+        # downsample ratio mode = ratio_mode
+        # segment index = 0
+        status, nSamples, overflow = driver.get_values(chandle, config['maxSamples'], block['ratio'], block['ratio_mode'], 0)
+        self._check(device, "getValues", status)
 
         # Stop the scope
-        # handle = chandle
-        self.status["stop"] = ps5.ps5000aStop(self.chandle)
-        assert_pico_ok(self.status["stop"])
-
-        # Close unit Disconnect the scope
-        # handle = chandle
-        self.status["close"]=ps5.ps5000aCloseUnit(self.chandle)
-        assert_pico_ok(self.status["close"])
+        # The unit is left open for the next shot. It is closed in stopServer
+        self._check(device, "stop", driver.stop(chandle))
+        self._lap(device, 'transfer')
+
+            ## REDUCING AND SAVING DATA ##
+
+        # each averaged sample sits at the mean time of the raw samples it was averaged from
+        counts = bufferMax[:, :nSamples]
+        if config['decimation'] > 1:
+            counts, t0_ns, dt_ns = self._decimate(device, 'block', counts, config, t0_ns, dt_ns)
+        self._publish_preview(device, path, counts, names, chRanges, t0_ns, dt_ns)
+        self._accumulate_psd(device, counts, names, chRanges, dt_ns)
+        results = None
+        if block['reductions']:
+            results = reduce_trace(counts, names, [CHANNEL_RANGES_MV[r] for r in chRanges], device['maxADC'], [device['applied']['ch' + name][3]*1e3 for name in names], t0_ns, dt_ns, block['reductions'])
+            self._lap(device, 'reduce')
+
+        if not path:
+            return results
+        if self.storage == 'mmap':
+            finish_mmap_trace(bufferMax, nSamples)
+            self._lap(device, 'save')
+            self._record_saved(path, path)
+        else:
+            self._save_trace(device, path, counts, names, chRanges, t0_ns, dt_ns)
 
-        # display self.status returns
-        #print(self.status)
-
-        
-            ## SAVING DATA ##
-
-        # Create time data
-        time = np.linspace(-self.preTriggerSamples*timeIntervalns.value, (self.postTriggerSamples - 1) * timeIntervalns.value, self.cmaxSamples.value)
-
-        """
-        # 2-channel option
-        # save data as a packed file
-        packed = {}
-        packed["time_ns"] = time
-        packed["ChA_mV"] = adc2mVChAMax #- analog_offset*1e3 # Add the analog offset (which I believe is in V) to the mV trace
-        packed["ChB_mV"] = adc2mVChBMax #- analog_offset*1e3
-        np.savez(path,**packed)
-        """
-
-        #"""
-        # 4-channel option
-        # save data as a packed file
-        packed = {}
-        packed["time_ns"] = time
-        packed["ChA_mV"] = adc2mVChAMax
-        packed["ChB_mV"] = adc2mVChBMax 
-        packed["ChC_mV"] = adc2mVChCMax
-        packed["ChD_mV"] = adc2mVChDMax
-
-        np.savez(path,**packed)
-        #"""
-        
         print(f'Picoscope trace saved at {path}')
+        return results
+
+    @setting(3)
+    def get_data_5000a(self,c,path,serial_no):
+        # Capture one block with the settings from set_recordduration_5000a and set_channel and save it to path
+        with self._device_lock(serial_no):
+            self._get_block(path, serial_no, '5000a', self._config(c))
 
     @setting(4)
-    def get_data_3000a(self,c,path,serial_no): 
-        # initially from https://github.com/picotech/picosdk-python-wrappers/blob/master/ps5000aExamples/ps5000aBlockExample.py
-        # modified to match https://github.com/picotech/picosdk-python-wrappers/blob/master/ps3000aExamples/ps3000aBlockExample.py
+    def get_data_3000a(self,c,path,serial_no):
+        # Capture one block with the settings from set_recordduration_3000a and set_channel and save it to path
+        with self._device_lock(serial_no):
+            self._get_block(path, serial_no, '3000a', self._config(c))
 
-            ## PICOSDK CODE ##
-            
-        self.serial_no = ctypes.create_string_buffer(bytes(serial_no,encoding='utf-8'))
+    @setting(5)
+    def set_capture_timeout(self,c,timeout):
+        # Inputs:
+        #   timeout: s to wait for a trigger in get_data before the capture is stopped and an error returned.
+        #            0 waits indefinitely (the capture can still be aborted with cancel_capture)
+        self.capture_timeout = timeout
+
+    @setting(6)
+    def cancel_capture(self,c,serial_no):
+        # Abort a capture that is waiting for its trigger. The get_data call waiting on it
+        # returns an error and the scope is stopped so it can be re-armed
+        # Inputs:
+        #   serial_no: serial number of the scope
+        device = self.devices.get(serial_no)
+        if device is not None:
+            device['cancelled'] = True
+            device['ready'].set()
+
+    @setting(7)
+    def get_data_rapid_5000a(self,c,path,serial_no,n_segments):
+        # Rapid block mode: arm n_segments captures with one RunBlock, each started by its own trigger,
+        # and fetch them all at once with ps5000aGetValuesBulk. One call replaces n_segments calls to get_data_5000a
+        # Uses the pre/post trigger samples and timebase from set_recordduration_5000a for every segment
+        # Inputs:
+        #   path: where to save the .npz file. Each ChX_mV is saved with shape (n_segments, samples),
+        #         trigger_offset_ns holds the trigger time offset of each segment
+        #   serial_no: serial number of the scope
+        #   n_segments: number of triggers to capture
 
-        # Open 3000 series PicoScope
-        # Returns handle to chandle for use in future API functions
-        self.status["openunit"] = ps3.ps3000aOpenUnit(ctypes.byref(self.chandle), self.serial_no)
+        with self._device_lock(serial_no):
+            ## PICOSDK CODE ##
 
-        try:
-            assert_pico_ok(self.status["openunit"])
-        except: # PicoNotOkError:
+            config = self._config(c)
+            if config['decimation'] > 1 and self.storage == 'mmap':
+                raise ValueError("set_decimation can't be used with 'mmap' storage, the trace file is the capture buffer")
+            device = self._get_device(serial_no, '5000a', config)
+            driver = device['driver']
+            chandle = device['chandle']
+            names, chRanges = self._configure(device, config, n_segments)
+            self._timebase(device, config, names, n_segments)
+            timeIntervalns = device['timeIntervalns']
+            self._lap(device, 'setup')
+
+            # Run rapid block capture. lpReady is only called once all n_segments blocks are captured
+            self._arm_block(device)
+            self._check(device, "runBlock", driver.run_block(chandle, config['preTriggerSamples'], config['postTriggerSamples'], device['timebase'], 0, device['lpReady']))
+            self._lap(device, 'arm')
+            self._wait_for_block(device)
+            self._lap(device, 'trigger_wait')
+
+            # one contiguous, preallocated (segments x channels x samples) buffer. Each segment/channel row is handed to the
+            # driver with ps5000aSetDataBuffer so the bulk transfer writes straight into it
+            # With 'mmap' storage it is the trace file, with room in the header for the per-segment offsets and flags
+            if self.storage == 'mmap':
+                header_size = HEADER_SIZE*(1 + (32*n_segments)//HEADER_SIZE)
+                data = self._mmap_buffer(device, path, (n_segments, len(names), config['maxSamples']), names, chRanges, -config['preTriggerSamples']*timeIntervalns, timeIntervalns, header_size)
+            else:
+                data = self._buffer('rapid_' + config['name'], (n_segments, len(names), config['maxSamples']), device=device)
+            for segment in range(n_segments):
+                self._register_buffers(device, data[segment], names, 'NONE', segment)
 
-            powerStatus = self.status["openunit"]
+            # Retrieve all segments in one transfer
+            # number of samples, from segment, to segment. Returns one overflow flag per segment
+            status, nSamples, overflow = driver.get_values_bulk(chandle, config['maxSamples'], 0, n_segments - 1)
+            self._check(device, "getValuesBulk", status)
 
-            if powerStatus == 286:
-                self.status["ChangePowerSource"] = ps3.ps3000aChangePowerSource(self.chandle, powerStatus)
-            elif powerStatus == 282:
-                self.status["ChangePowerSource"] = ps3.ps3000aChangePowerSource(self.chandle, powerStatus)
-            else:
-                raise
+            # Trigger time offset of each segment in ns
+            status, trigger_offset_ns = driver.get_trigger_time_offsets_bulk(chandle, 0, n_segments - 1)
+            self._check(device, "getTriggerTimeOffsetBulk", status)
 
-            assert_pico_ok(self.status["ChangePowerSource"])
-    
-        # Set up channel A
-        channel = ps3.PS3000A_CHANNEL["PS3000A_CHANNEL_A"]
-        enabled = 1
-        coupling_type = ps3.PS3000A_COUPLING["PS3000A_DC"]
-        chARange = ps3.PS3000A_RANGE["PS3000A_10V"]
-        analog_offset=0
-        self.status["setChA"] = ps3.ps3000aSetChannel(self.chandle, channel, enabled, coupling_type, chARange, analog_offset)
-        assert_pico_ok(self.status["setChA"])
-
-        # Set up channel B
-        channel = ps3.PS3000A_CHANNEL["PS3000A_CHANNEL_B"]
-        coupling_type = ps3.PS3000A_COUPLING["PS3000A_DC"]
-        chBRange = ps3.PS3000A_RANGE["PS3000A_10V"]
-        analog_offset=0
-        self.status["setChB"] = ps3.ps3000aSetChannel(self.chandle, channel, enabled, coupling_type, chBRange, analog_offset)
-        assert_pico_ok(self.status["setChB"])
-
-        # Set up channel C
-        channel = ps3.PS3000A_CHANNEL["PS3000A_CHANNEL_C"]
-        coupling_type = ps3.PS3000A_COUPLING["PS3000A_DC"]
-        chCRange = ps3.PS3000A_RANGE["PS3000A_10V"]
-        analog_offset=0
-        self.status["setChC"] = ps3.ps3000aSetChannel(self.chandle, channel, enabled, coupling_type, chCRange, analog_offset)
-        assert_pico_ok(self.status["setChC"])
-
-        # Set up channel D
-        channel = ps3.PS3000A_CHANNEL["PS3000A_CHANNEL_D"]
-        coupling_type = ps3.PS3000A_COUPLING["PS3000A_DC"]
-        chDRange = ps3.PS3000A_RANGE["PS3000A_10V"]
-        analog_offset=0
-        self.status["setChD"] = ps3.ps3000aSetChannel(self.chandle, channel, enabled, coupling_type, chDRange, analog_offset)
-        assert_pico_ok(self.status["setChD"])
-
-        # find maximum ADC count value
-        # pointer to value = ctypes.byref(maxADC)
-        maxADC = ctypes.c_int16()
-        self.status["maximumValue"] = ps3.ps3000aMaximumValue(self.chandle, ctypes.byref(maxADC))
-        assert_pico_ok(self.status["maximumValue"])
-
-        # Set up single trigger
-        source = ps3.PS3000A_CHANNEL["PS3000A_EXTERNAL"]
-        threshold = int(mV2adc(500,chARange, maxADC)) # def of mV2adc: https://github.com/picotech/picosdk-python-wrappers/blob/master/picosdk/functions.py#L42
-        direction = ps3.PS3000A_THRESHOLD_DIRECTION["PS3000A_RISING"]
-        delay = 0 # s
-        autoTrigger_ms = 0 # 0 means device will wait indefinitely for a trigger - see page 105 of ps3000a programmer's guide
-        self.status["trigger"] = ps3.ps3000aSetSimpleTrigger(self.chandle, 1, source, threshold, direction, delay, autoTrigger_ms) # (handle, enable, source, threshold, direction, delay, autoTrigger_ms)
+            self._check(device, "stop", driver.stop(chandle))
+            self._lap(device, 'transfer')
 
-        assert_pico_ok(self.status["trigger"])
+            ## SAVING DATA ##
 
-        # Get self.timebase information
-        # Warning: When using this example it may not be possible to access all Timebases as all channels are enabled by default when opening the scope.  
-        # To access these Timebases, set any unused analogue channels to off.
-        timeIntervalns = ctypes.c_float()
-        returnedMaxSamples = ctypes.c_int32()
-        self.status["GetTimebase"] = ps3.ps3000aGetTimebase2(self.chandle, self.timebase, self.maxSamples, ctypes.byref(timeIntervalns), 1, ctypes.byref(returnedMaxSamples), 0) # handle, timebase, noSamples, timeIntervalNanoseconds, oversample, maxSamples, segmentIndex - page 48 of ps3000a programmer's guide
-        assert_pico_ok(self.status["GetTimebase"])
+            counts, t0_ns, dt_ns = data[:, :, :nSamples], -config['preTriggerSamples']*timeIntervalns, timeIntervalns
+            if config['decimation'] > 1:
+                # every segment is decimated on its own
+                counts, t0_ns, dt_ns = self._decimate(device, 'rapid', counts, config, t0_ns, dt_ns)
+            # the preview shows the last segment
+            self._publish_preview(device, path, counts[-1], names, chRanges, t0_ns, dt_ns)
+            self._accumulate_psd(device, counts, names, chRanges, dt_ns)
+            extra = {"trigger_offset_ns": trigger_offset_ns, "overflow": overflow}
+            if self.storage == 'mmap':
+                finish_mmap_trace(data, nSamples, extra)
+                self._lap(device, 'save')
+                self._record_saved(path, path)
+            else:
+                self._save_trace(device, path, counts, names, chRanges, t0_ns, dt_ns, extra)
 
-        # Run block capture
-        # time indisposed ms = None (not needed in the example)
-        # segment index = 0
-        # lpReady = None (using ps5000aIsReady rather than ps5000aBlockReady)
-        # pParameter = None
-        self.status["runBlock"] = ps3.ps3000aRunBlock(self.chandle, self.preTriggerSamples, self.postTriggerSamples, self.timebase, 1, None, 0, None, None) # page 75 of ps3000a programmer's guide
-        assert_pico_ok(self.status["runBlock"])
-
-        # Create buffers ready for assigning pointers for data collection
-        bufferAMax = (ctypes.c_int16 * self.maxSamples)() # used for downsampling which isn't in the scope of this example
-        bufferAMin = (ctypes.c_int16 * self.maxSamples)() 
-        bufferBMax = (ctypes.c_int16 * self.maxSamples)()
-        bufferBMin = (ctypes.c_int16 * self.maxSamples)() 
-        bufferCMax = (ctypes.c_int16 * self.maxSamples)()
-        bufferCMin = (ctypes.c_int16 * self.maxSamples)() 
-        bufferDMax = (ctypes.c_int16 * self.maxSamples)()
-        bufferDMin = (ctypes.c_int16 * self.maxSamples)() 
-
-        # Set data buffer location for data collection from channel A
-        # pointer to buffer max = ctypes.byref(bufferAMax)
-        # pointer to buffer min = ctypes.byref(bufferAMin)
-        # buffer length = self.maxSamples
-        # segment index = 0
-        # ratio mode = ps3000A_RATIO_MODE_NONE = 0
-        source = ps3.PS3000A_CHANNEL["PS3000A_CHANNEL_A"]
-        self.status["setDataBuffers"] = ps3.ps3000aSetDataBuffers(self.chandle, source, ctypes.byref(bufferAMax), ctypes.byref(bufferAMin), self.maxSamples, 0, 0)
-        assert_pico_ok(self.status["setDataBuffers"])
-        source = ps3.PS3000A_CHANNEL["PS3000A_CHANNEL_B"]
-        self.status["setDataBuffers"] = ps3.ps3000aSetDataBuffers(self.chandle, source, ctypes.byref(bufferBMax), ctypes.byref(bufferBMin), self.maxSamples, 0, 0)
-        assert_pico_ok(self.status["setDataBuffers"])
-        source = ps3.PS3000A_CHANNEL["PS3000A_CHANNEL_C"]
-        self.status["setDataBuffers"] = ps3.ps3000aSetDataBuffers(self.chandle, source, ctypes.byref(bufferCMax), ctypes.byref(bufferCMin), self.maxSamples, 0, 0)
-        assert_pico_ok(self.status["setDataBuffers"])
-        source = ps3.PS3000A_CHANNEL["PS3000A_CHANNEL_D"]
-        self.status["setDataBuffers"] = ps3.ps3000aSetDataBuffers(self.chandle, source, ctypes.byref(bufferDMax), ctypes.byref(bufferDMin), self.maxSamples, 0, 0)
-        assert_pico_ok(self.status["setDataBuffers"])
-
-        # create overflow location
-        overflow = (ctypes.c_int16 * 10)()
-        # create converted type self.maxSamples
-        self.cmaxSamples = ctypes.c_int32(self.maxSamples)
-
-        # Check for data collection to finish using
-        ready = ctypes.c_int16(0)
-        check = ctypes.c_int16(0)
-        while ready.value == check.value:
-            self.status["isReady"] = ps3.ps3000aIsReady(self.chandle, ctypes.byref(ready))
+            print(f'{n_segments} picoscope traces saved at {path}')
 
-        # Retried data from scope to buffers assigned above
-        # start index = 0
-        # pointer to number of samples = ctypes.byref(self.cmaxSamples)
-        # downsample ratiao = 0
-        # downsample ratio mode = PS5000A_RATIO_MODE_NONE
-        # pointer to overflow = ctypes.byref(overflow))
-
-        self.status["GetValues"] = ps3.ps3000aGetValues(self.chandle, 0, ctypes.byref(self.cmaxSamples), 0, 0, 0, ctypes.byref(overflow))
-        assert_pico_ok(self.status["GetValues"])
-
-        # Finds the max ADC count
-        # Value = ctype.byref(maxADC)
-        maxADC = ctypes.c_int16()
-        self.status["maximumValue"] = ps3.ps3000aMaximumValue(self.chandle, ctypes.byref(maxADC))
-        assert_pico_ok(self.status["maximumValue"])
-
-        # convert ADC counts data to mV
-        adc2mVChAMax = adc2mV(bufferAMax, chARange, maxADC)
-        adc2mVChBMax = adc2mV(bufferBMax, chBRange, maxADC)
-        adc2mVChCMax = adc2mV(bufferCMax, chCRange, maxADC)
-        adc2mVChDMax = adc2mV(bufferDMax, chDRange, maxADC)
+    @setting(8)
+    def stream_5000a(self,c,path,serial_no,duration,sample_interval_ns,chunk_samples=2**20,n_chunks=16):
+        # Streaming mode capture, for records longer than the scope memory. The driver hands over data as it is
+        # captured, the streaming callback copies it into a StreamRingBuffer and a background thread writes it to
+        # disk while the capture runs, so memory use doesn't grow with the record length.
+        # Starts on the external trigger like get_data_5000a and stops after duration s of data
+        # based off of https://github.com/picotech/picosdk-python-wrappers/blob/master/ps5000aExamples/ps5000aStreamingExample.py
+        # Inputs:
+        #   path: raw int16 samples are written to path, the enabled channels interleaved, and the channels, scaling and
+        #         statistics to path + '.json'. Read back with np.fromfile(path, dtype=np.int16).reshape(-1, len(channels))
+        #   serial_no: serial number of the scope
+        #   duration: record duration in s
+        #   sample_interval_ns: requested sample interval. The driver may round it, the actual value is saved
+        #   chunk_samples, n_chunks: ring buffer size, see stream_buffer.py
+        # Returns the streaming statistics as a json string
 
-        # Stop the scope
-        self.status["stop"] = ps3.ps3000aStop(self.chandle)
-        assert_pico_ok(self.status["stop"])
+        with self._device_lock(serial_no):
+            ## PICOSDK CODE ##
 
-        # Close unit Disconnect the scope
-        self.status["close"]=ps3.ps3000aCloseUnit(self.chandle)
-        assert_pico_ok(self.status["close"])
+            config = self._config(c)
+            device = self._get_device(serial_no, '5000a', config)
+            driver = device['driver']
+            chandle = device['chandle']
+            names, chRanges = self._configure(device, config)
+
+            totalSamples = int(round(duration*1e9/sample_interval_ns))
+
+            # driver side buffers, one row per channel. The driver writes each batch of new samples into
+            # these and the streaming callback copies them into the ring buffer before the next batch
+            driverBufferSize = min(chunk_samples, totalSamples)
+            driverBuffers = self._buffer('stream', (len(names), driverBufferSize), device=device)
+            self._register_buffers(device, driverBuffers, names)
+
+            ring = StreamRingBuffer(path, len(names), chunk_samples, n_chunks)
+            stream = {'autoStop': False, 'triggerAt': None, 'overrange': 0, 'callbacks': 0}
+
+            def streaming_callback(handle, noOfSamples, startIndex, overflow, triggerAt, triggered, autoStop, pParameter):
+                # called from inside ps5000aGetStreamingLatestValues with the position of the new samples in driverBuffers
+                if triggered and stream['triggerAt'] is None:
+                    stream['triggerAt'] = ring.samples_received + triggerAt
+                ring.write(driverBuffers[:, startIndex:startIndex + noOfSamples])
+                stream['callbacks'] += 1
+                if overflow:
+                    stream['overrange'] += 1
+                if autoStop:
+                    stream['autoStop'] = True
+            cFuncPtr = driver.streaming_ready(streaming_callback)
+
+            # Run streaming capture
+            # sample interval in ns, max pre trigger samples = 0, max post trigger samples = totalSamples,
+            # autostop = 1, downsample ratio = 1, downsample ratio mode = NONE, overview buffer size = driverBufferSize
+            self._arm_block(device)
+            try:
+                status, sampleInterval = driver.run_streaming(chandle, sample_interval_ns, 0, totalSamples, 1, 1, 'NONE', driverBufferSize)
+                self._check(device, "runStreaming", status)
+
+                # Poll the driver for new data. Between polls the thread sleeps on the device event,
+                # so cancel_capture stops the stream right away
+                deadline = None
+                if self.capture_timeout > 0:
+                    deadline = time.monotonic() + duration + self.capture_timeout
+                while not stream['autoStop']:
+                    device['status']["getStreamingLatestValues"] = driver.get_streaming_latest_values(chandle, cFuncPtr)
+                    if device['status']["getStreamingLatestValues"] in DEVICE_LOST_STATUS:
+                        self._check(device, "getStreamingLatestValues", device['status']["getStreamingLatestValues"])
+                    if device['ready'].wait(0.01) and device['cancelled']:
+                        raise RuntimeError(f'stream on picoscope {serial_no} was cancelled')
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise TimeoutError(f'picoscope {serial_no} stream did not finish within {self.capture_timeout} s of the expected {duration} s')
+            finally:
+                device['status']["stop"] = driver.stop(chandle)
+                stats = ring.close()
 
             ## SAVING DATA ##
 
-        # Create time data
-        time = np.linspace(-self.preTriggerSamples*timeIntervalns.value, (self.postTriggerSamples - 1) * timeIntervalns.value, self.cmaxSamples.value)
-        
-        # average over 32-segment long intervals
-        time = np.mean(np.reshape(time,(-1,32)),1)
-        adc2mVChAMax = np.mean(np.reshape(adc2mVChAMax,(-1,32)),axis=1) # https://stackoverflow.com/questions/10847660/subsampling-averaging-over-a-numpy-array
-        adc2mVChBMax = np.mean(np.reshape(adc2mVChBMax,(-1,32)),axis=1)
-        adc2mVChCMax = np.mean(np.reshape(adc2mVChCMax,(-1,32)),axis=1)
-        adc2mVChDMax = np.mean(np.reshape(adc2mVChDMax,(-1,32)),axis=1)
-
-        #"""
-        # save data as a packed file
-
-        packed = {}
-        packed["time_ns"] = time
-        packed["ChA_mV"] = adc2mVChAMax
-        packed["ChB_mV"] = adc2mVChBMax 
-        packed["ChC_mV"] = adc2mVChCMax
-        packed["ChD_mV"] = adc2mVChDMax
-
-        np.savez(path,**packed)
-        #"""
-        
-        print(f'Picoscope trace saved at {path}')
+            stats['overrange_callbacks'] = stream['overrange']
+            stats['callbacks'] = stream['callbacks']
+            metadata = {
+                'channels': names,
+                'range_mV': [CHANNEL_RANGES_MV[r] for r in chRanges],
+                'maxADC': device['maxADC'],
+                'offset_mV': [device['applied']['ch' + name][3]*1e3 for name in names],
+                'sample_interval_ns': sampleInterval,
+                'trigger_sample': stream['triggerAt'],
+                'stats': stats,
+            }
+            with open(path + '.json', 'w') as f:
+                json.dump(metadata, f)
+
+            print(f'Picoscope stream saved at {path}: {stats["samples_written"]} samples, {stats["samples_dropped"]} dropped in {stats["overruns"]} overruns')
+            return json.dumps(stats)
+
+    @setting(9)
+    def set_float32(self,c,enabled):
+        # Inputs:
+        #   enabled: True to convert and save traces as float32 mV instead of float64.
+        #            float32 keeps well over the 16 bits of the ADC and halves the memory and file size
+        self.mV_dtype = np.float32 if enabled else np.float64
+
+    @setting(10)
+    def set_storage_format(self,c,format):
+        # Inputs:
+        #   format: 'mV' saves float ChA_mV..ChD_mV arrays and t0_ns, dt_ns (the default)
+        #           'raw' saves the int16 ADC counts with the scaling needed to convert them,
+        #           open those files with picoscope_data.load_trace
+        #           'mmap' captures block and rapid block data straight into a memory-mapped file at path
+        #           (mmap_trace.py): the driver writes the samples into the file's pages, with no copy,
+        #           conversion or np.savez, and the file can be mapped by readers while it is filled.
+        #           Meant for very long blocks. These files bypass set_async_save and open_run,
+        #           open them with picoscope_data.load_trace or mmap_trace.open_mmap_trace
+        if format not in ('mV', 'raw', 'mmap'):
+            raise ValueError(f"unknown storage format {format}, use 'mV', 'raw' or 'mmap'")
+        self.storage = format
+
+    @setting(11)
+    def set_channel(self,c,channel,enabled,range_V=10,coupling='DC',offset_V=0):
+        # Input settings of one channel, used by every get_data/stream setting on either model in this context.
+        # All four channels start enabled at +-10 V, DC coupled, no offset
+        # Inputs:
+        #   channel: 'A', 'B', 'C' or 'D'
+        #   enabled: False turns the channel off. It isn't transferred or saved, and fewer channels allow faster
+        #            timebases and, on the 5000a, higher resolutions (see set_resolution_5000a)
+        #   range_V: full scale in V, +- around the offset. One of 0.01, 0.02, 0.05 ... 20 (50 on some models)
+        #   coupling: 'DC' or 'AC'
+        #   offset_V: analog offset added to the input before digitization
+        config = self._config(c)
+        if channel not in config['channels']:
+            raise ValueError(f"unknown channel {channel}, use 'A', 'B', 'C' or 'D'")
+        if round(range_V*1000, 6) not in CHANNEL_RANGES_MV:
+            raise ValueError(f'unsupported range {range_V} V, use one of {[r/1000 for r in CHANNEL_RANGES_MV]}')
+        if coupling not in ('DC', 'AC'):
+            raise ValueError(f"unknown coupling {coupling}, use 'DC' or 'AC'")
+        config['channels'][channel] = {'enabled': bool(enabled), 'range': CHANNEL_RANGES_MV.index(round(range_V*1000, 6)), 'coupling': coupling, 'offset': float(offset_V)}
+
+    @setting(12)
+    def set_resolution_5000a(self,c,bits):
+        # Inputs:
+        #   bits: 8, 12, 14, 15 or 16. 15 bit allows at most 2 enabled channels and 16 bit 1, see set_channel.
+        #         Higher resolutions also have slower fastest timebases (timebase.py)
+        if ('5000a', bits) not in TIMEBASES:
+            raise ValueError(f'unsupported resolution {bits} bit, use 8, 12, 14, 15 or 16')
+        self._config(c)['bits'] = bits
+
+    @setting(13, enabled='b', options='s')
+    def set_simulated(self,c,enabled,options=''):
+        # Switch both models between the real scopes and simulated ones (picoscope_simulator.py), to run
+        # or load-test the server on a machine without a scope. Open scopes are closed first
+        # Inputs:
+        #   enabled: True for simulated scopes, False for the real ones
+        #   options: json dict of picoscope_simulator.SimulatedDriver options,
+        #            e.g. '{"trigger_delay_s": [0.01, 0.02], "transfer_rate": 2e8, "noise_mV": 5}'
+        for serial_no in list(self.devices):
+            self._close_device(serial_no)
+        self.simulated = json.loads(options or '{}') if enabled else None
+        self.drivers = {}
+
+    @setting(14)
+    def get_timings(self,c,serial_no):
+        # Time spent in each stage of the last get_data call on a scope, as a json dict of s:
+        #   open (ping or open), setup (channels, trigger, timebase), arm (RunBlock, data buffers),
+        #   trigger_wait, transfer (GetValues), preview (update signal), reduce (get_data_reduced), convert (to mV or raw arrays),
+        #   save (np.savez) and queue (handing the file to the background writer)
+        # Inputs:
+        #   serial_no: serial number of the scope
+        return json.dumps(self.devices[serial_no]['timings'])
+
+    @setting(15)
+    def set_async_save(self,c,max_pending):
+        # Inputs:
+        #   max_pending: 0 saves each trace before get_data returns (the default). Above 0, get_data returns once
+        #                the data is off the scope and a background thread converts and writes the file
+        #                (trace_writer.py). Up to max_pending shots can wait to be written, after that get_data
+        #                waits for the disk. Check or wait for a file with save_status / wait_for_save
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = TraceWriter(max_pending) if max_pending > 0 else None
+        # one copy of the counts per queued shot, plus the one being written and the one being filled
+        self.save_slots = max_pending + 2
+        for device in list(self.devices.values()):
+            device['save_jobs'] = [None]*self.save_slots
+            device['save_slot'] = 0
+
+    def _saved_inline(self, path):
+        # True if the shot for path was saved without the writer: recorded in self.saved, or, for shots from
+        # before the server was restarted, its .npz or 'mmap' trace file exists
+        with self.saved_lock:
+            if path in self.saved:
+                return True
+        return os.path.exists(npz_path(path)) or os.path.isfile(path)
+
+    @setting(16)
+    def save_status(self,c,path):
+        # Returns 'queued', 'writing', 'saved', 'failed: <error>', or 'unknown' for a path
+        # that was never saved (shots saved inline, 'mmap' traces and shots in a run file are 'saved' once written)
+        # Inputs:
+        #   path: path passed to get_data
+        job = self.writer.job(path) if self.writer is not None else None
+        if job is None:
+            return 'saved' if self._saved_inline(path) else 'unknown'
+        if job.state == 'failed':
+            return f'failed: {job.error!r}'
+        return job.state
+
+    @setting(17, path='s', timeout='v')
+    def wait_for_save(self,c,path,timeout=0):
+        # Wait until the file of a shot is on disk. Raises the error if writing it failed
+        # Inputs:
+        #   path: path passed to get_data
+        #   timeout: s to wait before raising TimeoutError, 0 waits indefinitely
+        # Returns the time the file took to convert and write, as a json dict of s
+        job = self.writer.job(path) if self.writer is not None else None
+        if job is None:
+            if not self._saved_inline(path):
+                raise ValueError(f'no trace was saved at {path}')
+            return json.dumps({})
+        if not job.wait(timeout if timeout > 0 else None):
+            raise TimeoutError(f'{path} was not written within {timeout} s ({job.state})')
+        return json.dumps(job.timings)
+
+    @setting(18, path='s', compression='s', flush_every='w')
+    def open_run(self,c,path,compression='',flush_every=10):
+        # Append the following shots to one HDF5 run file instead of saving a .npz file per shot (run_file.py).
+        # Each shot becomes a group named after the path passed to get_data, holding the traces as chunked
+        # datasets in the format chosen with set_storage_format and the metadata as attributes.
+        # Read a shot back with run_file.load_shot(path, name)
+        # Inputs:
+        #   path: run file, appended to if it exists
+        #   compression: '' for none, 'lzf' (fast) or 'gzip' (smaller)
+        #   flush_every: flush the file to disk every this many shots, 0 only when the run is closed
+        if compression not in ('', 'lzf', 'gzip'):
+            raise ValueError(f"unknown compression {compression}, use '', 'lzf' or 'gzip'")
+        self.close_run(c)
+        self.run = RunFile(path, compression, flush_every)
+        print(f'appending shots to run file {path}')
+
+    @setting(19)
+    def close_run(self,c):
+        # Finish the run file from open_run, shots are saved as .npz files again.
+        # Waits for any shots still being written to it
+        if self.run is None:
+            return
+        if self.writer is not None:
+            self.writer.join()
+        self.run.close()
+        self.run = None
+
+    @setting(20)
+    def list_devices(self,c,model):
+        # Serial numbers of the scopes of a model that are attached: the ones the server has open
+        # plus the ones the driver finds (ps5000aEnumerateUnits / ps3000aEnumerateUnits)
+        # Inputs:
+        #   model: '5000a' or '3000a'
+        status, serials = self._driver(model).enumerate_units()
+        if status != PICO_STATUS["PICO_NOT_FOUND"]:
+            assert_pico_ok(status)
+        opened = [serial_no for serial_no, device in list(self.devices.items()) if device['model'] == model]
+        return sorted(set(opened + serials))
+
+    @setting(21, paths='*s', serial_nos='*s', model='s')
+    def get_data_parallel(self,c,paths,serial_nos,model='5000a'):
+        # Capture one block on each of several scopes at once, e.g. scopes sharing the external trigger.
+        # Each scope is armed, waited for and read out on its own thread, so N scopes take about as long
+        # as the slowest one instead of N captures. Same settings and files as get_data_5000a / get_data_3000a
+        # Inputs:
+        #   paths: where to save the trace of each scope
+        #   serial_nos: serial number of each scope
+        #   model: '5000a' or '3000a'
+        if len(paths) != len(serial_nos):
+            raise ValueError(f'got {len(paths)} paths for {len(serial_nos)} scopes')
+        config = self._config(c)
+        errors = {}
+        def capture(path, serial_no):
+            try:
+                with self._device_lock(serial_no):
+                    self._get_block(path, serial_no, model, config)
+            except Exception as error:
+                errors[serial_no] = error
+        threads = [threading.Thread(target=capture, args=(path, serial_no), daemon=True) for path, serial_no in zip(paths, serial_nos)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise RuntimeError(f'capture failed on {len(errors)} of {len(serial_nos)} scopes: ' + ', '.join(f'{serial_no}: {error!r}' for serial_no, error in errors.items()))
+
+    @setting(22)
+    def get_status(self,c,serial_no):
+        # PICO_STATUS returned by the last call of each kind on a scope, as a json dict, e.g. {"runBlock": 0, ...}
+        # Inputs:
+        #   serial_no: serial number of the scope
+        return json.dumps(self.devices[serial_no]['status'])
+
+    @setting(23)
+    def save_preset(self,c,name):
+        # Save the acquisition config of this context (set_recordduration_*, set_channel, set_resolution_5000a)
+        # as a named preset, to switch back to with use_preset. Presets belong to the context.
+        # The scope keeps the timebase, max ADC count and buffers it works out for each preset, so
+        # switching between a few recurring presets only sends the settings that differ to the scope
+        # Inputs:
+        #   name: name of the preset, replaces any preset of that name
+        config = self._config(c)
+        config['name'] = name
+        self._context(c)['presets'][name] = copy.deepcopy(config)
+
+    @setting(24)
+    def use_preset(self,c,name):
+        # Make a preset saved with save_preset the acquisition config of this context.
+        # Changing settings afterwards doesn't change the preset until it is saved again
+        # Inputs:
+        #   name: name of the preset
+        presets = self._context(c)['presets']
+        if name not in presets:
+            raise ValueError(f'unknown preset {name}, saved presets are {sorted(presets)}')
+        self._context(c)['config'] = copy.deepcopy(presets[name])
+
+    @setting(25)
+    def list_presets(self,c):
+        # Names of the presets saved in this context
+        return sorted(self._context(c)['presets'])
+
+    @setting(26, serial_no='s', reductions='s', path='s', model='s')
+    def get_data_reduced(self,c,serial_no,reductions,path='',model='5000a'):
+        # Capture one block like get_data_5000a / get_data_3000a and return a few numbers per channel computed
+        # from it in memory (windowed sums, integrals, means, min/max, rms, peaks, threshold crossings), so the
+        # conductor doesn't have to wait for the file and read it back. See reductions.py for the spec and results
+        # Inputs:
+        #   serial_no: serial number of the scope
+        #   reductions: json dict of named windows, e.g. '{"signal": {"start_ns": 0, "stop_ns": 5000, "ops": ["integral", "peak"]}}'
+        #   path: also save the trace here, like get_data. '' (the default) doesn't save it
+        #   model: '5000a' or '3000a'
+        # Returns the results as a json dict {window: {channel: {op: value}}}
+        reductions = json.loads(reductions)
+        check_reductions(reductions)
+        with self._device_lock(serial_no):
+            return json.dumps(self._get_block(path, serial_no, model, self._config(c), reductions))
+
+    @setting(27)
+    def set_preview_points(self,c,points):
+        # Every block and rapid block capture sends a min/max envelope preview of its channels with the
+        # update signal (only while a client listens to it), see _publish_preview
+        # Inputs:
+        #   points: points per channel of the previews, 0 stops sending them
+        self.preview_points = points
+
+    @setting(28, path='s', serial_no='s', model='s', reductions='s')
+    def arm_block(self,c,path,serial_no,model='5000a',reductions=''):
+        # First half of get_data_5000a / get_data_3000a: set up the scope and arm it, then return without
+        # waiting for the trigger, so the scope is ready for the next trigger while the conductor does other things.
+        # Collect the capture with fetch_block. Each scope holds one armed capture at a time; arm several scopes
+        # to have several captures in flight (or use get_data_rapid_5000a for several triggers on one scope)
+        # Inputs:
+        #   path: where to save the trace, '' to not save it
+        #   serial_no: serial number of the scope
+        #   model: '5000a' or '3000a'
+        #   reductions: optional json reductions to compute when fetching, see get_data_reduced
+        # Returns the job id to pass to wait_block / fetch_block
+        reductions = json.loads(reductions) if reductions else None
+        if reductions:
+            check_reductions(reductions)
+        with self._device_lock(serial_no):
+            block = self._start_block(path, serial_no, model, self._config(c), reductions)
+            with self.devices_lock:
+                job = self.next_job
+                self.next_job += 1
+            self.jobs[job] = block
+            block['device']['job'] = job
+        return job
+
+    @setting(29, job='w', timeout='v')
+    def wait_block(self,c,job,timeout=0):
+        # Wait until the capture of a job from arm_block has triggered and is ready to fetch
+        # Inputs:
+        #   job: job id from arm_block
+        #   timeout: s to wait, 0 only checks
+        # Returns True once it has triggered (or was cancelled, which fetch_block reports), False otherwise
+        if job not in self.jobs:
+            raise ValueError(f'unknown job {job}')
+        return self.jobs[job]['device']['ready'].wait(timeout)
+
+    @setting(30, job='w')
+    def fetch_block(self,c,job):
+        # Second half of get_data: wait for the trigger of a job from arm_block (up to set_capture_timeout),
+        # transfer the data and save it like get_data. The scope is free to be armed again once this returns,
+        # or as soon as the data is off the scope with set_async_save
+        # Inputs:
+        #   job: job id from arm_block
+        # Returns json {"job", "serial_no", "path", "results"}, results being those of the job's reductions or null
+        block = self.jobs.get(job)
+        if block is None:
+            raise ValueError(f'unknown job {job}')
+        device = block['device']
+        with self._device_lock(device['serial_no']):
+            try:
+                self._wait_for_block(device)
+                self._lap(device, 'trigger_wait')
+                results = self._finish_block(block)
+            finally:
+                self.jobs.pop(job, None)
+                device['job'] = None
+        return json.dumps({'job': job, 'serial_no': device['serial_no'], 'path': block['path'], 'results': results})
+
+    @setting(31, serial_no='s', channel='s', nfft='w', overlap='v', window='s', checkpoint='s')
+    def start_psd(self,c,serial_no,channel,nfft=65536,overlap=0.5,window='hann',checkpoint=''):
+        # Average the PSD of one channel over every following block and rapid block capture of a scope (from any
+        # context), with a running Welch sum (psd_accumulator.py), so the spectrum converges while shots come in
+        # and no trace has to be read back. Read it with get_psd. Replaces a PSD already running on the scope
+        # Inputs:
+        #   serial_no: serial number of the scope
+        #   channel: 'A', 'B', 'C' or 'D'
+        #   nfft: samples per Welch segment, captures shorter than this add nothing
+        #   overlap: fraction of each segment shared with the next
+        #   window: scipy window name
+        #   checkpoint: .npz file the sums are saved to after every capture. If it exists, the PSD continues from it
+        WelchAccumulator(1, nfft, overlap, window) # checks the options
+        self.psds[serial_no] = {'channel': channel, 'nfft': nfft, 'overlap': overlap, 'window': window, 'checkpoint': checkpoint, 'accumulator': None}
+
+    @setting(32, serial_no='s', bins_per_decade='w')
+    def get_psd(self,c,serial_no,bins_per_decade=0):
+        # The PSD from start_psd so far
+        # Inputs:
+        #   serial_no: serial number of the scope
+        #   bins_per_decade: average into this many log spaced bins per decade (without DC), 0 for every FFT bin
+        # Returns json {"channel", "captures", "segments", "freqs_Hz", "psd_mV2_per_Hz"}
+        psd = self.psds.get(serial_no)
+        if psd is None:
+            raise ValueError(f'no PSD running on picoscope {serial_no}, see start_psd')
+        accumulator = psd['accumulator']
+        if accumulator is None:
+            raise ValueError(f'no capture has been added to the PSD of picoscope {serial_no} yet')
+        freqs, values = accumulator.log_binned(bins_per_decade)[:2] if bins_per_decade else accumulator.psd()
+        return json.dumps({'channel': psd['channel'], 'captures': accumulator.captures, 'segments': accumulator.segments,
+                           'freqs_Hz': freqs.tolist(), 'psd_mV2_per_Hz': values.tolist()})
+
+    @setting(33, serial_no='s')
+    def stop_psd(self,c,serial_no):
+        # Stop adding captures to the PSD of a scope. Its checkpoint file, if any, stays on disk
+        self.psds.pop(serial_no, None)
+
+    @setting(34, ratio='w', passband='v')
+    def set_decimation(self,c,ratio,passband=0.8):
+        # Decimate every block and rapid block capture of this context in software after the transfer, with an
+        # anti-aliasing filter (decimation.py: multi-stage polyphase FIR, run chunk by chunk), and keep only the
+        # decimated samples. Capture at a fast timebase and decimate to get a lower rate with the noise above
+        # the new Nyquist frequency filtered out instead of aliased, e.g. on the 3000a in place of its hardware
+        # block averaging (set averaging=1 in set_recordduration_3000a and the ratio here)
+        # The decimated samples are float32 ADC counts: 'raw' files hold them as adc like the int16 counts,
+        # 'mmap' storage can't be used. t0_ns accounts for the filter delay. The record duration, pre and post
+        # trigger samples of set_recordduration_* are those captured, before decimation
+        # Inputs:
+        #   ratio: total decimation ratio, 1 turns decimation off
+        #   passband: band kept flat, as a fraction of the decimated Nyquist frequency
+        if ratio < 1 or not 0 < passband < 1:
+            raise ValueError(f'decimation ratio {ratio} has to be at least 1 and passband {passband} between 0 and 1')
+        config = self._config(c)
+        config['decimation'] = ratio
+        config['passband'] = passband
 
 
 Server = PicoscopeServer
@@ -0,0 +1,315 @@
+# Simulated picoscope with the same interface as the picoscope_driver backends
+#
+# Lets the server, its LabRAD settings and the benchmarks run on a machine with no scope or picosdk
+# driver library. Selected with the server's set_simulated setting or picoscope_driver.make_driver(model, {...})
+#
+# Each enabled channel sees a synthetic waveform (sine, square, ramp or noise, plus gaussian noise),
+# digitized with the channel's range, offset and the device resolution. Timing is modeled too:
+#   - a block capture completes trigger_delay_s (a value or a (min, max) range, drawn per trigger)
+#     plus the capture time of the samples after RunBlock, on a timer thread that calls lpReady
+#   - get_values / get_values_bulk sleep for the transfer of the requested samples at transfer_rate B/s
+#   - streaming hands over samples as they would have been sampled since the trigger
+# Timebases are checked with the tables in timebase.py, and a block that doesn't fit the memory
+# (memory_samples, shared by the segments) is refused like on the real device
+
+import threading
+import time
+
+import numpy as np
+from picosdk.constants import PICO_STATUS
+
+from picoscope_data import CHANNEL_RANGES_MV
+from timebase import timebase_interval
+
+# waveform of each channel if none are given, see SimulatedDriver
+DEFAULT_SIGNALS = {
+    'A': {'shape': 'sine', 'frequency_Hz': 1e5, 'amplitude_mV': 2000},
+    'B': {'shape': 'square', 'frequency_Hz': 1e4, 'amplitude_mV': 1000},
+    'C': {'shape': 'ramp', 'frequency_Hz': 1e3, 'amplitude_mV': 500},
+    'D': {'shape': 'noise', 'amplitude_mV': 100},
+}
+
+# max ADC count per resolution, as returned by MaximumValue
+MAX_ADC = {'5000a': {8: 32512, 12: 32736, 14: 32767, 15: 32767, 16: 32767}, '3000a': {8: 32512}}
+
+
+class SimulatedDriver:
+
+    def __init__(self, model, signals=None, noise_mV=1.0, trigger_delay_s=1e-3, transfer_rate=100e6, memory_samples=2**27, reuse_waveforms=False, seed=None, serials=None):
+        # Inputs:
+        #   model: '5000a' or '3000a'
+        #   signals: dict of channel name -> {'shape': 'sine'|'square'|'ramp'|'noise', 'frequency_Hz', 'amplitude_mV',
+        #            'offset_mV', 'phase'}, missing channels use DEFAULT_SIGNALS
+        #   noise_mV: rms of the gaussian noise added to every channel, 0 for clean waveforms
+        #   trigger_delay_s: time from RunBlock to each trigger, a value or a (min, max) range to draw from
+        #   transfer_rate: USB transfer rate in bytes/s used to delay get_values, 0 for no delay
+        #   memory_samples: capture memory in samples, shared by the segments
+        #   reuse_waveforms: True to keep returning the same captured data while the settings don't change,
+        #                    so generating it doesn't count in benchmarks
+        #   seed: random seed, for repeatable waveforms
+        #   serials: serial numbers of the attached scopes listed by enumerate_units. Any serial number can be opened
+        self.model = model
+        self.signals = dict(DEFAULT_SIGNALS, **(signals or {}))
+        self.noise_mV = noise_mV
+        self.trigger_delay_s = trigger_delay_s
+        self.transfer_rate = transfer_rate
+        self.memory_samples = memory_samples
+        self.reuse_waveforms = reuse_waveforms
+        self.rng = np.random.default_rng(seed)
+        self.serials = list(serials) if serials is not None else [f'SIM{model.upper()}']
+        self.units = {} # state of each open unit, keyed by handle
+        self.next_handle = 1
+        self.lock = threading.Lock() # units can be opened from several threads at once
+
+    # ---- unit ----
+
+    def enumerate_units(self):
+        opened = [unit['serial_no'] for unit in list(self.units.values())]
+        serials = [serial for serial in self.serials if serial not in opened]
+        return PICO_STATUS["PICO_OK"] if serials else PICO_STATUS["PICO_NOT_FOUND"], serials
+
+    def open_unit(self, serial_no, bits):
+        with self.lock:
+            handle = self.next_handle
+            self.next_handle += 1
+        self.units[handle] = {
+            'serial_no': serial_no,
+            'bits': bits if self.model == '5000a' else 8,
+            'channels': {name: (True, 'DC', 9, 0.0) for name in 'ABCD'}, # (enabled, coupling, range, offset_V)
+            'segments': 1,
+            'captures': 1,
+            'buffers': {}, # (channel, segment) -> (array, ratio_mode)
+            'memory': None, # (segments x 4 x samples) int16 counts of the last capture
+            'trigger_offsets_ns': None,
+            'timer': None,
+            'stream': None,
+        }
+        return PICO_STATUS["PICO_OK"], handle
+
+    def change_power_source(self, handle, power_status):
+        return PICO_STATUS["PICO_OK"]
+
+    def close_unit(self, handle):
+        unit = self.units.pop(handle, None)
+        if unit is None:
+            return PICO_STATUS["PICO_INVALID_HANDLE"]
+        if unit['timer'] is not None:
+            unit['timer'].cancel()
+        return PICO_STATUS["PICO_OK"]
+
+    def ping_unit(self, handle):
+        return PICO_STATUS["PICO_OK"] if handle in self.units else PICO_STATUS["PICO_INVALID_HANDLE"]
+
+    def block_ready(self, function):
+        return function
+
+    def streaming_ready(self, function):
+        return function
+
+    def maximum_value(self, handle):
+        return PICO_STATUS["PICO_OK"], MAX_ADC[self.model][self.units[handle]['bits']]
+
+    def set_resolution(self, handle, bits):
+        if bits not in MAX_ADC[self.model]:
+            return PICO_STATUS["PICO_INVALID_PARAMETER"]
+        self.units[handle]['bits'] = bits
+        return PICO_STATUS["PICO_OK"]
+
+    # ---- setup ----
+
+    def set_channel(self, handle, name, enabled, coupling, range, offset_V):
+        if not 0 <= range < len(CHANNEL_RANGES_MV):
+            return PICO_STATUS["PICO_INVALID_VOLTAGE_RANGE"]
+        self.units[handle]['channels'][name] = (bool(enabled), coupling, range, offset_V)
+        return PICO_STATUS["PICO_OK"]
+
+    def set_simple_trigger(self, handle, enabled, source, threshold, direction, delay, autoTrigger_ms):
+        # every capture is triggered after trigger_delay_s, whatever the trigger settings
+        return PICO_STATUS["PICO_OK"]
+
+    def memory_segments(self, handle, n_segments):
+        self.units[handle]['segments'] = n_segments
+        return PICO_STATUS["PICO_OK"], self.memory_samples // n_segments
+
+    def set_no_of_captures(self, handle, n_captures):
+        if n_captures > self.units[handle]['segments']:
+            return PICO_STATUS["PICO_TOO_MANY_SEGMENTS"]
+        self.units[handle]['captures'] = n_captures
+        return PICO_STATUS["PICO_OK"]
+
+    def get_timebase(self, handle, timebase, n_samples, segment=0):
+        unit = self.units[handle]
+        n_channels = sum(enabled for enabled, _, _, _ in unit['channels'].values())
+        try:
+            interval = timebase_interval(self.model, unit['bits'], max(n_channels, 1), timebase)
+        except ValueError:
+            return PICO_STATUS["PICO_INVALID_TIMEBASE"], 0.0, 0
+        maxSamples = self.memory_samples // unit['segments']
+        if n_samples > maxSamples:
+            return PICO_STATUS["PICO_TOO_MANY_SAMPLES"], interval*1e9, maxSamples
+        unit['interval_ns'] = interval*1e9
+        return PICO_STATUS["PICO_OK"], interval*1e9, maxSamples
+
+    def set_data_buffer(self, handle, name, buffer, segment=0, ratio_mode='NONE'):
+        self.units[handle]['buffers'][(name, segment)] = (buffer, ratio_mode)
+        return PICO_STATUS["PICO_OK"]
+
+    # ---- block mode ----
+
+    def _trigger_delay(self):
+        if np.ndim(self.trigger_delay_s) == 0:
+            return self.trigger_delay_s
+        return self.rng.uniform(*self.trigger_delay_s)
+
+    def _waveforms(self, unit, t0_s, dt_s, n):
+        # (4 x n) int16 counts of the signals sampled at t0_s + i*dt_s, digitized like the device does
+        maxADC = MAX_ADC[self.model][unit['bits']]
+        counts = np.zeros((4, n), dtype=np.int16)
+        t = t0_s + np.arange(n)*dt_s
+        for i, name in enumerate('ABCD'):
+            enabled, coupling, range, offset_V = unit['channels'][name]
+            if not enabled:
+                continue
+            signal = self.signals[name]
+            amplitude = signal.get('amplitude_mV', 1000)
+            phase = 2*np.pi*signal.get('frequency_Hz', 1e3)*t + signal.get('phase', 0)
+            if signal['shape'] == 'sine':
+                mV = amplitude*np.sin(phase)
+            elif signal['shape'] == 'square':
+                mV = amplitude*np.sign(np.sin(phase))
+            elif signal['shape'] == 'ramp':
+                mV = amplitude*(2*((phase/(2*np.pi)) % 1) - 1)
+            else:
+                mV = self.rng.normal(0, amplitude, n)
+            if coupling == 'DC':
+                mV += signal.get('offset_mV', 0) # AC coupling removes the signal's DC offset
+            if self.noise_mV:
+                mV += self.rng.normal(0, self.noise_mV, n)
+            # the analog offset is added before digitization
+            mV += offset_V*1e3
+            counts[i] = np.clip(np.round(mV*(maxADC/CHANNEL_RANGES_MV[range])), -maxADC, maxADC)
+        return counts
+
+    def run_block(self, handle, pre_trigger, post_trigger, timebase, segment, lpReady):
+        unit = self.units[handle]
+        status, interval_ns, maxSamples = self.get_timebase(handle, timebase, pre_trigger + post_trigger)
+        if status != PICO_STATUS["PICO_OK"]:
+            return status
+        n = pre_trigger + post_trigger
+        n_captures = unit['captures']
+        dt = interval_ns*1e-9
+
+        # the trigger and capture times of all captures, the data is generated once the last one is done
+        wait = sum(self._trigger_delay() for _ in range(n_captures)) + n_captures*post_trigger*dt
+
+        def capture():
+            key = (n, n_captures, dt, pre_trigger, unit['bits'], tuple(unit['channels'].values()))
+            if self.reuse_waveforms and unit.get('memory_key') == key:
+                unit['timer'] = None
+                lpReady(handle, PICO_STATUS["PICO_OK"], None)
+                return
+            unit['memory_key'] = key
+            unit['memory'] = np.stack([self._waveforms(unit, -pre_trigger*dt + self.rng.uniform(0, dt), dt, n) for _ in range(n_captures)])
+            unit['trigger_offsets_ns'] = self.rng.uniform(0, interval_ns, n_captures)
+            unit['timer'] = None
+            lpReady(handle, PICO_STATUS["PICO_OK"], None)
+
+        unit['timer'] = threading.Timer(wait, capture)
+        unit['timer'].daemon = True
+        unit['timer'].start()
+        return PICO_STATUS["PICO_OK"]
+
+    def _transfer(self, unit, n_samples, ratio, segment):
+        # copy a segment of the last capture into the registered buffers, averaging ratio samples in
+        # RATIO_MODE_AVERAGE. Returns the number of samples written per channel
+        if unit['memory'] is None or segment >= len(unit['memory']):
+            return None
+        memory = unit['memory'][segment]
+        n_enabled = 0
+        written = 0
+        for i, name in enumerate('ABCD'):
+            if not unit['channels'][name][0]:
+                continue
+            n_enabled += 1
+            if (name, segment) not in unit['buffers']:
+                continue
+            buffer, ratio_mode = unit['buffers'][(name, segment)]
+            data = memory[i, :n_samples]
+            if ratio_mode == 'AVERAGE' and ratio > 1:
+                data = data[:len(data)//ratio*ratio].reshape(-1, ratio).mean(axis=1)
+            written = min(len(data), buffer.size)
+            buffer[:written] = data[:written]
+        if self.transfer_rate:
+            time.sleep(2*n_enabled*min(n_samples, memory.shape[-1])/self.transfer_rate)
+        return written
+
+    def get_values(self, handle, n_samples, ratio=0, ratio_mode='NONE', segment=0):
+        written = self._transfer(self.units[handle], n_samples, ratio, segment)
+        if written is None:
+            return PICO_STATUS["PICO_DATA_NOT_AVAILABLE"], 0, 0
+        return PICO_STATUS["PICO_OK"], written, 0
+
+    def get_values_bulk(self, handle, n_samples, from_segment, to_segment):
+        unit = self.units[handle]
+        written = 0
+        for segment in range(from_segment, to_segment + 1):
+            written = self._transfer(unit, n_samples, 0, segment)
+            if written is None:
+                return PICO_STATUS["PICO_DATA_NOT_AVAILABLE"], 0, np.zeros(to_segment - from_segment + 1, dtype=np.int16)
+        return PICO_STATUS["PICO_OK"], written, np.zeros(to_segment - from_segment + 1, dtype=np.int16)
+
+    def get_trigger_time_offsets_bulk(self, handle, from_segment, to_segment):
+        return PICO_STATUS["PICO_OK"], self.units[handle]['trigger_offsets_ns'][from_segment:to_segment + 1]
+
+    # ---- streaming ----
+
+    def run_streaming(self, handle, sample_interval_ns, pre_trigger, post_trigger, autostop, ratio, ratio_mode, overview_size):
+        unit = self.units[handle]
+        unit['stream'] = {
+            'interval_ns': int(sample_interval_ns),
+            'start': time.monotonic() + self._trigger_delay(),
+            'total': pre_trigger + post_trigger,
+            'autostop': autostop,
+            'overview_size': overview_size,
+            'delivered': 0,
+        }
+        return PICO_STATUS["PICO_OK"], int(sample_interval_ns)
+
+    def get_streaming_latest_values(self, handle, callback):
+        # hand over the samples taken since the last call, at most one overview buffer's worth,
+        # written into the registered buffers from where the last call stopped
+        unit = self.units[handle]
+        stream = unit['stream']
+        if stream is None:
+            return PICO_STATUS["PICO_INVALID_PARAMETER"]
+        elapsed = time.monotonic() - stream['start']
+        available = int(elapsed*1e9/stream['interval_ns']) - stream['delivered'] if elapsed > 0 else 0
+        if stream['autostop']:
+            available = min(available, stream['total'] - stream['delivered'])
+        if available <= 0:
+            return PICO_STATUS["PICO_OK"]
+
+        buffers = [(i, unit['buffers'][(name, 0)][0]) for i, name in enumerate('ABCD') if unit['channels'][name][0] and (name, 0) in unit['buffers']]
+        size = min(buffer.size for _, buffer in buffers)
+        start = stream['delivered'] % size
+        n = min(available, size - start, stream['overview_size'])
+        dt = stream['interval_ns']*1e-9
+        counts = self._waveforms(unit, stream['delivered']*dt, dt, n)
+        for i, buffer in buffers:
+            buffer[start:start + n] = counts[i]
+
+        triggered = stream['delivered'] == 0
+        stream['delivered'] += n
+        autoStop = stream['autostop'] and stream['delivered'] >= stream['total']
+        callback(handle, n, start, 0, 0, int(triggered), int(autoStop), None)
+        return PICO_STATUS["PICO_OK"]
+
+    def stop(self, handle):
+        unit = self.units.get(handle)
+        if unit is None:
+            return PICO_STATUS["PICO_INVALID_HANDLE"]
+        if unit['timer'] is not None:
+            unit['timer'].cancel()
+            unit['timer'] = None
+        unit['stream'] = None
+        return PICO_STATUS["PICO_OK"]
@@ -0,0 +1,176 @@
+# Running Welch power spectral density over many captures
+#
+# Each capture (or chunk of a stream) is cut into nfft long, windowed, overlapping segments whose periodograms
+# are added to a running sum, so the averaged PSD converges as data comes in and old captures never have to be
+# read again. Only the sum, the number of segments and the samples left over from the last chunk are kept,
+# and they can be checkpointed to disk and resumed. The result is the same as scipy.signal.welch with
+# average='mean' over all segments of all captures, for the same window, nfft, overlap and detrend.
+#   psd = WelchAccumulator(sample_rate, nfft=2**16)
+#   for each capture: psd.add(x)                 # or psd.add(chunk, continued=True) for chunks of one record
+#   freqs, Pxx = psd.psd()                       # units^2/Hz, one-sided
+#   freqs, Pxx, n = psd.log_binned(20)           # averaged into 20 bins per decade
+#   psd.save(path) ... psd = WelchAccumulator.load(path)
+# trace_psd / stream_psd do this for saved traces and stream_5000a recordings, and the server keeps one per
+# scope, fed with every block and rapid block capture, between start_psd and stop_psd
+
+import json
+import os
+
+import numpy as np
+from scipy import signal
+
+from picoscope_data import load_trace, read_stream
+from trace_writer import npz_path, write_npz
+
+
+class WelchAccumulator:
+
+    def __init__(self, sample_rate, nfft=2**16, overlap=0.5, window='hann', detrend='constant'):
+        # Inputs:
+        #   sample_rate: in Hz, every capture added has to have this rate
+        #   nfft: samples per segment, the frequency resolution is sample_rate/nfft
+        #   overlap: fraction of a segment shared with the next one, 0 to <1
+        #   window: scipy.signal.get_window name
+        #   detrend: 'constant' removes each segment's mean, 'linear' its linear fit (e.g. for a phase with a
+        #            frequency offset), None nothing
+        if not 0 <= overlap < 1:
+            raise ValueError(f'overlap {overlap} has to be between 0 and 1')
+        self.sample_rate = sample_rate
+        self.nfft = nfft
+        self.overlap = overlap
+        self.window_name = window
+        self.detrend = detrend
+        self.window = signal.get_window(window, nfft)
+        self.step = nfft - int(round(overlap*nfft))
+        self.sum = np.zeros(nfft//2 + 1)
+        self.segments = 0
+        self.captures = 0
+        self.tail = np.zeros(0) # samples of the current record not yet in a segment
+        self.sources = [] # files added by trace_psd / stream_psd, so a resumed checkpoint skips them
+
+    def add(self, x, continued=False):
+        # Add the segments of x to the running sum
+        # Inputs:
+        #   x: samples, any units
+        #   continued: True if x continues the record of the previous add (the next chunk of a stream),
+        #              so segments run across the boundary. False starts a new capture
+        if continued:
+            x = np.concatenate((self.tail, x))
+        else:
+            self.captures += 1
+        n = (len(x) - self.nfft)//self.step + 1 if len(x) >= self.nfft else 0
+        if n > 0:
+            # all segments of the chunk at once, as a (segments x nfft) view of x
+            segments = np.lib.stride_tricks.sliding_window_view(x, self.nfft)[::self.step][:n]
+            if self.detrend:
+                segments = signal.detrend(segments, axis=-1, type=self.detrend)
+            spectra = np.fft.rfft(segments*self.window, axis=-1)
+            self.sum += np.sum(spectra.real**2 + spectra.imag**2, axis=0)
+            self.segments += n
+        self.tail = np.array(x[n*self.step:], dtype=float)
+
+    def frequencies(self):
+        return np.fft.rfftfreq(self.nfft, 1/self.sample_rate)
+
+    def psd(self):
+        # Frequencies in Hz and the one-sided PSD averaged over every segment so far, in units^2/Hz
+        if self.segments == 0:
+            raise ValueError(f'no full segment of {self.nfft} samples has been added yet')
+        psd = self.sum/(self.segments*self.sample_rate*np.sum(self.window**2))
+        psd[1:-1 if self.nfft % 2 == 0 else None] *= 2
+        return self.frequencies(), psd
+
+    def log_binned(self, bins_per_decade=20):
+        # The PSD averaged into logarithmically spaced frequency bins, which evens out the noise of the many
+        # high frequency bins for log-log plots. Returns the mean frequency, the mean PSD and the number
+        # of FFT bins of each bin that has any. DC is left out
+        freqs, psd = self.psd()
+        freqs, psd = freqs[1:], psd[1:]
+        index = np.floor(np.log10(freqs)*bins_per_decade).astype(int)
+        index -= index[0]
+        counts = np.bincount(index)
+        used = counts > 0
+        return np.bincount(index, freqs)[used]/counts[used], np.bincount(index, psd)[used]/counts[used], counts[used]
+
+    def save(self, path):
+        # Checkpoint the running sums to path (.npz), written to a temporary file first so a crash
+        # never leaves a broken checkpoint
+        write_npz(path, {
+            'sample_rate': self.sample_rate, 'nfft': self.nfft, 'overlap': self.overlap, 'window': self.window_name,
+            'detrend': str(self.detrend), 'sum': self.sum, 'segments': self.segments, 'captures': self.captures,
+            'tail': self.tail, 'sources': np.array(self.sources, dtype=str),
+        })
+
+    @classmethod
+    def load(cls, path):
+        # Resume from a checkpoint written by save
+        with np.load(npz_path(path)) as f:
+            detrend = str(f['detrend'])
+            accumulator = cls(float(f['sample_rate']), int(f['nfft']), float(f['overlap']), str(f['window']), None if detrend == 'None' else detrend)
+            accumulator.sum = f['sum']
+            accumulator.segments = int(f['segments'])
+            accumulator.captures = int(f['captures'])
+            accumulator.tail = f['tail']
+            accumulator.sources = [str(source) for source in f['sources']]
+        return accumulator
+
+
+def resume(checkpoint, sample_rate, nfft=2**16, overlap=0.5, window='hann', detrend='constant'):
+    # The accumulator saved at checkpoint if there is one, otherwise a new one
+    if checkpoint and os.path.exists(npz_path(checkpoint)):
+        accumulator = WelchAccumulator.load(checkpoint)
+        if not np.isclose(accumulator.sample_rate, sample_rate) or accumulator.nfft != nfft:
+            raise ValueError(f'checkpoint {checkpoint} is for {accumulator.sample_rate} Hz and nfft {accumulator.nfft}, not {sample_rate} Hz and {nfft}')
+        # segments with a different overlap, window or detrend would be averaged with incompatible ones
+        saved = (accumulator.overlap, accumulator.window_name, accumulator.detrend)
+        if not np.isclose(saved[0], overlap) or saved[1:] != (window, detrend):
+            raise ValueError(f'checkpoint {checkpoint} is for overlap {saved[0]}, window {saved[1]!r} and detrend {saved[2]!r}, not {overlap}, {window!r} and {detrend!r}')
+        return accumulator
+    return WelchAccumulator(sample_rate, nfft, overlap, window, detrend)
+
+
+def add_trace(accumulator, trace, channel='A', chunk_samples=2**20):
+    # Add one channel of an open trace (picoscope_data.load_trace, run_file.load_shot) to accumulator as a
+    # capture, or each segment of a rapid block trace as a capture, reading chunk_samples at a time
+    if np.ndim(trace.channel(channel, 0, 1)) == 2:
+        for segment in trace.channel(channel):
+            accumulator.add(segment)
+    else:
+        for start in range(0, trace.n_samples(), chunk_samples):
+            accumulator.add(trace.channel(channel, start, start + chunk_samples), continued=start > 0)
+
+
+def trace_psd(paths, channel='A', nfft=2**16, overlap=0.5, window='hann', detrend='constant', checkpoint=None, chunk_samples=2**20):
+    # WelchAccumulator of one channel of traces saved by get_data_* (any storage format), each trace a capture
+    # (and each segment of rapid block traces). Long traces are read chunk_samples at a time.
+    # With checkpoint, the sums are resumed from that file if it exists and saved to it after every trace,
+    # and traces already in it are skipped, so the PSD of a growing set of files only reads the new ones
+    accumulator = None
+    for path in paths:
+        with load_trace(path) as trace:
+            if accumulator is None:
+                accumulator = resume(checkpoint, 1e9/np.diff(trace.time_axis(0, 2))[0], nfft, overlap, window, detrend)
+            if path in accumulator.sources:
+                continue
+            add_trace(accumulator, trace, channel, chunk_samples)
+        accumulator.sources.append(path)
+        if checkpoint:
+            accumulator.save(checkpoint)
+    return accumulator
+
+
+def stream_psd(path, channel='A', nfft=2**16, overlap=0.5, window='hann', detrend='constant', checkpoint=None, chunk_samples=2**20):
+    # WelchAccumulator of one channel of a stream_5000a recording, read chunk_samples at a time.
+    # checkpoint: as for trace_psd, a recording already in the checkpoint isn't read again
+    with open(path + '.json') as f:
+        metadata = json.load(f)
+    accumulator = resume(checkpoint, 1e9/metadata['sample_interval_ns'], nfft, overlap, window, detrend)
+    if path in accumulator.sources:
+        return accumulator
+    row = metadata['channels'].index(channel)
+    for k, chunk in enumerate(read_stream(path, chunk_samples)):
+        accumulator.add(chunk[row], continued=k > 0)
+    accumulator.sources.append(path)
+    if checkpoint:
+        accumulator.save(checkpoint)
+    return accumulator
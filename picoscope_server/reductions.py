@@ -0,0 +1,142 @@
+# Reductions of a capture to a few numbers per channel, computed on the counts still in memory
+#
+# Used by the server's get_data_reduced so the conductor gets e.g. the integral of a pulse window back in the
+# LabRAD response instead of waiting for the file and reading it back, and by analyze_shots.py on saved shots
+# (reduce_saved). A reduction spec is a dict of named time windows, each with the operations to compute on it:
+#   {"signal": {"start_ns": 0, "stop_ns": 5000, "ops": ["integral", "peak", "peak_time_ns"]},
+#    "background": {"start_ns": -8000, "stop_ns": -1000, "ops": ["mean", "rms"], "channels": ["A"]},
+#    "edge": {"start_ns": 0, "stop_ns": 20000, "ops": ["crossings", "first_crossing_ns"], "threshold_mV": 100}}
+# Times are relative to the trigger, windows are clipped to the record. "channels" defaults to all captured ones.
+# Results are in mV (integral in mV*ns), as {window: {channel: {op: value}}}, with one value per segment
+# for rapid block captures. Operations:
+#   sum, integral, mean, min, max, rms, std
+#   peak: the sample furthest from 0, with its sign; peak_time_ns: its time, refined with a parabola
+#         through the peak and its neighbours (no fit)
+#   crossings: number of upward crossings of threshold_mV; first_crossing_ns: time of the first,
+#              linearly interpolated, None if there is none
+
+import numpy as np
+
+OPS = ('sum', 'integral', 'mean', 'min', 'max', 'rms', 'std', 'peak', 'peak_time_ns', 'crossings', 'first_crossing_ns')
+
+
+def check_reductions(spec):
+    # Raise ValueError for a spec that can't be computed, before anything is captured
+    if not isinstance(spec, dict) or not spec:
+        raise ValueError('reductions must be a dict of named windows')
+    for name, window in spec.items():
+        for key in ('start_ns', 'stop_ns', 'ops'):
+            if key not in window:
+                raise ValueError(f'window {name} has no {key}')
+        if window['stop_ns'] <= window['start_ns']:
+            raise ValueError(f'window {name} ends before it starts')
+        unknown = [op for op in window['ops'] if op not in OPS]
+        if unknown:
+            raise ValueError(f'unknown operations {unknown} in window {name}, use {list(OPS)}')
+        if {'crossings', 'first_crossing_ns'} & set(window['ops']) and 'threshold_mV' not in window:
+            raise ValueError(f'window {name} needs a threshold_mV for crossings')
+
+
+def _value(x):
+    # numpy result -> json value, a list for rapid block captures
+    if np.ndim(x):
+        return [_value(v) for v in x]
+    x = float(x)
+    return None if np.isnan(x) else x
+
+
+def _window_ops(mV, t0_ns, dt_ns, start, window):
+    # ops of one window on mV, an (..., samples) array starting at sample start. Returns {op: array over ...}
+    ops = window['ops']
+    result = {}
+    if 'sum' in ops or 'integral' in ops:
+        total = mV.sum(axis=-1)
+        result['sum'] = total
+        result['integral'] = total*dt_ns
+    if 'mean' in ops or 'std' in ops:
+        result['mean'] = mV.mean(axis=-1)
+        result['std'] = mV.std(axis=-1)
+    if 'min' in ops:
+        result['min'] = mV.min(axis=-1)
+    if 'max' in ops:
+        result['max'] = mV.max(axis=-1)
+    if 'rms' in ops:
+        result['rms'] = np.sqrt(np.mean(mV*mV, axis=-1))
+    if 'peak' in ops or 'peak_time_ns' in ops:
+        i = np.abs(mV).argmax(axis=-1)
+        peak = np.take_along_axis(mV, i[..., None], -1)[..., 0]
+        # vertex of the parabola through the samples either side of the peak, 0 at the ends of the window
+        left = np.take_along_axis(mV, np.maximum(i - 1, 0)[..., None], -1)[..., 0]
+        right = np.take_along_axis(mV, np.minimum(i + 1, mV.shape[-1] - 1)[..., None], -1)[..., 0]
+        curvature = left - 2*peak + right
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shift = np.where((curvature != 0) & (i > 0) & (i < mV.shape[-1] - 1), 0.5*(left - right)/curvature, 0)
+        result['peak'] = peak
+        result['peak_time_ns'] = t0_ns + (start + i + shift)*dt_ns
+    if 'crossings' in ops or 'first_crossing_ns' in ops:
+        above = mV >= window['threshold_mV']
+        rising = ~above[..., :-1] & above[..., 1:]
+        result['crossings'] = rising.sum(axis=-1)
+        first = rising.argmax(axis=-1)
+        before = np.take_along_axis(mV, first[..., None], -1)[..., 0]
+        after = np.take_along_axis(mV, (first + 1)[..., None], -1)[..., 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = (window['threshold_mV'] - before)/(after - before)
+        result['first_crossing_ns'] = np.where(rising.any(axis=-1), t0_ns + (start + first + fraction)*dt_ns, np.nan)
+    return {op: result[op] for op in ops}
+
+
+def _window_range(name, window, t0_ns, dt_ns, n):
+    # First and last+1 sample of a window, clipped to the n samples of the record
+    start = min(max(int(np.ceil((window['start_ns'] - t0_ns)/dt_ns)), 0), n)
+    stop = min(max(int(np.ceil((window['stop_ns'] - t0_ns)/dt_ns)), 0), n)
+    if stop <= start:
+        raise ValueError(f'window {name} ({window["start_ns"]} to {window["stop_ns"]} ns) is outside the record')
+    return start, stop
+
+
+def _window_channels(name, window, names):
+    channels = window.get('channels', names)
+    missing = [channel for channel in channels if channel not in names]
+    if missing:
+        raise ValueError(f'window {name} uses channels {missing} that were not captured')
+    return channels
+
+
+def reduce_trace(counts, names, range_mV, maxADC, offset_mV, t0_ns, dt_ns, spec):
+    # Compute spec (see the top of this file) on a capture. Only the samples inside the windows are
+    # converted to mV, and every operation runs on all channels (and segments) of a window at once
+    # Inputs:
+    #   counts: int16 ADC counts, (channels x samples) or (segments x channels x samples)
+    #   names: channel name of each row of counts
+    #   range_mV, maxADC, offset_mV: scaling of each channel, as saved by picoscope_data.pack_raw
+    #   t0_ns, dt_ns: time of the first sample relative to the trigger, and the sample interval
+    #   spec: dict of windows
+    n = counts.shape[-1]
+    scale = (np.asarray(range_mV, dtype=float)/maxADC)[:, None]
+    offset = np.asarray(offset_mV, dtype=float)[:, None]
+    results = {}
+    for name, window in spec.items():
+        start, stop = _window_range(name, window, t0_ns, dt_ns, n)
+        channels = _window_channels(name, window, names)
+        rows = [names.index(channel) for channel in channels]
+        mV = counts[..., rows, start:stop]*scale[rows] - offset[rows]
+        values = _window_ops(mV, t0_ns, dt_ns, start, window)
+        results[name] = {channel: {op: _value(value[..., k]) for op, value in values.items()} for k, channel in enumerate(channels)}
+    return results
+
+
+def reduce_saved(trace, spec):
+    # reduce_trace for a trace saved by the server, opened with picoscope_data.load_trace (any storage format).
+    # Only the samples inside the windows are read and converted, with trace.channel
+    t0_ns, t1_ns = trace.time_axis(0, 2)
+    dt_ns = t1_ns - t0_ns
+    n = trace.n_samples()
+    results = {}
+    for name, window in spec.items():
+        start, stop = _window_range(name, window, t0_ns, dt_ns, n)
+        channels = _window_channels(name, window, trace.channels)
+        mV = np.stack([trace.channel(channel, start, stop) for channel in channels], axis=-2)
+        values = _window_ops(mV, t0_ns, dt_ns, start, window)
+        results[name] = {channel: {op: _value(value[..., k]) for op, value in values.items()} for k, channel in enumerate(channels)}
+    return results
@@ -0,0 +1,120 @@
+# HDF5 run files: every shot of a run appended to one file instead of one .npz per shot
+#
+# Layout: one group per shot, named after the path the shot was saved with (its file name without
+# .npz, with _1, _2... added if the name is taken). Inside it each array of the trace (e.g. ChA_mV or
+# the raw adc counts) is a chunked, optionally compressed dataset and everything small (t0_ns, dt_ns,
+# maxADC, channels, ranges, ...) plus the shot metadata (path, time, scope) are attributes of the group.
+# The datasets are chunked per channel and 2**16 samples, so a window of one channel can be read
+# without decompressing the rest of the shot.
+#
+# Reading:
+#   with h5py.File(path, 'r') as f: names = list(f)
+#   trace = load_shot(path, name)   # same interface as picoscope_data.load_trace
+#   trace['ChA_mV'], trace['time_ns'], trace.close()
+
+import os
+import threading
+
+import h5py
+import numpy as np
+
+from picoscope_data import Trace
+
+# arrays up to this size are stored as attributes rather than datasets
+MAX_ATTRIBUTE_SIZE = 64
+
+
+class RunFile:
+
+    def __init__(self, path, compression=None, flush_every=10, chunk_samples=2**16):
+        # Inputs:
+        #   path: HDF5 file to create, or to append to if it exists
+        #   compression: None, 'gzip' or 'lzf'. lzf is fast, gzip smaller
+        #   flush_every: flush to disk after this many shots, 0 only flushes on close.
+        #                Shots since the last flush are lost if the server dies
+        #   chunk_samples: samples per chunk along the time axis
+        self.path = path
+        self.file = h5py.File(path, 'a')
+        self.compression = compression or None
+        self.flush_every = flush_every
+        self.chunk_samples = chunk_samples
+        self.unflushed = 0
+        self.shots = len(self.file)
+        self.lock = threading.Lock()
+
+    def append(self, path, arrays, attrs=None):
+        # Add one shot. Returns the name of its group
+        # Inputs:
+        #   path: path the shot was saved with, used to name the group
+        #   arrays: dict of arrays and scalars of the trace, e.g. from picoscope_data.pack_raw
+        #   attrs: dict of extra metadata to store on the group
+        name = os.path.basename(path)
+        if name.endswith('.npz'):
+            name = name[:-4]
+        with self.lock:
+            unique, i = name, 0
+            while unique in self.file:
+                i += 1
+                unique = f'{name}_{i}'
+            group = self.file.create_group(unique)
+            group.attrs['path'] = path
+            group.attrs['shot'] = self.shots
+            for key, value in (attrs or {}).items():
+                group.attrs[key] = value
+            for key, value in arrays.items():
+                value = np.asarray(value)
+                if value.dtype.kind == 'U':
+                    value = value.astype('S') # h5py stores bytes, not numpy unicode
+                if value.ndim == 0 or value.size <= MAX_ATTRIBUTE_SIZE:
+                    group.attrs[key] = value
+                else:
+                    chunks = (1,)*(value.ndim - 1) + (min(value.shape[-1], self.chunk_samples),)
+                    group.create_dataset(key, data=value, chunks=chunks, compression=self.compression)
+            self.shots += 1
+            self.unflushed += 1
+            if self.flush_every and self.unflushed >= self.flush_every:
+                self.flush()
+        return unique
+
+    def flush(self):
+        self.file.flush()
+        self.unflushed = 0
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class _ShotFiles:
+    # Gives a shot group the .files / [key] / close() interface of np.load, for picoscope_data.Trace
+
+    def __init__(self, file, group):
+        self.h5 = file
+        self.group = group
+        self.files = list(group.keys()) + list(group.attrs.keys())
+
+    def __getitem__(self, key):
+        if key in self.group:
+            return self.group[key][()]
+        value = self.group.attrs[key]
+        if isinstance(value, bytes):
+            return value.decode()
+        if isinstance(value, np.ndarray) and value.dtype.kind == 'S':
+            return value.astype('U')
+        return value
+
+    def lazy(self, key):
+        # the dataset itself, for picoscope_data.Trace to read only the slices it needs (whole chunks of
+        # chunk_samples, decompressed if the run file is compressed)
+        if key in self.group:
+            return self.group[key]
+        return self[key]
+
+    def close(self):
+        self.h5.close()
+
+
+def load_shot(path, name):
+    # Open shot name of a run file as a picoscope_data.Trace
+    file = h5py.File(path, 'r')
+    return Trace(path, _ShotFiles(file, file[name]))
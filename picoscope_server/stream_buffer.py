@@ -0,0 +1,111 @@
+# Ring buffer for streaming picoscope acquisitions
+#
+# The streaming callback copies each block the driver hands us into a fixed number of fixed-size
+# chunks, and a background thread writes every full chunk to disk as the capture runs. A record
+# of any length therefore only ever holds n_chunks*chunk_samples samples in memory.
+#
+# The file is raw int16 with the channels interleaved, i.e. it can be read back with
+#   np.fromfile(path, dtype=np.int16).reshape(-1, n_channels)
+# If the disk can't keep up and the ring fills, incoming samples are dropped (never blocking the
+# driver) and the drop is recorded in the statistics returned by close().
+
+import threading
+import time
+
+import numpy as np
+
+
+class StreamRingBuffer:
+
+    def __init__(self, path, n_channels, chunk_samples=2**20, n_chunks=16):
+        # Inputs:
+        #   path: file the samples are written to
+        #   n_channels: number of channels per sample
+        #   chunk_samples: samples per chunk, i.e. per disk write
+        #   n_chunks: number of chunks in the ring. Memory used is n_chunks*chunk_samples*n_channels*2 bytes
+        self.ring = np.zeros((n_chunks, chunk_samples, n_channels), dtype=np.int16)
+        self.n_chunks = n_chunks
+        self.chunk_samples = chunk_samples
+
+        # head counts the chunks handed to the writer, tail the chunks it has written.
+        # Both only ever increase, the ring index is head % n_chunks
+        self.head = 0
+        self.tail = 0
+        self.fill = 0 # samples already in the chunk being filled
+        self.closed = False
+        self.cond = threading.Condition()
+
+        # statistics
+        self.samples_received = 0 # samples handed to write()
+        self.samples_dropped = 0 # samples thrown away because the ring was full
+        self.overruns = 0 # number of times the ring filled up
+        self.gaps = [] # (sample index in the file, number of samples dropped there) for every overrun
+        self.max_queued_chunks = 0 # most full chunks waiting for the writer at once
+        self.write_time = 0 # s spent in file writes
+
+        self.file = open(path, 'wb')
+        self.writer = threading.Thread(target=self._drain, daemon=True)
+        self.writer.start()
+
+    def write(self, block):
+        # Copy a (channels x samples) block into the ring. Called from the driver callback, never blocks
+        n = block.shape[1]
+        self.samples_received += n
+        i = 0
+        while i < n:
+            if self.head - self.tail >= self.n_chunks:
+                # the writer is behind by the whole ring, drop the rest of this block.
+                # Consecutive drops at the same place in the file count as one overrun
+                position = self.head*self.chunk_samples + self.fill
+                self.samples_dropped += n - i
+                if self.gaps and self.gaps[-1][0] == position:
+                    self.gaps[-1] = (position, self.gaps[-1][1] + n - i)
+                else:
+                    self.overruns += 1
+                    self.gaps.append((position, n - i))
+                return
+            chunk = self.ring[self.head % self.n_chunks]
+            k = min(n - i, self.chunk_samples - self.fill)
+            chunk[self.fill:self.fill + k] = block[:, i:i + k].T
+            self.fill += k
+            i += k
+            if self.fill == self.chunk_samples:
+                with self.cond:
+                    self.head += 1
+                    self.fill = 0
+                    self.max_queued_chunks = max(self.max_queued_chunks, self.head - self.tail)
+                    self.cond.notify()
+
+    def _drain(self):
+        # writer thread: write full chunks to disk in order until close() is called
+        while True:
+            with self.cond:
+                while self.tail == self.head and not self.closed:
+                    self.cond.wait()
+                if self.tail == self.head:
+                    return
+                chunk = self.ring[self.tail % self.n_chunks]
+            start = time.perf_counter()
+            self.file.write(chunk)
+            self.write_time += time.perf_counter() - start
+            with self.cond:
+                self.tail += 1
+
+    def close(self):
+        # Flush everything to disk, including the partly filled last chunk, and return the statistics
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.writer.join()
+        self.file.write(self.ring[self.head % self.n_chunks, :self.fill])
+        self.file.close()
+
+        return {
+            'samples_received': self.samples_received,
+            'samples_written': self.head*self.chunk_samples + self.fill,
+            'samples_dropped': self.samples_dropped,
+            'overruns': self.overruns,
+            'gaps': self.gaps,
+            'max_queued_chunks': self.max_queued_chunks,
+            'write_time_s': self.write_time,
+        }
@@ -0,0 +1,5 @@
+# The server modules import each other by module name, as when the server is run from this directory
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,15 @@
+# Resuming a summary file skips analysed shots but tries failed ones again
+
+from analyze_shots import Summary
+
+
+def test_done_skips_failed_rows(tmp_path):
+    summary = Summary(str(tmp_path / 'summary.h5'))
+    summary.append([{'path': 'a.npz', 'error': '', 'n_samples': 10}])
+    summary.append([{'path': 'b.npz', 'error': 'OSError: busy'}])
+    summary.close()
+    summary = Summary(str(tmp_path / 'summary.h5'))
+    assert summary.done() == {'a.npz'}
+    summary.append([{'path': 'b.npz', 'error': '', 'n_samples': 10}])
+    assert summary.done() == {'a.npz', 'b.npz'}
+    summary.close()
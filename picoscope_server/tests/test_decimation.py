@@ -0,0 +1,37 @@
+# Decimator output doesn't depend on how the input is chunked
+
+import numpy as np
+import pytest
+from scipy import signal
+
+from decimation import Decimator, PolyphaseStage, decimate
+
+
+@pytest.mark.parametrize('ratio', [20, 1000, 7])
+@pytest.mark.parametrize('chunk_samples', [1, 13, 999, 4096])
+def test_chunk_size_invariance(ratio, chunk_samples):
+    x = np.random.default_rng(0).normal(size=(2, 20000))
+    whole = Decimator(ratio).process(x)
+    assert whole.shape == (2, -(-x.shape[-1]//ratio))
+    assert np.allclose(decimate(x, ratio, chunk_samples), whole, rtol=0, atol=1e-12)
+
+
+def test_uneven_chunks():
+    x = np.random.default_rng(1).normal(size=20000)
+    whole = Decimator(100).process(x)
+    decimator = Decimator(100)
+    bounds = [0, 3, 50, 51, 777, 10000, 19999, 20000]
+    chunked = np.concatenate([decimator.process(x[start:stop]) for start, stop in zip(bounds[:-1], bounds[1:])])
+    assert np.allclose(chunked, whole, rtol=0, atol=1e-12)
+
+
+def test_stage_matches_full_rate_filter():
+    # filtering at the full rate and keeping every ratio-th sample, with the first sample repeated in front
+    x = np.random.default_rng(2).normal(size=5000)
+    taps = signal.firwin(41, 0.08)
+    full = np.convolve(np.concatenate((np.repeat(x[:1], len(taps) - 1), x)), taps, mode='valid')
+    assert np.allclose(Decimator(10, stages=[PolyphaseStage(10, taps)]).process(x), full[::10])
+
+
+def test_dc_level():
+    assert np.allclose(decimate(np.full(10000, 3.5), 1000, 333), 3.5)
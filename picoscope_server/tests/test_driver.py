@@ -0,0 +1,16 @@
+# Checks of the real picosdk backends that don't need a scope or the driver library
+
+import types
+
+from picoscope_driver import Ps3000aDriver
+
+
+def test_3000a_block_ready_without_sdk_type():
+    # picosdk's ps3000a module has no BlockReadyType, so the 3000a backend must not look it up
+    driver = Ps3000aDriver.__new__(Ps3000aDriver)
+    driver.sdk = types.SimpleNamespace(StreamingReadyType=None)
+    driver.prefix = 'ps3000a'
+    calls = []
+    callback = driver.block_ready(lambda handle, status, pParameter: calls.append((handle, status, pParameter)))
+    callback(3, 0, None)
+    assert calls == [(3, 0, None)]
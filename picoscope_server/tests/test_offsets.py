@@ -0,0 +1,32 @@
+# A channel's analog offset (set_channel offset_V) gives the same voltages in every storage format
+
+import json
+
+import numpy as np
+
+from picoscope_data import load_trace
+from picoscope_server import PicoscopeServer
+
+
+def test_mV_and_raw_remove_offset(tmp_path):
+    server = PicoscopeServer()
+    server.initServer()
+    try:
+        # a constant 300 mV on A, digitized at +-1 V with a 0.2 V offset
+        signals = {'A': {'shape': 'sine', 'frequency_Hz': 1e5, 'amplitude_mV': 0, 'offset_mV': 300}}
+        server.set_simulated(None, True, json.dumps({'trigger_delay_s': 0.0, 'transfer_rate': 0, 'noise_mV': 0, 'seed': 1, 'signals': signals}))
+        for name in 'BCD':
+            server.set_channel(None, name, False)
+        server.set_channel(None, 'A', True, 1, 'DC', 0.2)
+        server.set_recordduration_5000a(None, 1e-4, 100, 900)
+        traces = {}
+        for storage in ('mV', 'raw'):
+            server.set_storage_format(None, storage)
+            path = str(tmp_path / f'{storage}.npz')
+            server.get_data_5000a(None, path, 'SIM')
+            with load_trace(path) as trace:
+                traces[storage] = np.array(trace['ChA_mV'])
+        np.testing.assert_allclose(traces['mV'], 300, atol=0.1)
+        np.testing.assert_allclose(traces['mV'], traces['raw'], atol=1e-6)
+    finally:
+        server.stopServer()
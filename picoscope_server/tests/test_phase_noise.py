@@ -0,0 +1,36 @@
+# PhaseNoise keeps the decimated phase only when asked to
+
+import numpy as np
+import pytest
+
+from phase_noise import PhaseNoise
+from psd_accumulator import WelchAccumulator
+
+
+def beat(n, rate=1e6, f=1e4):
+    phase = 2*np.pi*f*np.arange(n)/rate + np.cumsum(np.random.default_rng(0).normal(0, 1e-3, n))
+    return 100*np.sin(phase), 100*np.cos(phase)
+
+
+def test_accumulator_only_keeps_nothing():
+    i, q = beat(400000)
+    psds = []
+    for chunk in (400000, 30000):
+        accumulator = WelchAccumulator(1e6/20, nfft=1024, detrend='linear')
+        analysis = PhaseNoise(1e6, accumulator=accumulator)
+        for start in range(0, len(i), chunk):
+            analysis.process(i[start:start + chunk], q[start:start + chunk])
+        assert analysis.chunks == []
+        with pytest.raises(ValueError):
+            analysis.psd()
+        psds.append(accumulator.psd()[1])
+    np.testing.assert_allclose(psds[0], psds[1], rtol=1e-6, atol=1e-9*psds[0].max())
+
+
+def test_keep_phase():
+    i, q = beat(100000)
+    analysis = PhaseNoise(1e6, keep_phase=True)
+    analysis.process(i, q)
+    times, phase = analysis.phase()
+    assert len(phase) == 5000
+    assert len(analysis.psd()[0]) > 0
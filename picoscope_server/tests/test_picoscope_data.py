@@ -0,0 +1,62 @@
+# The lazy .npz reader behind load_trace gives the same arrays as np.load
+
+import numpy as np
+import pytest
+
+from picoscope_data import MAP_BYTES, _NpzFiles, load_trace, pack_raw
+
+
+def arrays():
+    rng = np.random.default_rng(0)
+    return {
+        'small': np.arange(10, dtype=np.int16),
+        'scalar': np.float64(2.5),
+        'names': np.array(['A', 'B']),
+        'large': rng.normal(size=(3, MAP_BYTES)),
+        'counts': rng.integers(-32000, 32000, size=(4, 2, MAP_BYTES), dtype=np.int16),
+        'fortran': np.asfortranarray(rng.normal(size=(MAP_BYTES//16, 5))),
+        'small_fortran': np.asfortranarray(np.arange(12.0).reshape(3, 4)),
+    }
+
+
+@pytest.mark.parametrize('save', [np.savez, np.savez_compressed])
+def test_matches_np_load(tmp_path, save):
+    path = str(tmp_path / 'trace.npz')
+    save(path, **arrays())
+    files = _NpzFiles(path)
+    with np.load(path) as expected:
+        assert sorted(files.files) == sorted(expected.files)
+        for key in expected.files:
+            array = files[key]
+            assert array.dtype == expected[key].dtype
+            assert array.shape == expected[key].shape
+            assert np.array_equal(array, expected[key])
+            if array.ndim:
+                assert np.array_equal(files[key][..., 1:7], expected[key][..., 1:7])
+    files.close()
+
+
+def test_uncompressed_arrays_are_mapped(tmp_path):
+    path = str(tmp_path / 'trace.npz')
+    np.savez(path, **arrays())
+    files = _NpzFiles(path)
+    for key in ('large', 'counts', 'fortran'):
+        assert isinstance(files[key], np.memmap)
+    assert files['fortran'].flags.f_contiguous
+    assert not isinstance(files['small'], np.memmap)
+    # copy on write, like an array from np.load the mapped one can be changed without changing the file
+    files['large'][0, 0] = 1e9
+    assert _NpzFiles(path)['large'][0, 0] != 1e9
+
+
+def test_raw_trace_channels(tmp_path):
+    path = str(tmp_path / 'raw.npz')
+    counts = np.random.default_rng(1).integers(-32000, 32000, size=(2, MAP_BYTES), dtype=np.int16)
+    np.savez(path, **pack_raw(counts, [7, 8], 32512, [0.1, -0.2], -1000.0, 2.0, 'AB'))
+    with load_trace(path) as trace:
+        mV = counts[0]*(trace.range_mV[0]/32512) - 100.0
+        assert np.allclose(trace['ChA_mV'], mV)
+        assert np.allclose(trace.channel('A', 100, 200), mV[100:200])
+        times_ns, window = trace.window(0, 20, ['A', 'B'])
+        assert np.allclose(times_ns, np.arange(0, 20, 2.0))
+        assert np.allclose(window[0], mV[500:510])
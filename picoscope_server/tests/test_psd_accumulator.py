@@ -0,0 +1,61 @@
+# WelchAccumulator against scipy.signal.welch, and its checkpoints
+
+import numpy as np
+import pytest
+from scipy import signal
+
+from psd_accumulator import WelchAccumulator, resume
+
+
+def test_resume_checks_settings(tmp_path):
+    checkpoint = str(tmp_path / 'psd.npz')
+    accumulator = WelchAccumulator(1e6, nfft=256, overlap=0.5, window='hann', detrend='constant')
+    accumulator.add(np.random.default_rng(0).normal(size=4096))
+    accumulator.save(checkpoint)
+    assert resume(checkpoint, 1e6, 256, 0.5, 'hann', 'constant').segments == accumulator.segments
+    for overlap, window, detrend in ((0.25, 'hann', 'constant'), (0.5, 'hamming', 'constant'), (0.5, 'hann', 'linear'), (0.5, 'hann', None)):
+        with pytest.raises(ValueError):
+            resume(checkpoint, 1e6, 256, overlap, window, detrend)
+
+
+@pytest.mark.parametrize('detrend', ['constant', 'linear', None])
+def test_matches_welch(detrend):
+    x = np.random.default_rng(1).normal(size=10000) + np.linspace(0, 5, 10000)
+    accumulator = WelchAccumulator(1e6, nfft=256, overlap=0.5, window='hann', detrend=detrend)
+    accumulator.add(x)
+    freqs, psd = signal.welch(x, fs=1e6, window='hann', nperseg=256, noverlap=128, detrend=detrend or False)
+    assert np.allclose(accumulator.psd()[0], freqs)
+    assert np.allclose(accumulator.psd()[1], psd)
+
+
+def test_chunked_matches_one_shot():
+    x = np.random.default_rng(2).normal(size=10000)
+    one_shot = WelchAccumulator(1e6, nfft=256)
+    one_shot.add(x)
+    chunked = WelchAccumulator(1e6, nfft=256)
+    # uneven chunks, some shorter than a segment, so segments run across the boundaries
+    bounds = [0, 100, 150, 1000, 1001, 5000, 10000]
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        chunked.add(x[start:stop], continued=start > 0)
+    assert chunked.segments == one_shot.segments
+    assert chunked.captures == 1
+    assert np.allclose(chunked.psd()[1], one_shot.psd()[1])
+
+
+def test_checkpoint_round_trip(tmp_path):
+    checkpoint = str(tmp_path / 'psd.npz')
+    x = np.random.default_rng(3).normal(size=10000)
+    uninterrupted = WelchAccumulator(1e6, nfft=256, detrend='linear')
+    uninterrupted.add(x[:3000])
+    uninterrupted.add(x[3000:], continued=True)
+    accumulator = WelchAccumulator(1e6, nfft=256, detrend='linear')
+    accumulator.add(x[:3000])
+    accumulator.sources.append('shot1')
+    accumulator.save(checkpoint)
+    # the tail left over from the first chunk is saved too, so the record continues where it stopped
+    resumed = resume(checkpoint, 1e6, 256, 0.5, 'hann', 'linear')
+    assert resumed.sources == ['shot1']
+    assert (resumed.segments, resumed.captures) == (accumulator.segments, accumulator.captures)
+    resumed.add(x[3000:], continued=True)
+    assert resumed.segments == uninterrupted.segments
+    assert np.allclose(resumed.psd()[1], uninterrupted.psd()[1])
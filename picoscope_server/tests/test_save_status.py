@@ -0,0 +1,35 @@
+# save_status / wait_for_save know about shots that don't end up in a .npz file at the path given to get_data
+
+import json
+
+import pytest
+
+from picoscope_server import PicoscopeServer
+
+
+@pytest.fixture
+def server():
+    server = PicoscopeServer()
+    server.initServer()
+    server.set_simulated(None, True, json.dumps({'trigger_delay_s': 0.0, 'transfer_rate': 0, 'seed': 1}))
+    server.set_recordduration_5000a(None, 1e-5, 100, 900)
+    yield server
+    server.stopServer()
+
+
+def test_run_file_shot(server, tmp_path):
+    server.open_run(None, str(tmp_path / 'run.h5'))
+    server.get_data_5000a(None, 'shot1', 'SIM')
+    assert server.save_status(None, 'shot1') == 'saved'
+    server.wait_for_save(None, 'shot1')
+    assert server.save_status(None, 'shot2') == 'unknown'
+    with pytest.raises(ValueError):
+        server.wait_for_save(None, 'shot2')
+
+
+def test_mmap_shot(server, tmp_path):
+    path = str(tmp_path / 'trace.bin')
+    server.set_storage_format(None, 'mmap')
+    server.get_data_5000a(None, path, 'SIM')
+    assert server.save_status(None, path) == 'saved'
+    server.wait_for_save(None, path)
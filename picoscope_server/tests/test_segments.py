@@ -0,0 +1,20 @@
+# Rapid block captures that don't fit in a memory segment are refused before RunBlock
+
+import json
+
+import pytest
+
+from picoscope_server import PicoscopeServer
+
+
+def test_segment_too_small(tmp_path):
+    server = PicoscopeServer()
+    server.initServer()
+    server.set_simulated(None, True, json.dumps({'trigger_delay_s': 0.0, 'transfer_rate': 0, 'memory_samples': 10000}))
+    try:
+        server.set_recordduration_5000a(None, 1e-5, 100, 900)
+        server.get_data_rapid_5000a(None, str(tmp_path / 'fits'), 'SIM', 10)
+        with pytest.raises(ValueError, match='memory segments'):
+            server.get_data_rapid_5000a(None, str(tmp_path / 'too_long'), 'SIM', 20)
+    finally:
+        server.stopServer()
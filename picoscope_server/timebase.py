@@ -0,0 +1,69 @@
+# Picoscope timebase calculator
+#
+# The sample interval of timebase n depends on the model, the resolution and, through the fastest
+# allowed timebase, on the number of enabled channels.
+# See the "Timebases" sections of
+#   picotech.com/download/manuals/picoscope-5000-series-a-api-programmers-guide.pdf
+#   picotech.com/download/manuals/picoscope-3000-series-a-api-programmers-guide.pdf
+#
+#   5000a  8-bit:  n=0..2: 2^n/1e9 s                n>=3: (n-2)/125e6 s
+#   5000a 12-bit:  n=1..3: 2^(n-1)/500e6 s          n>=4: (n-3)/62.5e6 s
+#   5000a 14/15-bit:                                n>=3: (n-2)/125e6 s
+#   5000a 16-bit:                                   n>=4: (n-3)/62.5e6 s
+#   3000a  8-bit:  n=0..2: 2^n/1e9 s                n>=3: (n-2)/125e6 s
+#
+# Each entry is
+#   (fast, first linear timebase, linear offset, linear rate, fastest timebase for 1, 2, 3, 4 channels)
+# where fast = (exponent offset, rate) gives 2^(n - exponent offset)/rate for the timebases below the
+# linear range, or None if there are none. A channel count missing from the last tuple isn't
+# supported at that resolution (15 bit is limited to 2 channels, 16 bit to 1)
+
+from functools import lru_cache
+
+TIMEBASES = {
+    ('5000a', 8): ((0, 1e9), 3, 2, 125e6, (0, 1, 2, 2)),
+    ('5000a', 12): ((1, 500e6), 4, 3, 62.5e6, (1, 2, 3, 3)),
+    ('5000a', 14): (None, 3, 2, 125e6, (3, 3, 3, 3)),
+    ('5000a', 15): (None, 3, 2, 125e6, (3, 3)),
+    ('5000a', 16): (None, 4, 3, 62.5e6, (4,)),
+    ('3000a', 8): ((0, 1e9), 3, 2, 125e6, (0, 1, 2, 2)),
+}
+
+MAX_TIMEBASE = 2**32 - 1
+
+
+def max_channels(model, bits):
+    # Number of channels that can be enabled at once at this resolution
+    if (model, bits) not in TIMEBASES:
+        raise ValueError(f'no timebase table for a {model} at {bits} bit')
+    return len(TIMEBASES[(model, bits)][4])
+
+
+def _table(model, bits, n_channels):
+    if not 1 <= n_channels <= max_channels(model, bits):
+        raise ValueError(f'a {model} at {bits} bit supports 1 to {max_channels(model, bits)} channels, not {n_channels}')
+    return TIMEBASES[(model, bits)]
+
+
+def timebase_interval(model, bits, n_channels, timebase):
+    # Sample interval in s of a timebase
+    fast, linear_from, offset, rate, fastest = _table(model, bits, n_channels)
+    if timebase < fastest[n_channels - 1]:
+        raise ValueError(f'timebase {timebase} is faster than a {model} can sample {n_channels} channels at {bits} bit')
+    if timebase < linear_from:
+        return 2**(timebase - fast[0]) / fast[1]
+    return (timebase - offset) / rate
+
+
+@lru_cache(maxsize=256)
+def solve_timebase(model, bits, n_channels, interval):
+    # Timebase whose sample interval is closest to interval (in s) for this model, resolution and number of
+    # enabled channels, never faster than the device allows. Cached, since the same few configurations recur
+    # Returns (timebase, sample interval in s)
+    fast, linear_from, offset, rate, fastest = _table(model, bits, n_channels)
+    first = fastest[n_channels - 1]
+
+    candidates = list(range(first, max(first, linear_from)))
+    candidates.append(min(MAX_TIMEBASE, max(first, linear_from, round(interval*rate + offset))))
+    timebase = min(candidates, key=lambda n: abs(timebase_interval(model, bits, n_channels, n) - interval))
+    return timebase, timebase_interval(model, bits, n_channels, timebase)
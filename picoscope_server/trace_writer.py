@@ -0,0 +1,121 @@
+# Background writer for saved traces
+#
+# Saving a multi-megabyte trace takes longer than the rest of a shot, so with a TraceWriter the
+# acquisition thread only queues the shot and returns; a single writer thread builds the arrays
+# to save (e.g. the mV conversion) and writes the file. The queue holds at most max_pending shots,
+# after that submit() blocks until the writer catches up, so a slow disk slows the shots down
+# instead of using up the memory.
+#
+# Files are written to path + '.tmp', fsync'ed and renamed to path, so a file that exists is complete
+# and on disk. The state of each shot's file can be checked with job(path).state or waited for with job(path).wait().
+
+import collections
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class SaveJob:
+    # One queued file. state is 'queued', 'writing', 'saved' or 'failed'
+
+    def __init__(self, path, pack, write):
+        self.path = path
+        self.pack = pack # function returning the dict of arrays to save
+        self.write = write # function(path, arrays) writing them
+        self.state = 'queued'
+        self.error = None
+        self.timings = {}
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        # Wait until the file is on disk, raising the error if writing it failed.
+        # Returns False if it is still pending after timeout s
+        if not self.done.wait(timeout):
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+
+def npz_path(path):
+    # np.savez adds .npz to paths without it, the writer does the same
+    return path if path.endswith('.npz') else path + '.npz'
+
+
+def write_npz(path, arrays):
+    # np.savez to path + '.tmp', fsync, then rename to path, so path only ever holds a complete file
+    path = npz_path(path)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class TraceWriter:
+
+    def __init__(self, max_pending=4, history=10000):
+        # Inputs:
+        #   max_pending: shots that can wait in the queue before submit blocks
+        #   history: number of finished shots whose state is remembered for status/wait
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.jobs = collections.OrderedDict() # path -> SaveJob, oldest first
+        self.history = history
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, path, pack, write=write_npz):
+        # Queue a file, blocking while max_pending shots are already waiting. Returns its SaveJob
+        # Inputs:
+        #   path: file to write
+        #   pack: function called on the writer thread that returns the dict of arrays to np.savez.
+        #         It must only use data that isn't changed after submit, e.g. a copy of the counts
+        #   write: function(path, arrays) that saves them, e.g. RunFile.append instead of a .npz file
+        job = SaveJob(path, pack, write)
+        with self.lock:
+            self.jobs.pop(npz_path(path), None)
+            self.jobs[npz_path(path)] = job
+            while len(self.jobs) > self.history and next(iter(self.jobs.values())).done.is_set():
+                self.jobs.popitem(last=False)
+        self.queue.put(job)
+        return job
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            job.state = 'writing'
+            try:
+                start = time.perf_counter()
+                arrays = job.pack()
+                job.timings['convert'] = time.perf_counter() - start
+                job.write(job.path, arrays)
+                job.timings['save'] = time.perf_counter() - start - job.timings['convert']
+                job.state = 'saved'
+            except Exception as error:
+                print(f'saving {job.path} failed: {error!r}')
+                job.error = error
+                job.state = 'failed'
+            job.pack = job.write = None
+            job.done.set()
+            self.queue.task_done()
+
+    def job(self, path):
+        # SaveJob of the last file queued for path, or None if it isn't known
+        with self.lock:
+            return self.jobs.get(npz_path(path))
+
+    def join(self):
+        # Wait until everything queued so far is written
+        self.queue.join()
+
+    def close(self):
+        # Write everything still queued, then stop the writer thread
+        self.queue.put(None)
+        self.thread.join()